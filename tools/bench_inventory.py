@@ -0,0 +1,259 @@
+#!/usr/bin/python
+"""
+Inventory-scale benchmark for the lookup helpers in vsphere_clone_template.
+
+Builds inventories of increasing size in an in-process FakeVcenter
+(tools/fake_vcenter.py) and times the helpers whose cost grows with the
+inventory: VsphereHelpers.get_vm, VsphereHelpers.collect_properties,
+FolderHelpers.get_folder_objects and find_folder, NetworkHelpers.get_network,
+pytree.search_leaves_extra_data and the InventorySnapshot path.
+
+For every case it reports the best wall time over --repeat runs, the
+number of vCenter round trips one run makes (the SOAP methods a real
+vCenter would have received) and the peak memory. Peak memory comes from
+tracemalloc when the interpreter has it. Otherwise it is the growth of the
+resident set size: on Linux the peak is reset before every run through
+/proc/self/clear_refs, elsewhere the process' maximum resident set size
+only ever goes up, so later cases read low. There is no
+network or XML in the loop, so wall times measure client-side work plus
+the fake's own; compare runs against each other, not against a vCenter.
+
+Usage:
+    bench_inventory.py --vms 1000,10000,100000 --folder-depth 6 \\
+        --portgroups 2000 --json bench.json
+"""
+
+import argparse
+import gc
+import imp
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_vcenter import FakeVcenter, build_inventory
+from pyVmomi import vim
+
+MODULE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vsphere_clone_template.py")
+
+
+def _max_rss_kb():
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def _proc_status_kb(field):
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """
+    Reset the process' peak RSS to its current RSS.
+    Returns:
+        The current RSS in KB, or None when the peak cannot be reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except (IOError, OSError):
+        return None
+    return _proc_status_kb("VmRSS")
+
+
+def measure(fake, func, repeat):
+    """
+    Run func repeat times.
+    Returns:
+        A dict with the best wall time, the round trips of the last run,
+        the peak memory in KB and the last result
+    """
+    best = None
+    calls = 0
+    result = None
+    peak_kb = 0
+    for x in range(repeat):
+        gc.collect()
+        rss_before = _reset_peak_rss() if tracemalloc is None else None
+        max_rss_before = _max_rss_kb()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        fake.reset_calls()
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        calls = fake.total_calls()
+        if tracemalloc is not None:
+            peak_kb = max(peak_kb, tracemalloc.get_traced_memory()[1] // 1024)
+            tracemalloc.stop()
+        elif rss_before is not None:
+            peak_kb = max(peak_kb, (_proc_status_kb("VmHWM") or rss_before) - rss_before)
+        else:
+            peak_kb = max(peak_kb, _max_rss_kb() - max_rss_before)
+        best = elapsed if best is None else min(best, elapsed)
+    return {"seconds": best, "round_trips": calls, "peak_kb": peak_kb, "result": result}
+
+
+def folder_path(fake, folder, vm_folder):
+    """Folder names from below the datacenter's vm folder down to folder."""
+    names = []
+    while folder is not None and folder._moId != vm_folder._moId:
+        names.append(fake.get(folder, "name"))
+        folder = fake.get(folder, "parent")
+    return names[::-1]
+
+
+def folder_tree(module, folder_objects, vm_folder):
+    """
+    pytree of the folder objects shaped the way find_folder builds it: each
+    node is a folder, its extra_data the folder's children.
+    """
+    root_tree = module.pytree("root", None)
+    pending = list(folder_objects)
+    parents = {vm_folder._moId: root_tree}
+    while pending:
+        remaining = []
+        for folder in pending:
+            parent = parents.get(folder["parent"]._moId) if folder["parent"] is not None else None
+            if parent is None:
+                remaining.append(folder)
+                continue
+            node = module.pytree(folder["folder"], folder["child"], meta_data={"name": folder["name"], "parent": folder["parent"]})
+            parent.add_leaf(node)
+            parents[folder["folder"]._moId] = node
+        if len(remaining) == len(pending):
+            break
+        pending = remaining
+    return root_tree
+
+
+def run_size(module, args, vm_count):
+    build_start = time.time()
+    fake = FakeVcenter()
+    inv = build_inventory(fake, vms=vm_count, folders=args.folders, folder_depth=args.folder_depth,
+                          networks=args.networks, portgroups=args.portgroups, datastores=args.datastores)
+    build_seconds = time.time() - build_start
+
+    si = fake.service_instance
+    vm_folder = inv["vm_folder"]
+    dc_folder = {"dc": inv["datacenter"], "folder": vm_folder, "name": "dc1"}
+    last_vm = "vm%06d" % (vm_count - 1)
+    last_leaf = inv["leaves"][-1]
+    structure = folder_path(fake, last_leaf, vm_folder)
+    network_name = "pg%04d" % (args.portgroups - 1) if args.portgroups > 0 else "net%04d" % (args.networks - 1)
+    helpers = module.VsphereHelpers
+
+    def collect():
+        view = helpers.get_container_view(si, obj_type=[vim.VirtualMachine])
+        return helpers.collect_properties(si, view_ref=view, obj_type=vim.VirtualMachine,
+                                          path_set=["name", "parent"], include_mors=True)
+
+    folder_objects = module.FolderHelpers.get_folder_objects(si, inv["datacenter"])
+    tree = folder_tree(module, folder_objects, vm_folder)
+    # The deepest, last-built folder is the worst case for the depth-first search.
+    search_for = fake.get(last_leaf, "parent")
+    inventory = module.InventorySnapshot(si)
+
+    cases = [("get_vm", lambda: helpers.get_vm(si, last_vm)),
+             ("collect_properties", collect),
+             ("get_folder_objects", lambda: module.FolderHelpers.get_folder_objects(si, inv["datacenter"])),
+             ("find_folder", lambda: module.FolderHelpers.find_folder(si, structure, folder_objects, dc_folder)),
+             ("get_network", lambda: module.NetworkHelpers.get_network(si, network_name)),
+             ("search_leaves_extra_data", lambda: module.pytree.search_leaves_extra_data(tree, last_leaf)),
+             ("InventorySnapshot", lambda: module.InventorySnapshot(si)),
+             ("get_vm (inventory)", lambda: helpers.get_vm(si, last_vm, inventory)),
+             ("get_network (inventory)", lambda: module.NetworkHelpers.get_network(si, network_name, inventory))]
+
+    results = []
+    for name, func in cases:
+        if args.only and name.split(" ")[0] not in args.only:
+            continue
+        measured = measure(fake, func, args.repeat)
+        result = measured.pop("result")
+        if name.startswith("get_vm") and len(result) != 1:
+            raise Exception("%s found %s VMs named %s" % (name, len(result), last_vm))
+        if name == "find_folder" and result[0] != last_leaf:
+            raise Exception("find_folder resolved %s to %s" % (",".join(structure), result[0]))
+        if name == "search_leaves_extra_data" and (result is None or result.name != search_for):
+            raise Exception("search_leaves_extra_data did not find %s" % last_leaf)
+        measured["case"] = name
+        results.append(measured)
+
+    helpers.destroy_views()
+    return {"vms": vm_count,
+            "folders": len(folder_objects),
+            "networks": args.networks + args.portgroups,
+            "build_seconds": build_seconds,
+            "max_rss_kb": _max_rss_kb(),
+            "cases": results}
+
+
+def report(runs, out):
+    memory = "peak KB" if tracemalloc is not None else "RSS +KB"
+    for run in runs:
+        out.write("%d VMs, %d folders, %d networks (built in %.1fs, max RSS %d KB)\n"
+                  % (run["vms"], run["folders"], run["networks"], run["build_seconds"], run["max_rss_kb"]))
+        out.write("  %-26s %12s %12s %12s\n" % ("case", "seconds", "round trips", memory))
+        for case in run["cases"]:
+            out.write("  %-26s %12.4f %12d %12d\n" % (case["case"], case["seconds"], case["round_trips"], case["peak_kb"]))
+        out.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the inventory lookups against an in-process fake vCenter.")
+    parser.add_argument("--vms", default="1000,10000,100000",
+                        help="Comma separated inventory sizes")
+    parser.add_argument("--folders", type=int, default=10,
+                        help="Folders below the vm folder; deeper levels have two children each")
+    parser.add_argument("--folder-depth", type=int, default=4)
+    parser.add_argument("--networks", type=int, default=50,
+                        help="Standard networks")
+    parser.add_argument("--portgroups", type=int, default=500,
+                        help="Distributed portgroups")
+    parser.add_argument("--datastores", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per case; the best wall time is reported")
+    parser.add_argument("--only", action="append",
+                        help="Run only this case; may be repeated")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--module", default=MODULE,
+                        help="vsphere_clone_template.py to benchmark")
+    args = parser.parse_args()
+
+    module = imp.load_source("vsphere_clone_template", args.module)
+
+    runs = []
+    for vm_count in [int(x) for x in args.vms.split(",") if x.strip()]:
+        run = run_size(module, args, vm_count)
+        report([run], sys.stdout)
+        sys.stdout.flush()
+        runs.append(run)
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump({"python": sys.version.split()[0], "args": vars(args), "runs": runs}, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
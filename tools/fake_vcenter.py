@@ -0,0 +1,937 @@
+#!/usr/bin/python
+"""
+In-process stand-in for a vCenter server.
+
+FakeVcenter is a pyVmomi stub adapter: managed objects created against it
+(vim.VirtualMachine('vm-1', fake) and everything reachable from
+fake.service_instance) route their property reads and method calls into
+this class instead of onto the wire. Data objects are the real pyVmomi
+types, so module code runs unmodified. Every call is counted in
+fake.calls as the SOAP method a real vCenter would have received.
+"""
+
+import datetime
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+from pyVmomi.VmomiSupport import ManagedObject
+
+
+def _untyped(data_object, name, val):
+    # anyType slots: plain python lists are fine on the client side and
+    # skipping the pyVmomi type check keeps large inventories cheap.
+    object.__setattr__(data_object, name, val)
+    return data_object
+
+
+class FakeVcenter(object):
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.objects = {}
+        self.children = defaultdict(list)
+        self.revisions = defaultdict(dict)
+        self.names = defaultdict(set)
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.cookie = "vmware_soap_session=\"fake\""
+        self.sessions = set()
+        self._ids = itertools.count(1)
+        self._results = {}
+        self.tasks = []
+        self.events = []
+        self.cloning = set()
+        self.clone_specs = {}
+        self.clone_sources = {}
+        self.hosts = []
+        self.timers = []
+        self.event_collectors = {}
+
+        self.service_instance = vim.ServiceInstance("ServiceInstance", self)
+        self.root_folder = self.add(vim.Folder, "group-d1", name="Datacenters", parent=None)
+        self.property_collector = self.add(vmodl.query.PropertyCollector, "propertyCollector", filter=[])
+        self.view_manager = self.add(vim.view.ViewManager, "ViewManager", viewList=[])
+        self.session_manager = self.add(vim.SessionManager, "SessionManager", currentSession=None)
+        self.storage_resource_manager = self.add(vim.StorageResourceManager, "StorageResourceManager")
+        self.task_manager = self.add(vim.TaskManager, "TaskManager", recentTask=[])
+        self.event_manager = self.add(vim.event.EventManager, "EventManager", latestEvent=None)
+        self.search_index = self.add(vim.SearchIndex, "SearchIndex")
+        self.perf_manager = self.add(vim.PerformanceManager, "PerfMgr", perfCounter=[
+            vim.PerformanceManager.CounterInfo(key=key, groupInfo=vim.ElementDescription(key=group, label=group, summary=group),
+                                               nameInfo=vim.ElementDescription(key=name, label=name, summary=name),
+                                               unitInfo=vim.ElementDescription(key=unit, label=unit, summary=unit),
+                                               rollupType="average", statsType="rate", level=1)
+            for key, group, name, unit in PERF_COUNTERS])
+        # (host name or datastore name, counter name) -> realtime sample
+        # value; unset pairs report a value derived from the name.
+        self.perf_values = {}
+
+        self.content = vim.ServiceInstanceContent(
+            rootFolder=self.root_folder,
+            propertyCollector=self.property_collector,
+            viewManager=self.view_manager,
+            sessionManager=self.session_manager,
+            storageResourceManager=self.storage_resource_manager,
+            taskManager=self.task_manager,
+            eventManager=self.event_manager,
+            perfManager=self.perf_manager,
+            searchIndex=self.search_index,
+            about=vim.AboutInfo(name="Fake vCenter", apiVersion="6.7", apiType="VirtualCenter"))
+        self.add(vim.ServiceInstance, "ServiceInstance", content=self.content)
+
+    # ------------------------------------------------------------------
+    # inventory
+    # ------------------------------------------------------------------
+    def add(self, vimtype, moid=None, under=None, **props):
+        with self.lock:
+            if moid is None:
+                moid = "%s-%s" % (vimtype.__name__.split(".")[-1].lower(), next(self._ids))
+            obj = vimtype(moid, self)
+            if isinstance(obj, vim.HostSystem):
+                self.hosts.append(obj)
+            self.objects[moid] = {"obj": obj, "props": {}}
+            for key, val in props.items():
+                self.set(obj, key, val)
+            if under is not None:
+                self.children[under._moId].append(obj)
+                if isinstance(under, vim.Folder):
+                    siblings = self.objects[under._moId]["props"].setdefault("childEntity", [])
+                    siblings.append(obj)
+                    self.set(under, "childEntity", siblings)
+            return obj
+
+    def remove(self, obj):
+        with self.lock:
+            entry = self.objects.pop(obj._moId, None)
+            if entry is not None:
+                self.names[entry["props"].get("name")].discard(obj._moId)
+            for members in self.children.values():
+                if obj in members:
+                    members.remove(obj)
+            self.changed.notify_all()
+
+    def set(self, obj, prop, val):
+        with self.lock:
+            if prop == "name":
+                self.names[self.objects[obj._moId]["props"].get("name")].discard(obj._moId)
+                self.names[val].add(obj._moId)
+            self.objects[obj._moId]["props"][prop] = val
+            self.revisions[obj._moId][prop] = next(self._ids)
+            self.changed.notify_all()
+
+    def get(self, obj, path):
+        with self.lock:
+            entry = self.objects.get(obj._moId)
+            if entry is None:
+                raise vmodl.fault.ManagedObjectNotFound(obj=obj)
+            parts = path.split(".")
+            if parts[0] == "view" and isinstance(obj, vim.view.ContainerView):
+                val = self._view_members(entry["props"])
+            else:
+                val = entry["props"].get(parts[0])
+            for part in parts[1:]:
+                if val is None:
+                    return None
+                val = getattr(val, part, None)
+            return val
+
+    def has(self, obj, path):
+        entry = self.objects.get(obj._moId)
+        if entry is None:
+            return False
+        top = path.split(".")[0]
+        return top in entry["props"] or (top == "view" and isinstance(obj, vim.view.ContainerView))
+
+    def descendants(self, container):
+        found = []
+        stack = deque(self.children.get(container._moId, []))
+        while stack:
+            obj = stack.popleft()
+            found.append(obj)
+            stack.extend(self.children.get(obj._moId, []))
+        return found
+
+    def _view_members(self, props):
+        types = tuple(props["type"])
+        if props["recursive"]:
+            members = self.descendants(props["container"])
+        else:
+            members = list(self.children.get(props["container"]._moId, []))
+        return [x for x in members if isinstance(x, types)]
+
+    def find(self, vimtype, name):
+        with self.lock:
+            found = [self.objects[x]["obj"] for x in self.names.get(name, ())]
+        return [x for x in found if isinstance(x, vimtype)]
+
+    # ------------------------------------------------------------------
+    # stub adapter interface
+    # ------------------------------------------------------------------
+    def InvokeAccessor(self, mo, info):
+        with self.lock:
+            self.calls["RetrievePropertiesEx"] += 1
+        self.before_call("RetrievePropertiesEx", mo, [])
+        with self.lock:
+            self.advance()
+            return self.get(mo, info.name)
+
+    def InvokeMethod(self, mo, info, args):
+        with self.lock:
+            self.calls[info.wsdlName] += 1
+        self.before_call(info.wsdlName, mo, args)
+        handler = getattr(self, "_%s" % info.wsdlName, None)
+        if handler is None:
+            raise vmodl.fault.NotImplemented(msg="FakeVcenter does not implement %s" % info.wsdlName)
+        # Handlers run one at a time, like vCenter's own inventory lock;
+        # WaitForUpdatesEx releases the lock while it waits.
+        with self.lock:
+            return handler(mo, *args)
+
+    def before_call(self, method, mo, args):
+        """Hook for subclasses that add latency or faults."""
+        pass
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        self.calls.clear()
+
+    # ------------------------------------------------------------------
+    # ServiceInstance / SessionManager
+    # ------------------------------------------------------------------
+    def _RetrieveServiceContent(self, mo):
+        return self.content
+
+    def _CurrentTime(self, mo):
+        return datetime.datetime.utcnow()
+
+    def _Login(self, mo, userName, password, locale=None):
+        session = vim.UserSession(key="session-%s" % next(self._ids), userName=userName)
+        self.sessions.add(session.key)
+        self.set(self.session_manager, "currentSession", session)
+        return session
+
+    def _Logout(self, mo):
+        current = self.get(self.session_manager, "currentSession")
+        if current is not None:
+            self.sessions.discard(current.key)
+        self.set(self.session_manager, "currentSession", None)
+
+    def _SessionIsActive(self, mo, sessionID, userName):
+        return sessionID in self.sessions
+
+    # ------------------------------------------------------------------
+    # views
+    # ------------------------------------------------------------------
+    def _CreateContainerView(self, mo, container, type=None, recursive=False):
+        view = self.add(vim.view.ContainerView, container=container,
+                        type=list(type or [vim.ManagedEntity]), recursive=recursive)
+        self.objects[self.view_manager._moId]["props"]["viewList"].append(view)
+        return view
+
+    def _DestroyView(self, mo):
+        views = self.objects[self.view_manager._moId]["props"]["viewList"]
+        if mo in views:
+            views.remove(mo)
+        self.remove(mo)
+
+    # ------------------------------------------------------------------
+    # PropertyCollector
+    # ------------------------------------------------------------------
+    def _select(self, object_set):
+        found = []
+        seen = set()
+        for spec in object_set:
+            names = {}
+            self._collect_traversals(spec.selectSet or [], names)
+            self._walk(spec.obj, spec.skip, spec.selectSet or [], names, found, seen, set())
+        return found
+
+    def _collect_traversals(self, select_set, names):
+        for sel in select_set:
+            if isinstance(sel, vmodl.query.PropertyCollector.TraversalSpec):
+                if sel.name and sel.name not in names:
+                    names[sel.name] = sel
+                    self._collect_traversals(sel.selectSet or [], names)
+                elif not sel.name:
+                    self._collect_traversals(sel.selectSet or [], names)
+
+    def _walk(self, obj, skip, select_set, names, found, seen, visited):
+        if obj is None or obj._moId not in self.objects:
+            return
+        if not skip and obj._moId not in seen:
+            seen.add(obj._moId)
+            found.append(obj)
+        for sel in select_set:
+            if isinstance(sel, vmodl.query.PropertyCollector.TraversalSpec):
+                traversal = sel
+            else:
+                traversal = names.get(sel.name)
+            if traversal is None or not isinstance(obj, traversal.type):
+                continue
+            key = (obj._moId, traversal.name, traversal.path)
+            if key in visited:
+                continue
+            visited.add(key)
+            targets = self.get(obj, traversal.path)
+            if targets is None:
+                continue
+            if not isinstance(targets, (list, tuple)):
+                targets = [targets]
+            for target in targets:
+                if isinstance(target, ManagedObject):
+                    self._walk(target, traversal.skip, traversal.selectSet or [], names, found, seen, visited)
+
+    def _paths_for(self, obj, prop_set):
+        paths = []
+        for spec in prop_set:
+            if not isinstance(obj, spec.type):
+                continue
+            if spec.all:
+                paths.extend(sorted(self.objects[obj._moId]["props"].keys()))
+            else:
+                paths.extend(spec.pathSet or [])
+        return list(dict.fromkeys(paths)) if paths else []
+
+    def _content(self, obj, prop_set):
+        props = []
+        for path in self._paths_for(obj, prop_set):
+            if self.has(obj, path):
+                val = self.get(obj, path)
+                # vCenter leaves unset properties (info.result of a running
+                # task, the root folder's parent) out of propSet.
+                if val is not None:
+                    props.append(_untyped(vmodl.DynamicProperty(name=path), "val", val))
+        return vmodl.query.PropertyCollector.ObjectContent(obj=obj, propSet=props)
+
+    def _retrieve(self, spec_set):
+        with self.lock:
+            result = []
+            for spec in spec_set:
+                for obj in self._select(spec.objectSet):
+                    if len([x for x in spec.propSet if isinstance(obj, x.type)]) > 0:
+                        result.append(self._content(obj, spec.propSet))
+            return result
+
+    def _RetrieveContents(self, mo, specSet):
+        return self._retrieve(specSet)
+
+    def _RetrieveProperties(self, mo, specSet):
+        return self._retrieve(specSet)
+
+    def _RetrievePropertiesEx(self, mo, specSet, options=None):
+        return self._page(self._retrieve(specSet), options)
+
+    def _ContinueRetrievePropertiesEx(self, mo, token):
+        objects, options = self._results.pop(token)
+        return self._page(objects, options)
+
+    def _CancelRetrievePropertiesEx(self, mo, token):
+        self._results.pop(token, None)
+
+    def _page(self, objects, options):
+        if not objects:
+            return None
+        limit = options.maxObjects if options is not None and options.maxObjects else len(objects)
+        result = vmodl.query.PropertyCollector.RetrieveResult(objects=objects[:limit])
+        if len(objects) > limit:
+            token = "token-%s" % next(self._ids)
+            self._results[token] = (objects[limit:], options)
+            result.token = token
+        return result
+
+    def _CreatePropertyCollector(self, mo):
+        return self.add(vmodl.query.PropertyCollector, filter=[], version=0)
+
+    def _DestroyPropertyCollector(self, mo):
+        for pc_filter in list(self.get(mo, "filter") or []):
+            self.remove(pc_filter)
+        self.remove(mo)
+
+    def _CreateFilter(self, mo, spec, partialUpdates):
+        pc_filter = self.add(vmodl.query.PropertyCollector.Filter, spec=spec,
+                             partialUpdates=partialUpdates, reported={})
+        self.objects[mo._moId]["props"].setdefault("filter", []).append(pc_filter)
+        return pc_filter
+
+    def _DestroyPropertyFilter(self, mo):
+        for entry in self.objects.values():
+            filters = entry["props"].get("filter")
+            if isinstance(filters, list) and mo in filters:
+                filters.remove(mo)
+        self.remove(mo)
+
+    def _filter_update(self, pc_filter):
+        spec = self.get(pc_filter, "spec")
+        reported = self.objects[pc_filter._moId]["props"]["reported"]
+        updates = []
+        current = {}
+        for obj in self._select(spec.objectSet):
+            paths = self._paths_for(obj, spec.propSet)
+            revs = dict((p, self.revisions[obj._moId].get(p.split(".")[0])) for p in paths)
+            current[obj._moId] = revs
+            before = reported.get(obj._moId)
+            if before is None:
+                kind = "enter"
+                changed = [p for p in paths if self.has(obj, p)]
+            else:
+                kind = "modify"
+                changed = [p for p in paths if before.get(p) != revs[p]]
+            if changed:
+                changes = [_untyped(vmodl.query.PropertyCollector.Change(name=p, op="assign"), "val", self.get(obj, p))
+                           for p in changed]
+                updates.append(vmodl.query.PropertyCollector.ObjectUpdate(kind=kind, obj=obj, changeSet=changes))
+        for moid in reported:
+            if moid not in current and moid in self.objects:
+                updates.append(vmodl.query.PropertyCollector.ObjectUpdate(kind="leave", obj=self.objects[moid]["obj"], changeSet=[]))
+        self.objects[pc_filter._moId]["props"]["reported"] = current
+        if updates:
+            return vmodl.query.PropertyCollector.FilterUpdate(filter=pc_filter, objectSet=updates)
+        return None
+
+    def _WaitForUpdatesEx(self, mo, version=None, options=None):
+        max_wait = None
+        if options is not None and options.maxWaitSeconds is not None:
+            max_wait = options.maxWaitSeconds
+        deadline = None if max_wait is None else time.time() + max_wait
+        with self.lock:
+            entry = self.objects.get(mo._moId)
+            if entry is None:
+                raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+            props = entry["props"]
+            if version not in (None, "") and str(version) != str(props.get("version", 0)):
+                raise vmodl.query.InvalidCollectorVersion()
+            if version in (None, ""):
+                for pc_filter in props.get("filter", []):
+                    self.objects[pc_filter._moId]["props"]["reported"] = {}
+            while True:
+                self.advance()
+                filter_updates = [x for x in [self._filter_update(f) for f in props.get("filter", [])] if x is not None]
+                if filter_updates:
+                    props["version"] = props.get("version", 0) + 1
+                    return vmodl.query.PropertyCollector.UpdateSet(version=str(props["version"]),
+                                                                   filterSet=filter_updates)
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.changed.wait(0.05 if remaining is None else min(0.05, remaining))
+
+    def _CheckForUpdates(self, mo, version=None):
+        return self._WaitForUpdatesEx(mo, version, vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0))
+
+    # ------------------------------------------------------------------
+    # tasks
+    # ------------------------------------------------------------------
+    def create_task(self, entity, description_id, duration=0.0, on_success=None, on_error=None, error=None, entity_name=None):
+        with self.lock:
+            task = self.add(vim.Task)
+            if not isinstance(entity, vim.ManagedEntity):
+                entity = None
+            info = vim.TaskInfo(key=task._moId, task=task, descriptionId=description_id,
+                                entity=entity, entityName=entity_name,
+                                state=vim.TaskInfo.State.running, progress=0,
+                                cancelable=False, cancelled=False,
+                                queueTime=datetime.datetime.utcnow(), eventChainId=next(self._ids))
+            self.set(task, "info", info)
+            self.tasks.append({"task": task, "start": time.time(), "duration": duration,
+                               "on_success": on_success, "error": error, "done": False})
+            recent = self.objects[self.task_manager._moId]["props"]["recentTask"]
+            recent.append(task)
+            return task
+
+    def task_progress(self, elapsed, duration):
+        if duration <= 0:
+            return 100
+        return int(min(100, 100.0 * elapsed / duration))
+
+    def after(self, seconds, func):
+        """Run func once seconds have passed, like a task finishing."""
+        with self.lock:
+            self.timers.append((time.time() + seconds, func))
+
+    def advance(self):
+        with self.lock:
+            now = time.time()
+            due = [x for x in self.timers if x[0] <= now]
+            if due:
+                self.timers = [x for x in self.timers if x[0] > now]
+                for at, func in sorted(due, key=lambda x: x[0]):
+                    func()
+            for entry in self.tasks:
+                if entry["done"]:
+                    continue
+                info = self.get(entry["task"], "info")
+                elapsed = now - entry["start"]
+                if elapsed >= entry["duration"]:
+                    entry["done"] = True
+                    if entry["error"] is None:
+                        result = entry["on_success"]() if entry["on_success"] is not None else None
+                        if isinstance(result, Exception):
+                            entry["error"] = result
+                        else:
+                            info.result = result
+                            info.state = vim.TaskInfo.State.success
+                    if entry["error"] is not None:
+                        info.error = entry["error"]
+                        info.state = vim.TaskInfo.State.error
+                    info.progress = 100
+                    self.set(entry["task"], "info", info)
+                else:
+                    progress = self.task_progress(elapsed, entry["duration"])
+                    if progress != info.progress:
+                        info.progress = progress
+                        self.set(entry["task"], "info", info)
+
+    def get_task_info(self, task):
+        self.advance()
+        return self.get(task, "info")
+
+    def _FindChild(self, mo, entity, name):
+        for child in self.children.get(entity._moId, []):
+            if self.get(child, "name") == name:
+                return child
+        return None
+
+    # ------------------------------------------------------------------
+    # provisioning
+    # ------------------------------------------------------------------
+    clone_seconds = 0.0
+
+    def _CreateFolder(self, mo, name):
+        for child in self.children.get(mo._moId, []):
+            if isinstance(child, vim.Folder) and self.get(child, "name") == name:
+                raise vim.fault.DuplicateName(name=name, object=child)
+        return self.add(vim.Folder, under=mo, name=name, parent=mo, childEntity=[])
+
+    def duplicate_name(self, name, folder):
+        """DuplicateName naming the VM that holds name, or the folder while it is still cloning."""
+        existing = self.find(vim.VirtualMachine, name)
+        return vim.fault.DuplicateName(name=name, object=existing[0] if existing else folder)
+
+    def create_vm(self, folder, name, template=False, datastore=None, pool=None):
+        if self.find(vim.VirtualMachine, name):
+            return self.duplicate_name(name, folder)
+        config = vim.vm.ConfigInfo(name=name, template=template, changeVersion=str(next(self._ids)),
+                                   hardware=vim.vm.VirtualHardware(device=[]))
+        vm = self.add(vim.VirtualMachine, under=folder, name=name, parent=folder, config=config,
+                      datastore=[datastore] if datastore is not None else [],
+                      resourcePool=pool,
+                      runtime=vim.vm.RuntimeInfo(powerState="poweredOff"),
+                      guest=vim.vm.GuestInfo(toolsRunningStatus="guestToolsNotRunning", net=[]),
+                      availableField=[], snapshot=None)
+        return vm
+
+    def _CloneVM_Task(self, mo, folder, name, spec):
+        datastore = spec.location.datastore if spec.location is not None else None
+        pool = spec.location.pool if spec.location is not None else None
+        if name in self.cloning or self.find(vim.VirtualMachine, name):
+            return self.create_task(mo, "VirtualMachine.clone", 0, error=self.duplicate_name(name, folder))
+        self.cloning.add(name)
+        self.clone_specs[name] = spec
+        self.clone_sources[name] = mo
+        chain = {}
+        task = self.create_task(mo, "VirtualMachine.clone", self.clone_seconds,
+                                on_success=lambda: self.finish_clone(mo, chain["id"], folder, name, spec.template, datastore, pool),
+                                entity_name=self.get(mo, "name"))
+        chain["id"] = self.get(task, "info").eventChainId
+        self.post_event(vim.event.VmBeingClonedEvent, chain["id"], mo, destName=name,
+                        destFolder=vim.event.FolderEventArgument(name=self.get(folder, "name"), folder=folder))
+        return task
+
+    def _MarkAsVirtualMachine(self, mo, pool, host=None):
+        config = self.get(mo, "config")
+        if not config.template:
+            raise vim.fault.NotSupported()
+        config.template = False
+        self.set(mo, "config", config)
+
+    def _MarkAsTemplate(self, mo):
+        config = self.get(mo, "config")
+        if config.template:
+            raise vim.fault.NotSupported()
+        config.template = True
+        self.set(mo, "config", config)
+
+    def _CreateSnapshot_Task(self, mo, name, description=None, memory=False, quiesce=False):
+        if self.get(mo, "config").template:
+            return self.create_task(mo, "VirtualMachine.createSnapshot", 0, error=vim.fault.NotSupported())
+
+        def finish():
+            snapshot = self.add(vim.vm.Snapshot, vm=mo)
+            tree = vim.vm.SnapshotTree(snapshot=snapshot, vm=mo, name=name, description=description or "",
+                                       id=next(self._ids), createTime=datetime.datetime.utcnow(),
+                                       state="poweredOff", quiesced=False, childSnapshotList=[])
+            info = self.get(mo, "snapshot")
+            if info is None:
+                info = vim.vm.SnapshotInfo(rootSnapshotList=[tree])
+            else:
+                info.rootSnapshotList.append(tree)
+            info.currentSnapshot = snapshot
+            self.set(mo, "snapshot", info)
+            return snapshot
+        return self.create_task(mo, "VirtualMachine.createSnapshot", self.snapshot_seconds, on_success=finish,
+                                entity_name=self.get(mo, "name"))
+
+    snapshot_seconds = 0.0
+
+    def _Destroy_Task(self, mo):
+        def finish():
+            parent = self.get(mo, "parent")
+            if parent is not None and self.has(parent, "childEntity"):
+                self.set(parent, "childEntity", [x for x in self.get(parent, "childEntity") if x != mo])
+            self.remove(mo)
+        return self.create_task(mo, "ManagedEntity.destroy", 0, on_success=finish)
+
+    def _Rename_Task(self, mo, newName):
+        def finish():
+            if self.find(vim.VirtualMachine, newName):
+                return self.duplicate_name(newName, self.get(mo, "parent"))
+            self.set(mo, "name", newName)
+            config = self.get(mo, "config")
+            if config is not None:
+                config.name = newName
+                self.set(mo, "config", config)
+        return self.create_task(mo, "ManagedEntity.rename", 0, on_success=finish)
+
+    def _InstantClone_Task(self, mo, spec):
+        if self.get(mo, "config").template or self.get(mo, "runtime").powerState != "poweredOn":
+            return self.create_task(mo, "VirtualMachine.instantClone", 0, error=vim.fault.InvalidState())
+        name = spec.name
+        if name in self.cloning or self.find(vim.VirtualMachine, name):
+            return self.create_task(mo, "VirtualMachine.instantClone", 0, error=self.duplicate_name(name, location.folder or self.get(mo, "parent")))
+        self.cloning.add(name)
+        self.clone_specs[name] = spec
+        location = spec.location
+
+        def finish():
+            self.cloning.discard(name)
+            folder = location.folder or self.get(mo, "parent")
+            vm = self.create_vm(folder, name, False, location.datastore, location.pool)
+            if not isinstance(vm, Exception):
+                self.set(vm, "runtime", vim.vm.RuntimeInfo(powerState="poweredOn"))
+            return vm
+        return self.create_task(mo, "VirtualMachine.instantClone", self.clone_seconds, on_success=finish,
+                                entity_name=self.get(mo, "name"))
+
+    def finish_clone(self, source, chain_id, folder, name, template, datastore, pool):
+        self.cloning.discard(name)
+        vm = self.create_vm(folder, name, template, datastore, pool)
+        spec = self.clone_specs.get(name)
+        if not isinstance(vm, Exception) and spec is not None and spec.config is not None and spec.config.extraConfig:
+            config = self.get(vm, "config")
+            config.extraConfig = list(spec.config.extraConfig)
+            self.set(vm, "config", config)
+        if isinstance(vm, Exception):
+            self.post_event(vim.event.VmCloneFailedEvent, chain_id, source, destName=name, reason=vm)
+        else:
+            self.post_event(vim.event.VmClonedEvent, chain_id, vm, sourceVm=vim.event.VmEventArgument(name=self.get(source, "name"), vm=source))
+            if spec is not None and spec.powerOn and not template:
+                self.set(vm, "runtime", vim.vm.RuntimeInfo(powerState="poweredOn"))
+                if spec.customization is not None:
+                    self.customize(vm, spec.customization)
+        return vm
+
+    # Seconds guest customization runs after the clone powers on, the
+    # failure event to post instead of CustomizationSucceeded by VM name,
+    # and the seconds until the customized guest reports its addresses.
+    customize_seconds = 0.0
+    customization_failures = {}
+    guest_ip_seconds = 0.0
+
+    def customize(self, vm, customization):
+        self.post_event(vim.event.CustomizationStartedEvent, None, vm)
+        failure = self.customization_failures.get(self.get(vm, "name"))
+        if failure is not None:
+            self.after(self.customize_seconds, lambda: self.post_event(failure, None, vm, logLocation="/var/log/vmware-imc/toolsDeployPkg.log"))
+            self.after(self.customize_seconds, lambda: self.report_guest(vm, []))
+            return
+        ips = [getattr(x.adapter.ip, "ipAddress", None) for x in customization.nicSettingMap or []]
+
+        def succeeded():
+            self.post_event(vim.event.CustomizationSucceeded, None, vm)
+            self.report_guest(vm, [])
+            self.after(self.guest_ip_seconds, lambda: self.report_guest(vm, ips))
+        self.after(self.customize_seconds, succeeded)
+
+    def report_guest(self, vm, ips):
+        """VMware Tools running in vm with one NIC per address (None for DHCP)."""
+        nics = [vim.vm.GuestInfo.NicInfo(connected=True, deviceConfigId=4000 + x, macAddress="00:50:56:00:00:%02x" % x,
+                                         ipAddress=[ip or "10.1.0.%d" % (x + 10), "fe80::250:56ff:fe00:%x" % x])
+                for x, ip in enumerate(ips)]
+        self.set(vm, "guest", vim.vm.GuestInfo(toolsRunningStatus="guestToolsRunning", net=nics,
+                                               ipAddress=nics[0].ipAddress[0] if nics else None))
+
+    # ------------------------------------------------------------------
+    # events
+    # ------------------------------------------------------------------
+    def post_event(self, event_type, chain_id, vm, **props):
+        key = next(self._ids)
+        # Clone events must name a destination host and folder.
+        prop_names = [x.name for x in event_type._GetPropertyList()]
+        if "destHost" in prop_names and "destHost" not in props and self.hosts:
+            props["destHost"] = vim.event.HostEventArgument(name=self.get(self.hosts[0], "name"), host=self.hosts[0])
+        if "destFolder" in prop_names and "destFolder" not in props:
+            folder = self.get(vm, "parent")
+            props["destFolder"] = vim.event.FolderEventArgument(name=self.get(folder, "name"), folder=folder)
+        event = event_type(key=key, chainId=chain_id if chain_id is not None else key,
+                           createdTime=datetime.datetime.utcnow(), userName="fake", template=False,
+                           vm=vim.event.VmEventArgument(name=self.get(vm, "name"), vm=vm),
+                           fullFormattedMessage=event_type.__name__.split(".")[-1], **props)
+        with self.lock:
+            self.events.append(event)
+            for moid, collector in self.event_collectors.items():
+                if self.match_event(event, collector["filter"]):
+                    self.set(collector["obj"], "latestPage", self._collected(moid)[-collector["page_size"]:])
+        self.set(self.event_manager, "latestEvent", event)
+        return event
+
+    def within(self, obj, container, recursion):
+        """Whether obj is below container for an event filter's recursion."""
+        if obj._moId == container._moId:
+            return recursion in ("self", "all")
+        parent = self.get(obj, "parent") if obj._moId in self.objects else None
+        depth = 1
+        while parent is not None:
+            if parent._moId == container._moId:
+                return recursion == "all" or (recursion == "children" and depth == 1)
+            parent = self.get(parent, "parent")
+            depth += 1
+        return False
+
+    def match_event(self, event, spec):
+        if spec is None:
+            return True
+        if spec.eventTypeId and event.__class__.__name__.split(".")[-1] not in spec.eventTypeId:
+            return False
+        if spec.type and not isinstance(event, tuple(spec.type)):
+            return False
+        if spec.eventChainId is not None and event.chainId != spec.eventChainId:
+            return False
+        if spec.entity is not None:
+            vm = event.vm.vm if event.vm is not None else None
+            if vm is None or not self.within(vm, spec.entity.entity, spec.entity.recursion or "all"):
+                return False
+        if spec.time is not None:
+            if spec.time.beginTime is not None and event.createdTime < spec.time.beginTime.replace(tzinfo=None):
+                return False
+            if spec.time.endTime is not None and event.createdTime > spec.time.endTime.replace(tzinfo=None):
+                return False
+        return True
+
+    def _QueryEvents(self, mo, filter):
+        self.advance()
+        with self.lock:
+            events = [x for x in self.events if self.match_event(x, filter)]
+        return list(reversed(events))[:1000]
+
+    def _collected(self, moid):
+        spec = self.event_collectors[moid]["filter"]
+        return [x for x in self.events if self.match_event(x, spec)]
+
+    def _CreateCollectorForEvents(self, mo, filter):
+        self.advance()
+        collector = self.add(vim.event.EventHistoryCollector, filter=filter, latestPage=[])
+        self.event_collectors[collector._moId] = {"obj": collector, "filter": filter, "page_size": 10}
+        events = self._collected(collector._moId)
+        # The scrollable view starts just before the latest page.
+        self.event_collectors[collector._moId]["position"] = max(0, len(events) - 10)
+        self.set(collector, "latestPage", events[-10:])
+        return collector
+
+    def _collector(self, mo):
+        collector = self.event_collectors.get(mo._moId)
+        if collector is None:
+            raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+        return collector
+
+    def _ReadNextEvents(self, mo, maxCount):
+        self.advance()
+        collector = self._collector(mo)
+        events = self._collected(mo._moId)[collector["position"]:collector["position"] + maxCount]
+        collector["position"] += len(events)
+        return events
+
+    def _ReadPreviousEvents(self, mo, maxCount):
+        self.advance()
+        collector = self._collector(mo)
+        start = max(0, collector["position"] - maxCount)
+        events = self._collected(mo._moId)[start:collector["position"]]
+        collector["position"] = start
+        return list(reversed(events))
+
+    def _RewindCollector(self, mo):
+        self._collector(mo)["position"] = 0
+
+    def _ResetCollector(self, mo):
+        collector = self._collector(mo)
+        collector["position"] = max(0, len(self._collected(mo._moId)) - collector["page_size"])
+
+    def _SetCollectorPageSize(self, mo, maxCount):
+        collector = self._collector(mo)
+        collector["page_size"] = maxCount
+        self.set(mo, "latestPage", self._collected(mo._moId)[-maxCount:])
+
+    def _DestroyCollector(self, mo):
+        self.event_collectors.pop(mo._moId, None)
+        self.remove(mo)
+
+    def perf_value(self, name, counter):
+        if (name, counter) in self.perf_values:
+            return self.perf_values[(name, counter)]
+        return sum(ord(x) for x in name + counter) % 50 + 1
+
+    def _QueryPerf(self, mo, querySpec):
+        self.advance()
+        counters = dict((x.key, "%s.%s.%s" % (x.groupInfo.key, x.nameInfo.key, x.rollupType)) for x in self.get(mo, "perfCounter"))
+        results = []
+        for spec in querySpec:
+            samples = spec.maxSample or 1
+            name = self.get(spec.entity, "name")
+            series = []
+            for metric in spec.metricId or []:
+                counter = counters.get(metric.counterId)
+                if counter is None:
+                    continue
+                if metric.instance == "*" and counter.startswith("datastore.") and isinstance(spec.entity, vim.HostSystem):
+                    # One instance per datastore the host's cluster mounts, named by its URL's UUID.
+                    instances = [(self.get(x, "summary").url.rstrip("/").split("/")[-1], self.get(x, "name"))
+                                 for x in self.get(self.get(spec.entity, "parent"), "datastore") or []]
+                else:
+                    instances = [(metric.instance or "", name)]
+                for instance, source in instances:
+                    value = ",".join([str(self.perf_value(source, counter))] * samples)
+                    series.append(vim.PerformanceManager.MetricSeriesCSV(
+                        id=vim.PerformanceManager.MetricId(counterId=metric.counterId, instance=instance), value=value))
+            results.append(vim.PerformanceManager.EntityMetricCSV(
+                entity=spec.entity, sampleInfoCSV=",".join(["20,2026-01-01T00:00:00Z"] * samples), value=series))
+        return results
+
+    def _RecommendDatastores(self, mo, storageSpec):
+        pod = storageSpec.podSelectionSpec.storagePod
+        members = [x for x in self.get(pod, "childEntity") or []]
+        members.sort(key=lambda x: -self.get(x, "summary.freeSpace"))
+        recommendations = []
+        for rank, datastore in enumerate(members):
+            key = "rec-%s" % next(self._ids)
+            relocate = vim.vm.RelocateSpec(datastore=datastore, disk=[
+                vim.vm.RelocateSpec.DiskLocator(diskId=x.diskId, datastore=datastore)
+                for config in storageSpec.podSelectionSpec.initialVmConfig or [] for x in config.disk or []])
+            action = vim.storageDrs.StoragePlacementAction(destination=datastore, relocateSpec=relocate)
+            recommendations.append(vim.cluster.Recommendation(key=key, rating=5 - min(rank, 4), action=[action]))
+            self._results[key] = (storageSpec, datastore)
+        return vim.storageDrs.StoragePlacementResult(recommendations=recommendations)
+
+    def _ApplyStorageDrsRecommendation_Task(self, mo, key):
+        applied = [self._results.pop(x) for x in key if x in self._results]
+        if not applied:
+            return self.create_task(mo, "StorageResourceManager.applyRecommendation", 0,
+                                    error=vmodl.fault.InvalidArgument(invalidProperty="key"))
+        for storage_spec, datastore in applied:
+            if storage_spec.cloneName in self.cloning or self.find(vim.VirtualMachine, storage_spec.cloneName):
+                return self.create_task(mo, "StorageResourceManager.applyRecommendation", 0,
+                                        error=self.duplicate_name(storage_spec.cloneName, storage_spec.folder))
+        for storage_spec, datastore in applied:
+            self.cloning.add(storage_spec.cloneName)
+            self.clone_specs[storage_spec.cloneName] = storage_spec.cloneSpec
+            self.clone_sources[storage_spec.cloneName] = storage_spec.vm
+
+        chain = {}
+
+        def apply_all():
+            vms = []
+            for storage_spec, datastore in applied:
+                vm = self.finish_clone(storage_spec.vm, chain["id"], storage_spec.folder, storage_spec.cloneName,
+                                       storage_spec.cloneSpec.template, datastore, storage_spec.resourcePool)
+                if isinstance(vm, Exception):
+                    return vm
+                vms.append(vm)
+            return vim.storageDrs.ApplyRecommendationResult(vm=vms[0])
+
+        task = self.create_task(mo, "StorageResourceManager.applyRecommendation", self.clone_seconds,
+                                on_success=apply_all)
+        chain["id"] = self.get(task, "info").eventChainId
+        for storage_spec, datastore in applied:
+            if storage_spec.vm is not None:
+                self.post_event(vim.event.VmBeingClonedEvent, chain["id"], storage_spec.vm, destName=storage_spec.cloneName,
+                                destFolder=vim.event.FolderEventArgument(name=self.get(storage_spec.folder, "name"), folder=storage_spec.folder))
+        return task
+
+
+PERF_COUNTERS = [(2, "cpu", "usage", "percent"),
+                 (24, "mem", "usage", "percent"),
+                 (178, "datastore", "totalReadLatency", "millisecond"),
+                 (179, "datastore", "totalWriteLatency", "millisecond")]
+
+
+def build_inventory(fake, vms=100, folders=10, folder_depth=3, networks=20, portgroups=20,
+                    datastores=10, pods=2, hosts=4):
+    """
+    Populate fake with one datacenter holding a cluster, a folder tree of
+    folders x folder_depth, vms spread over the deepest folders, standard
+    networks, distributed portgroups on one switch and datastores split
+    across storage pods. Returns a dict of the interesting objects.
+    """
+    root = fake.root_folder
+    dc = fake.add(vim.Datacenter, under=root, name="dc1", parent=root)
+    vm_folder = fake.add(vim.Folder, under=dc, name="vm", parent=dc, childEntity=[])
+    host_folder = fake.add(vim.Folder, under=dc, name="host", parent=dc, childEntity=[])
+    ds_folder = fake.add(vim.Folder, under=dc, name="datastore", parent=dc, childEntity=[])
+    net_folder = fake.add(vim.Folder, under=dc, name="network", parent=dc, childEntity=[])
+    fake.set(dc, "vmFolder", vm_folder)
+    fake.set(dc, "hostFolder", host_folder)
+    fake.set(dc, "datastoreFolder", ds_folder)
+    fake.set(dc, "networkFolder", net_folder)
+
+    cluster = fake.add(vim.ClusterComputeResource, under=host_folder, name="cluster1", parent=host_folder)
+    pool = fake.add(vim.ResourcePool, under=cluster, name="Resources", parent=cluster)
+    fake.set(cluster, "resourcePool", pool)
+    host_objs = [fake.add(vim.HostSystem, under=cluster, name="esx%03d" % x, parent=cluster) for x in range(hosts)]
+    fake.set(cluster, "host", host_objs)
+
+    pod_objs = [fake.add(vim.StoragePod, under=ds_folder, name="pod%02d" % x, parent=ds_folder, childEntity=[])
+                for x in range(pods)]
+    ds_objs = []
+    for x in range(datastores):
+        parent = pod_objs[x % len(pod_objs)] if pod_objs else ds_folder
+        summary = vim.Datastore.Summary(name="ds%03d" % x, capacity=10 * 1024 ** 4,
+                                        freeSpace=(10 - x % 7) * 1024 ** 4, uncommitted=0,
+                                        accessible=True, type="VMFS", url="ds:///vmfs/volumes/ds%03d/" % x)
+        mounts = [vim.Datastore.HostMount(key=host, mountInfo=vim.host.MountInfo(accessMode="readWrite", mounted=True, accessible=True))
+                  for host in host_objs]
+        ds = fake.add(vim.Datastore, under=parent, name="ds%03d" % x, parent=parent, summary=summary, host=mounts)
+        ds_objs.append(ds)
+
+    dvs = fake.add(vim.dvs.VmwareDistributedVirtualSwitch, under=net_folder, name="dvs1",
+                   parent=net_folder, uuid="50 01 02 03 04 05 06 07-08 09 0a 0b 0c 0d 0e 0f")
+    net_objs = []
+    for x in range(networks):
+        net_objs.append(fake.add(vim.Network, under=net_folder, name="net%04d" % x, parent=net_folder))
+    for x in range(portgroups):
+        net_objs.append(fake.add(vim.dvs.DistributedVirtualPortgroup, under=net_folder, name="pg%04d" % x,
+                                 parent=net_folder, key="dvportgroup-%s" % x,
+                                 config=vim.dvs.DistributedVirtualPortgroup.ConfigInfo(name="pg%04d" % x, distributedVirtualSwitch=dvs)))
+    fake.set(cluster, "network", net_objs)
+    fake.set(cluster, "datastore", ds_objs)
+
+    leaves = [vm_folder]
+    for depth in range(folder_depth):
+        next_level = []
+        for parent in leaves:
+            for x in range(folders if depth == 0 else 2):
+                folder = fake.add(vim.Folder, under=parent, name="f%d_%d" % (depth, x), parent=parent, childEntity=[])
+                next_level.append(folder)
+        leaves = next_level
+
+    template = fake.create_vm(vm_folder, "template01", template=True, datastore=ds_objs[0] if ds_objs else None, pool=pool)
+    cdrom = vim.vm.device.VirtualCdrom(key=3000, connectable=vim.vm.device.VirtualDevice.ConnectInfo(startConnected=True))
+    fake.get(template, "config").hardware.device = [cdrom]
+    for x in range(vms):
+        fake.create_vm(leaves[x % len(leaves)], "vm%06d" % x, datastore=ds_objs[x % len(ds_objs)] if ds_objs else None, pool=pool)
+
+    return {"datacenter": dc, "cluster": cluster, "pool": pool, "hosts": host_objs,
+            "datastores": ds_objs, "pods": pod_objs, "networks": net_objs, "dvs": dvs,
+            "template": template, "vm_folder": vm_folder, "leaves": leaves}
@@ -0,0 +1,863 @@
+#!/usr/bin/python
+"""
+Latency- and fault-injecting vCenter simulator.
+
+SimulatedVcenter extends the FakeVcenter in fake_vcenter.py with
+per-method latency, per-task durations, task progress curves and
+injected faults, so the concurrent paths of vsphere_clone_template
+(parallel clones, Storage DRS retries, DuplicateName handling, folder
+creation races) run under repeatable timing. It works in-process, where
+managed objects route straight into it, or behind SoapEndpoint, a local
+HTTP SOAP server that pyVmomi's SmartConnect and SoapStubAdapter talk to
+like any vCenter, connection pool and XML included.
+
+    sim = SimulatedVcenter(latency={"*": 0.005, "RecommendDatastores": (0.2, 0.5)},
+                           task_seconds={"VirtualMachine.clone": 3}, progress="stall", seed=1)
+    build_inventory(sim)
+    sim.inject("ApplyStorageDrsRecommendation_Task", vim.fault.InsufficientStorageSpace(), in_task=True)
+    sim.stale_recommendations = 2
+    si = SoapEndpoint(sim).start().connect()
+
+Faults are raised by the call itself, or with in_task=True delivered as
+the error of the task the call returns, after the task's duration. Every
+call lands in sim.timeline with its thread and offset in seconds.
+
+Running this file plays the built-in scenarios against deploy_template,
+_recommend_and_clone and VsphereHelpers.wait_task and exits non-zero
+when one of them does not end the way it should. --serve only serves a
+simulated inventory.
+
+Usage:
+    vcenter_simulator.py --transport http --scenario sdrs_stale --scenario duplicate_name
+    vcenter_simulator.py --serve 8989 --latency '*=0.01' --task-seconds VirtualMachine.clone=5
+"""
+
+import argparse
+import datetime
+import imp
+import json
+import math
+import os
+import random
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import BaseHTTPServer as httpserver
+    import SocketServer as socketserver
+except ImportError:
+    import http.server as httpserver
+    import socketserver
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_vcenter import FakeVcenter, build_inventory
+from pyVmomi import vim
+from pyVmomi import vmodl
+from pyVmomi import SoapAdapter
+from pyVmomi import VmomiSupport
+from pyVmomi.VmomiSupport import DataObject, ManagedObject, Object
+
+MODULE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vsphere_clone_template.py")
+
+# Fraction of a task's duration elapsed -> fraction of progress reported.
+PROGRESS_CURVES = {"linear": lambda x: x,
+                   "ease-in": lambda x: x * x,
+                   "ease-out": lambda x: math.sqrt(x),
+                   # Like a clone copying one big disk: quick start, then
+                   # stuck at 60% until it is done.
+                   "stall": lambda x: min(x, 0.6)}
+
+# descriptionId of the task each task method creates.
+TASK_DESCRIPTIONS = {"CloneVM_Task": "VirtualMachine.clone",
+                     "InstantClone_Task": "VirtualMachine.instantClone",
+                     "CreateSnapshot_Task": "VirtualMachine.createSnapshot",
+                     "ApplyStorageDrsRecommendation_Task": "StorageResourceManager.applyRecommendation",
+                     "Destroy_Task": "ManagedEntity.destroy",
+                     "Rename_Task": "ManagedEntity.rename"}
+
+
+class FaultRule(object):
+    """
+    Fault injected into calls of method. fault is a fault instance or a
+    function of (mo, args) returning one; when, a function of (mo, args),
+    narrows the calls it applies to. times=None never runs out.
+    """
+    def __init__(self, method, fault, times=1, when=None, in_task=False):
+        self.method = method
+        self.fault = fault
+        self.times = times
+        self.when = when
+        self.in_task = in_task
+        self.fired = 0
+
+    def matches(self, method, mo, args, in_task):
+        if method != self.method or in_task != self.in_task:
+            return False
+        if self.times is not None and self.fired >= self.times:
+            return False
+        return self.when is None or self.when(mo, args)
+
+    def make(self, mo, args):
+        self.fired += 1
+        if callable(self.fault) and not isinstance(self.fault, vmodl.MethodFault):
+            return self.fault(mo, args)
+        return self.fault
+
+
+class SimulatedVcenter(FakeVcenter):
+    def __init__(self, latency=None, task_seconds=None, progress="linear", seed=None):
+        """
+        Args:
+            latency (dict): Method name to seconds or a (low, high) range;
+                            "*" applies to every other method
+            task_seconds (dict): Task descriptionId to seconds or a range
+            progress (str|function): A PROGRESS_CURVES name or a function
+                                     of the elapsed fraction
+            seed (int): Seed for the ranges, so runs repeat
+        """
+        FakeVcenter.__init__(self)
+        self.latency = dict(latency or {})
+        self.task_seconds = dict(task_seconds or {})
+        self.progress = PROGRESS_CURVES.get(progress, progress)
+        self.random = random.Random(seed)
+        self.rules = []
+        self.stale_recommendations = 0
+        self.timeline = []
+        self.started = time.time()
+
+    def _seconds(self, value):
+        if isinstance(value, (tuple, list)):
+            with self.lock:
+                return self.random.uniform(value[0], value[1])
+        return value
+
+    def inject(self, method, fault, times=1, when=None, in_task=False):
+        rule = FaultRule(method, fault, times, when, in_task)
+        with self.lock:
+            self.rules.append(rule)
+        return rule
+
+    def _take_fault(self, method, mo, args, in_task):
+        with self.lock:
+            for rule in self.rules:
+                if rule.matches(method, mo, args, in_task):
+                    return rule.make(mo, args)
+        return None
+
+    def before_call(self, method, mo, args):
+        with self.lock:
+            self.timeline.append((round(time.time() - self.started, 4), threading.current_thread().name, method))
+        delay = self._seconds(self.latency.get(method, self.latency.get("*", 0)))
+        if delay:
+            time.sleep(delay)
+        fault = self._take_fault(method, mo, args, False)
+        if fault is not None:
+            raise fault
+
+    def InvokeMethod(self, mo, info, args):
+        fault = self._take_fault(info.wsdlName, mo, args, True)
+        if fault is None:
+            return FakeVcenter.InvokeMethod(self, mo, info, args)
+        with self.lock:
+            self.calls[info.wsdlName] += 1
+        self.before_call(info.wsdlName, mo, args)
+        return self.create_task(mo, TASK_DESCRIPTIONS.get(info.wsdlName, info.wsdlName), 0, error=fault)
+
+    def create_task(self, entity, description_id, duration=0.0, on_success=None, on_error=None, error=None, entity_name=None):
+        duration = self._seconds(self.task_seconds.get(description_id, duration))
+        return FakeVcenter.create_task(self, entity, description_id, duration, on_success, on_error, error, entity_name)
+
+    def task_progress(self, elapsed, duration):
+        if duration <= 0:
+            return 100
+        return int(100 * min(1.0, self.progress(min(1.0, float(elapsed) / duration))))
+
+    def _ApplyStorageDrsRecommendation_Task(self, mo, key):
+        if self.stale_recommendations > 0:
+            # Another placement used the space these keys were computed
+            # for, so vCenter has dropped them.
+            self.stale_recommendations -= 1
+            for rec_key in key:
+                self._results.pop(rec_key, None)
+        return FakeVcenter._ApplyStorageDrsRecommendation_Task(self, mo, key)
+
+    def competing_clone(self, source, name, folder=None):
+        """
+        Start a clone of source to name the way another client would: not
+        counted, no latency. It takes task_seconds["VirtualMachine.clone"].
+        """
+        with self.lock:
+            template = self.get(source, "config").template
+            spec = vim.vm.CloneSpec(location=vim.vm.RelocateSpec(), template=template, powerOn=False)
+            return self._CloneVM_Task(source, folder or self.get(source, "parent"), name, spec)
+
+
+def _request_type(info, cache={}):
+    """
+    DataObject type whose properties are the parameters of a method, so
+    SoapDeserializer can read a whole request body as one object.
+    """
+    request_type = cache.get(info.wsdlName)
+    if request_type is None:
+        props = [Object(name="_this", type=ManagedObject, version=info.version, flags=0)] + list(info.params)
+        request_type = type(str("%sRequestType" % info.wsdlName), (DataObject,),
+                            {"_wsdlName": "%sRequestType" % info.wsdlName,
+                             "_version": info.version,
+                             "_propList": props,
+                             "_propInfo": dict((x.name, x) for x in props)})
+        cache[info.wsdlName] = request_type
+    return request_type
+
+
+def _array_type(items):
+    if len(items) == 0 or isinstance(items[0], ManagedObject):
+        return ManagedObject.Array
+    item_type = type(items[0])
+    if item_type is type(u""):
+        item_type = str
+    for base in item_type.__mro__:
+        if len([x for x in items if not isinstance(x, base)]) == 0:
+            return VmomiSupport.GetVmodlType(VmomiSupport.GetVmodlName(base) + "[]")
+    return VmomiSupport.GetVmodlType("anyType[]")
+
+
+def _default(prop_type):
+    """Placeholder for a required property the fake left unset."""
+    if issubclass(prop_type, list):
+        return prop_type()
+    if issubclass(prop_type, DataObject):
+        return _typed(prop_type())
+    if issubclass(prop_type, VmomiSupport.Enum):
+        return prop_type.values[0] if getattr(prop_type, "values", None) else None
+    if prop_type is datetime.datetime:
+        return datetime.datetime(1970, 1, 1)
+    if prop_type in (bool, int, float) or prop_type is type(2 ** 64):
+        return prop_type(0)
+    if issubclass(prop_type, (str, type(u""))):
+        return ""
+    return None
+
+
+def _typed(val, declared=object):
+    """
+    Make val serializable. The fake keeps plain python lists, in anyType
+    slots especially, and leaves required properties nobody reads unset;
+    the serializer wants typed arrays and every required property.
+    """
+    if isinstance(val, list):
+        items = [_typed(x) for x in val]
+        if hasattr(val, "Item"):
+            return type(val)(items)
+        if declared is not object and issubclass(declared, list):
+            return declared(items)
+        return _array_type(items)(items)
+    if isinstance(val, DataObject):
+        for prop in val._GetPropertyList():
+            sub = getattr(val, prop.name, None)
+            if sub is None and not prop.flags & VmomiSupport.F_OPTIONAL:
+                object.__setattr__(val, prop.name, _default(prop.type))
+            elif isinstance(sub, (list, DataObject)):
+                object.__setattr__(val, prop.name, _typed(sub, prop.type))
+    return val
+
+
+class _RequestDeserializer(SoapAdapter.ExpatDeserializerNSHandlers):
+    def __init__(self, stub, version):
+        SoapAdapter.ExpatDeserializerNSHandlers.__init__(self)
+        self.deser = SoapAdapter.SoapDeserializer(stub, version)
+        self.body_tag = SoapAdapter.XMLNS_SOAPENV + SoapAdapter.NS_SEP + "Body"
+
+    def Deserialize(self, data, request_type):
+        self.request_type = request_type
+        self.nsMap = {}
+        self.parser = SoapAdapter.ParserCreate(namespace_separator=SoapAdapter.NS_SEP)
+        self.parser.buffer_text = True
+        SoapAdapter.SetHandlers(self.parser, SoapAdapter.GetHandlers(self))
+        SoapAdapter.ParseData(self.parser, data)
+        return self.deser.GetResult()
+
+    def StartElementHandler(self, tag, attr):
+        if tag == self.body_tag:
+            self.deser.Deserialize(self.parser, self.request_type, False, self.nsMap)
+
+    def EndElementHandler(self, tag):
+        pass
+
+    def CharacterDataHandler(self, data):
+        pass
+
+
+class _SoapRequestHandler(httpserver.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # One send per response; header lines written one by one sit out the
+    # client's delayed ACK.
+    wbufsize = -1
+
+    def setup(self):
+        httpserver.BaseHTTPRequestHandler.setup(self)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    METHOD = re.compile(br"<(?:\w+:)?Body>\s*<(\w+)")
+
+    def do_GET(self):
+        if not self.path.endswith("/vimServiceVersions.xml"):
+            self._reply(404, "")
+            return
+        versions = [VmomiSupport.versionIdMap[x] for x in VmomiSupport.GetServiceVersions("vim25")
+                    if x != "vim.version.legacy"]
+        body = ('<namespaces version="1.0"><namespace><name>urn:vim25</name><version>%s</version><priorVersions>%s'
+                '</priorVersions></namespace></namespaces>') % (versions[0], "".join("<version>%s</version>" % x for x in versions[1:]))
+        self._reply(200, body)
+
+    def do_POST(self):
+        fake = self.server.fake
+        data = self.rfile.read(int(self.headers.get("content-length")))
+        action = (self.headers.get("soapaction") or "").strip('"')
+        version = VmomiSupport.versionMap.get(action[len("urn:"):], self.server.version)
+        name = self.METHOD.search(data).group(1).decode("ascii")
+        info = VmomiSupport.GuessWsdlMethod(name).info
+        ns_map = SoapAdapter.SOAP_NSMAP.copy()
+        ns_map[VmomiSupport.GetWsdlNamespace(version)] = ""
+        cookie = None
+        try:
+            request = _RequestDeserializer(fake, version).Deserialize(data, _request_type(info))
+            result = fake.InvokeMethod(request._this, info, [getattr(request, x.name) for x in info.params])
+            body = ['<%sResponse xmlns="%s">' % (name, VmomiSupport.GetWsdlNamespace(version))]
+            if result is not None:
+                body.append(SoapAdapter.SerializeToUnicode(_typed(result, info.result),
+                                                           Object(name="returnval", type=info.result, version=version,
+                                                                  flags=info.resultFlags),
+                                                           version, ns_map))
+            body.append('</%sResponse>' % name)
+            status = 200
+            if name == "Login":
+                cookie = 'vmware_soap_session="%s"; Path=/; HttpOnly' % result.key
+        except Exception as err:
+            if not isinstance(err, vmodl.MethodFault):
+                traceback.print_exc()
+                err = vmodl.fault.SystemError(msg=str(err), reason=str(err))
+            fault = _typed(err)
+            # SerializeToUnicode would wrap the fault in a LocalizedMethodFault;
+            # vCenter sends <DuplicateNameFault xsi:type="DuplicateName">.
+            detail = StringIO()
+            serializer = SoapAdapter.SoapSerializer(detail, version, ns_map)
+            serializer._SerializeDataObject(fault, Object(name="%sFault" % fault._wsdlName, type=type(fault),
+                                                          version=version, flags=0),
+                                            ' xmlns="%s" xsi:type="%s"' % (VmomiSupport.GetWsdlNamespace(version), fault._wsdlName),
+                                            serializer.defaultNS)
+            body = ['<soapenv:Fault><faultcode>ServerFaultCode</faultcode><faultstring>%s</faultstring><detail>'
+                    % SoapAdapter.XmlEscape(fault.msg or ""), detail.getvalue(), '</detail></soapenv:Fault>']
+            status = 500
+        self._reply(status, "".join([SoapAdapter.XML_HEADER, "\n", SoapAdapter.SOAP_ENVELOPE_START,
+                                     SoapAdapter.SOAP_BODY_START] + body +
+                                    [SoapAdapter.SOAP_BODY_END, SoapAdapter.SOAP_ENVELOPE_END]), cookie)
+
+    def _reply(self, status, body, cookie=None):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if cookie is not None:
+            self.send_header("Set-Cookie", cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _SoapServer(socketserver.ThreadingMixIn, httpserver.HTTPServer):
+    daemon_threads = True
+
+
+class SoapEndpoint(object):
+    """
+    Serves a FakeVcenter over plain HTTP SOAP on /sdk, version discovery
+    included, so SmartConnect(protocol="http", host=host, port=port)
+    works from other machines. On loopback SmartConnect hands plain HTTP
+    an SSL context and fails; connect() logs in on a SoapStubAdapter of
+    its own instead.
+    """
+    def __init__(self, fake, host="127.0.0.1", port=0, version="vim.version.version10"):
+        self.server = _SoapServer((host, port), _SoapRequestHandler)
+        self.server.fake = fake
+        self.server.version = version
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def connect(self, user="administrator@vsphere.local", password="secret"):
+        # A negative port is plain HTTP to SoapStubAdapter.
+        stub = SoapAdapter.SoapStubAdapter(host=self.host, port=-self.port, version=self.server.version)
+        si = vim.ServiceInstance("ServiceInstance", stub)
+        si.content.sessionManager.Login(user, password)
+        return si
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Scenario(object):
+    """One simulated vCenter, connected in-process or over HTTP."""
+    NIC = {"nic1": {"name": "pg0001", "position": 0, "ip": "10.0.0.5", "netmask": "255.255.255.0",
+                    "gateway": "10.0.0.1", "dns": ["10.0.0.2"]}}
+    SDRS_DISK = {"os_disk": {"datastore_cluster": "pod00"}}
+
+    def __init__(self, module, args, **settings):
+        latency = dict(args.latency)
+        latency.update(settings.pop("latency", {}))
+        task_seconds = dict(args.task_seconds)
+        task_seconds.update(settings.pop("task_seconds", {}))
+        self.module = module
+        self.sim = SimulatedVcenter(latency, task_seconds, settings.pop("progress", args.progress), args.seed)
+        self.inventory = build_inventory(self.sim, vms=args.vms)
+        self.endpoint = None
+        if args.transport == "http":
+            self.endpoint = SoapEndpoint(self.sim).start()
+            self.si = self.endpoint.connect()
+        else:
+            self.si = self.sim.service_instance
+        self.content = self.si.RetrieveContent()
+
+    def local(self, obj):
+        """obj as seen through this scenario's connection."""
+        return type(obj)(obj._moId, self.si._stub)
+
+    def deploy(self, guest, vm_disk=None, is_template=False, **kwargs):
+        return self.module.deploy_template(self.si, self.content, guest, "template01", "cluster1", "sim.local", 2, 1024,
+                                           "linux", vm_disk or self.SDRS_DISK, {} if is_template else self.NIC,
+                                           is_template=is_template, folder_structure=kwargs.pop("folder_structure", ["f0_1", "f1_0"]),
+                                           **kwargs)
+
+    def run_threads(self, count, func):
+        """Run func(index) on count threads started together; returns results and errors."""
+        results = [None] * count
+        errors = [None] * count
+        barrier = threading.Event()
+
+        def run(index):
+            barrier.wait()
+            try:
+                results[index] = func(index)
+            except Exception as err:
+                errors[index] = err
+
+        threads = [threading.Thread(target=run, args=(x,), name="client-%d" % x) for x in range(count)]
+        for thread in threads:
+            thread.start()
+        barrier.set()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def vms(self, name):
+        return self.sim.find(vim.VirtualMachine, name)
+
+    def close(self):
+        self.module.VsphereHelpers.destroy_views()
+        if self.endpoint is not None:
+            self.si._stub.DropConnections()
+            self.endpoint.stop()
+
+
+def scenario_parallel_clones(scenario):
+    """Eight deploys through Storage DRS at once overlap their clone tasks."""
+    results, errors = scenario.run_threads(8, lambda x: scenario.deploy("par-%02d" % x))
+    elapsed = time.time() - scenario.started
+    return {"ok": errors.count(None) == 8 and all(len(scenario.vms("par-%02d" % x)) == 1 for x in range(8))
+            and elapsed < 8 * 1.0,
+            "errors": [str(x) for x in errors if x is not None]}
+scenario_parallel_clones.settings = {"task_seconds": {"StorageResourceManager.applyRecommendation": 1.0}}
+
+
+def scenario_duplicate_name(scenario):
+    """Two deploys of one VM: one clones, the other fails at once on DuplicateName."""
+    results, errors = scenario.run_threads(2, lambda x: scenario.deploy("dup-01", sdrs_retry={"backoff_base": 0.1}))
+    failed = [x for x in errors if x is not None]
+    attempts = [x.attempts for x in failed if hasattr(x, "attempts")]
+    return {"ok": len(failed) == 1 and "DuplicateName" in str(failed[0]) and len(scenario.vms("dup-01")) == 1
+            and attempts == [[{"attempt": 1, "cause": "DuplicateName", "result": "fatal"}]],
+            "errors": [str(x) for x in failed],
+            "attempts": attempts}
+scenario_duplicate_name.settings = {"task_seconds": {"StorageResourceManager.applyRecommendation": 0.5}}
+
+
+def scenario_competing_template_clone(scenario):
+    """A template clone already running elsewhere is waited for, not retried."""
+    template = scenario.inventory["template"]
+    scenario.sim.competing_clone(template, "tmpl-copy")
+    result = scenario.deploy("tmpl-copy", is_template=True)
+    elapsed = time.time() - scenario.started
+    return {"ok": [x["result"] for x in result["sdrs_attempts"]] == ["duplicate"] and elapsed >= 1.0
+            and len(scenario.vms("tmpl-copy")) == 1,
+            "attempts": result["sdrs_attempts"]}
+scenario_competing_template_clone.settings = {"task_seconds": {"VirtualMachine.clone": 1.5}}
+
+
+def scenario_stale_clone_event(scenario):
+    """A newer failed clone of the same name does not hide the clone still running."""
+    template = scenario.inventory["template"]
+    scenario.sim.competing_clone(template, "tmpl-stale")
+    chain_id = next(scenario.sim._ids)
+    scenario.sim.post_event(vim.event.VmBeingClonedEvent, chain_id, template, destName="tmpl-stale")
+    scenario.sim.post_event(vim.event.VmCloneFailedEvent, chain_id, template, destName="tmpl-stale",
+                            reason=vim.fault.NoDiskSpace(msg="ds000 is full", datastore="ds000"))
+    result = scenario.deploy("tmpl-stale", is_template=True)
+    return {"ok": [x["result"] for x in result["sdrs_attempts"]] == ["duplicate"]
+            and len(scenario.vms("tmpl-stale")) == 1,
+            "attempts": result["sdrs_attempts"]}
+scenario_stale_clone_event.settings = {"task_seconds": {"VirtualMachine.clone": 1.0}}
+
+
+def scenario_sdrs_stale(scenario):
+    """Recommendations that went stale are asked for again without backing off."""
+    scenario.sim.stale_recommendations = 2
+    result = scenario.deploy("stale-01")
+    attempts = result["sdrs_attempts"]
+    return {"ok": [x["result"] for x in attempts] == ["stale", "stale", "cloned"]
+            and [x.get("delay") for x in attempts] == [0, 0, None]
+            and scenario.sim.calls["RecommendDatastores"] == 3,
+            "attempts": attempts}
+
+
+def scenario_sdrs_space(scenario):
+    """A clone failing for space backs off and gets a fresh recommendation."""
+    scenario.sim.inject("ApplyStorageDrsRecommendation_Task",
+                        vim.fault.InsufficientStorageSpace(msg="pod00 is full"), in_task=True)
+    result = scenario.deploy("space-01", sdrs_retry={"backoff_base": 0.2, "backoff_max": 0.2})
+    attempts = result["sdrs_attempts"]
+    return {"ok": [x["result"] for x in attempts] == ["retryable", "cloned"] and attempts[0]["delay"] > 0,
+            "attempts": attempts}
+scenario_sdrs_space.settings = {"task_seconds": {"StorageResourceManager.applyRecommendation": 0.2}}
+
+
+def scenario_sdrs_exhausted(scenario):
+    """A clone that keeps failing gives up after max_attempts."""
+    scenario.sim.inject("ApplyStorageDrsRecommendation_Task", vim.fault.NoDiskSpace(msg="ds000 is full", datastore="ds000"),
+                        times=None, in_task=True)
+    try:
+        scenario.deploy("full-01", sdrs_retry={"max_attempts": 3, "backoff_base": 0.05, "backoff_max": 0.1})
+    except scenario.module.CloneRetryError as err:
+        return {"ok": [x["result"] for x in err.attempts] == ["retryable"] * 3 and len(scenario.vms("full-01")) == 0,
+                "attempts": err.attempts}
+    return {"ok": False, "errors": ["full-01 was cloned"]}
+
+
+def scenario_sdrs_bad_spec(scenario):
+    """An InvalidArgument that is not about the recommendation fails on the first attempt."""
+    scenario.sim.inject("ApplyStorageDrsRecommendation_Task",
+                        vmodl.fault.InvalidArgument(invalidProperty="spec.location.disk[0].diskId"),
+                        times=None, in_task=True)
+    try:
+        scenario.deploy("bad-01", sdrs_retry={"max_attempts": 3})
+    except scenario.module.CloneRetryError as err:
+        return {"ok": [x["result"] for x in err.attempts] == ["fatal"]
+                and scenario.sim.calls["RecommendDatastores"] == 1,
+                "attempts": err.attempts}
+    return {"ok": False, "errors": ["bad-01 was cloned"]}
+
+
+def scenario_linked_snapshot_denied(scenario):
+    """A snapshot this run may not create fails at once instead of waiting for another run's."""
+    template = scenario.inventory["template"]
+    scenario.sim.inject("CreateSnapshot_Task", vim.fault.NoPermission(object=template, privilegeId="VirtualMachine.State.CreateSnapshot"),
+                        in_task=True)
+    start = time.time()
+    try:
+        scenario.deploy("denied-01", vm_disk={"os_disk": {"datastore": "ds001"}}, clone_mode="linked")
+    except Exception as err:
+        return {"ok": "NoPermission" in str(err) and time.time() - start < 2
+                and scenario.sim.get(template, "config").template and len(scenario.vms("denied-01")) == 0,
+                "errors": [str(err)]}
+    return {"ok": False, "errors": ["denied-01 was cloned"]}
+
+
+def scenario_sdrs_staggered(scenario):
+    """Storage DRS guests arriving one after another each start their clone without waiting for the earlier batches."""
+    targets = scenario.module.resolve_deploy_targets(scenario.si, scenario.content, "template01", "cluster1", ["f0_1", "f1_0"])
+    targets["placement_planner"] = scenario.module.StoragePlacementPlanner(scenario.si, scenario.content)
+    start = time.time()
+
+    def deploy(index):
+        time.sleep(0.5 * index)
+        scenario.deploy("stagger-%02d" % index, targets=targets)
+        return time.time() - start
+
+    results, errors = scenario.run_threads(3, deploy)
+    return {"ok": errors.count(None) == 3 and max(results) < 3.5,
+            "seconds": [round(x, 3) for x in results if x is not None],
+            "errors": [str(x) for x in errors if x is not None]}
+scenario_sdrs_staggered.settings = {"task_seconds": {"StorageResourceManager.applyRecommendation": 2.0}}
+
+
+def scenario_recommend_and_clone(scenario):
+    """_recommend_and_clone alone, with RecommendDatastores slow and the apply task stalling."""
+    template = scenario.local(scenario.inventory["template"])
+    folder = scenario.local(scenario.inventory["leaves"][0])
+    pool = scenario.local(scenario.inventory["pool"])
+    helpers = scenario.module.VsphereHelpers
+    pod_select = vim.storageDrs.PodSelectionSpec(storagePod=scenario.local(scenario.inventory["pods"][0]))
+    clone_spec = vim.vm.CloneSpec(location=vim.vm.RelocateSpec(pool=pool), template=False, powerOn=False)
+    spec = helpers.create_storage_placement_spec("rac-01", folder, pod_select, template, clone_spec, pool)
+    start = time.time()
+    scenario.module._recommend_and_clone(scenario.content, spec, {}, [], True)
+    elapsed = time.time() - start
+    return {"ok": len(scenario.vms("rac-01")) == 1 and elapsed >= 1.3, "seconds": round(elapsed, 3)}
+scenario_recommend_and_clone.settings = {"latency": {"RecommendDatastores": 0.3},
+                                         "task_seconds": {"StorageResourceManager.applyRecommendation": 1.0},
+                                         "progress": "stall"}
+
+
+def scenario_wait_task(scenario):
+    """wait_task returns when a stalled task ends and raises its fault when it fails."""
+    helpers = scenario.module.VsphereHelpers
+    entity = scenario.inventory["template"]
+    start = time.time()
+    helpers.wait_task(scenario.local(scenario.sim.create_task(entity, "sim.stall", 1.5)), "stalled task", True)
+    waited = time.time() - start
+    failed = scenario.local(scenario.sim.create_task(entity, "sim.fail", 0.3, error=vim.fault.NoDiskSpace(datastore="ds000")))
+    try:
+        helpers.wait_task(failed, "failing task", True)
+        fault = None
+    except Exception as err:
+        fault = scenario.module._get_fault(err)
+    return {"ok": waited >= 1.5 and isinstance(fault, vim.fault.NoDiskSpace),
+            "seconds": round(waited, 3), "fault": type(fault).__name__}
+scenario_wait_task.settings = {"progress": "stall"}
+
+
+def scenario_folder_race(scenario):
+    """Two deploys into a folder neither finds both try to create it; both must land in it."""
+    results, errors = scenario.run_threads(2, lambda x: scenario.deploy("race-%02d" % x, folder_structure=["f0_1", "new"]))
+    folders = [x for x in scenario.sim.find(vim.Folder, "new")]
+    placed = [scenario.sim.get(vm, "parent") for x in range(2) for vm in scenario.vms("race-%02d" % x)]
+    return {"ok": errors.count(None) == 2 and len(folders) == 1 and placed == folders * 2,
+            "errors": [str(x) for x in errors if x is not None]}
+scenario_folder_race.settings = {"latency": {"CreateFolder": 0.3}}
+
+
+def scenario_async_clone(scenario):
+    """Deploys with wait=False return their task at once; get_task_states follows them to the VMs."""
+    helpers = scenario.module.VsphereHelpers
+    start = time.time()
+    results, errors = scenario.run_threads(3, lambda x: scenario.deploy("async-%02d" % x, wait=False))
+    direct = scenario.deploy("async-ds", vm_disk={"os_disk": {"datastore": "ds000"}}, wait=False)
+    submitted = time.time() - start
+    task_ids = [x["task"] for x in results if x is not None] + [direct["task"]]
+    running = helpers.get_task_states(scenario.content, task_ids + ["task-missing"])
+    for finished in helpers.wait_tasks([scenario.local(vim.Task(x, None)) for x in task_ids]):
+        pass
+    done = helpers.get_task_states(scenario.content, task_ids)
+    return {"ok": errors.count(None) == 3 and submitted < 1.0
+            and [x["state"] for x in running] == ["running"] * 4 + ["unknown"]
+            and [x["state"] for x in done] == ["success"] * 4
+            and sorted(x["vm"] for x in done) == ["async-00", "async-01", "async-02", "async-ds"],
+            "submit_seconds": round(submitted, 3), "tasks": done}
+scenario_async_clone.settings = {"task_seconds": {"StorageResourceManager.applyRecommendation": 1.0,
+                                                  "VirtualMachine.clone": 1.0}}
+
+
+def scenario_async_reservations(scenario):
+    """A submitted clone keeps its local placement reservation, so the next run sharing the file places elsewhere."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "reservations.json")
+    vm_disk = {"os_disk": {"datastore_cluster": "pod00"},
+               "data": {"datastore_cluster": "pod00", "size_gb": 2500, "type": "thin", "mount_point": "/data", "fs_type": "xfs"}}
+    try:
+        for guest in ["resv-00", "resv-01"]:
+            # One LocalPlacement per guest stands in for separate module runs.
+            placement = scenario.module.LocalPlacement(scenario.content, reservation_file=path)
+            scenario.deploy(guest, vm_disk=vm_disk, wait=False, local_placement=placement)
+        with open(path) as handle:
+            reservations = json.load(handle)
+    finally:
+        shutil.rmtree(directory)
+    datastores = dict((x["guest"], x["datastore"]) for x in reservations if x["bytes"] > 0)
+    return {"ok": sorted(datastores) == ["resv-00", "resv-01"] and datastores["resv-00"] != datastores["resv-01"],
+            "reservations": reservations}
+
+
+def scenario_customization_wait(scenario):
+    """One event collector follows the customization of a batch, a failure and a guest that never shows up."""
+    scenario.sim.customize_seconds = 1.0
+    scenario.sim.customization_failures = {"cust-02": vim.event.CustomizationLinuxIdentityFailed}
+    since = scenario.si.CurrentTime()
+    results, errors = scenario.run_threads(3, lambda x: scenario.deploy("cust-%02d" % x))
+    scenario.sim.reset_calls()
+    customized = scenario.module.wait_for_customization(scenario.content, ["cust-00", "cust-01", "cust-02", "cust-none"],
+                                                        since, timeout=3)
+    calls = dict(scenario.sim.calls)
+    return {"ok": errors.count(None) == 3
+            and [customized[x]["state"] for x in sorted(customized)] == ["succeeded", "succeeded", "failed", "timeout"]
+            and calls.get("CreateCollectorForEvents") == 1 and calls.get("ReadNextEvents", 0) <= 8,
+            "customization": customized, "calls": calls}
+scenario_customization_wait.settings = {"task_seconds": {"StorageResourceManager.applyRecommendation": 0.5}}
+
+
+def scenario_guest_ip(scenario):
+    """One filter follows the guest addresses of a batch by MoRef, without a name scan; a guest whose customization failed never gets its IP."""
+    scenario.sim.customize_seconds = 0.5
+    scenario.sim.guest_ip_seconds = 0.5
+    scenario.sim.customization_failures = {"ip-02": vim.event.CustomizationNetworkSetupFailed}
+    start = time.time()
+    results, errors = scenario.run_threads(3, lambda x: scenario.deploy("ip-%02d" % x))
+    expected = dict(("ip-%02d" % x, scenario.module.expected_guest_ips(scenario.NIC)) for x in range(3))
+    expected["ip-dhcp"] = {"ips": [], "nics": 1}
+    vm_ids = dict(("ip-%02d" % x, results[x]["moid"]) for x in range(3) if results[x] is not None)
+    scenario.sim.reset_calls()
+    addresses = scenario.module.wait_for_guest_ips(scenario.content, expected, vm_ids, timeout=3, since=start)
+    calls = dict(scenario.sim.calls)
+    ready = [addresses["ip-%02d" % x] for x in range(2)]
+    return {"ok": errors.count(None) == 3
+            and [x["state"] for x in ready] == ["ready", "ready"]
+            and all(x["ips"] == ["10.0.0.5"] and x["tools"] == "guestToolsRunning" for x in ready)
+            and addresses["ip-02"]["state"] == "timeout" and addresses["ip-dhcp"]["state"] == "missing"
+            and calls.get("WaitForUpdatesEx", 0) <= 8 and "RetrievePropertiesEx" not in calls,
+            "addresses": addresses, "calls": calls}
+scenario_guest_ip.settings = {"task_seconds": {"StorageResourceManager.applyRecommendation": 0.5}}
+
+
+def scenario_perf_placement(scenario):
+    """One QueryPerf loads a batch's hosts and datastores; clones skip a slow datastore and go to the hosts mounting it with the lowest projected load."""
+    for host, cpu in [("esx000", 8000), ("esx001", 6000), ("esx002", 1000), ("esx003", 4000)]:
+        scenario.sim.perf_values[(host, "cpu.usage.average")] = cpu
+    # ds006 is the tightest fit in pod00, ds004 the next one.
+    for datastore, latency in [("ds006", 40), ("ds004", 1)]:
+        scenario.sim.perf_values[(datastore, "datastore.totalReadLatency.average")] = latency
+        scenario.sim.perf_values[(datastore, "datastore.totalWriteLatency.average")] = latency
+    # esx002, the idlest host, lost its mount of ds004.
+    datastore = scenario.local(scenario.inventory["datastores"][4])
+    scenario.sim.set(datastore, "host", [x for x in scenario.sim.get(datastore, "host") if scenario.sim.get(x.key, "name") != "esx002"])
+    targets = scenario.module.resolve_deploy_targets(scenario.si, scenario.content, "template01", "cluster1",
+                                                     ["f0_1", "f1_0"], placement_metrics=True)
+    first = dict(scenario.sim.calls)
+    scenario.sim.reset_calls()
+    stats = scenario.module.PerfMetrics(scenario.content).cluster_load(scenario.local(scenario.inventory["cluster"]))
+    again = dict(scenario.sim.calls)
+    placement = scenario.module.LocalPlacement(scenario.content)
+    results, errors = scenario.run_threads(3, lambda x: scenario.deploy("perf-%02d" % x, targets=targets,
+                                                                        local_placement=placement))
+    specs = [scenario.sim.clone_specs.get("perf-%02d" % x) for x in range(3)]
+    hosts = sorted(scenario.sim.get(x.location.host, "name") for x in specs if x is not None)
+    datastores = set(scenario.sim.get(x.location.datastore, "name") for x in specs if x is not None)
+    latency = dict((x["name"], x["load"]) for x in stats["datastores"])
+    mounted = dict((x["name"], len(x["hosts"])) for x in stats["datastores"])
+    return {"ok": errors.count(None) == 3 and first.get("QueryPerf") == 1 and again.get("QueryPerf") == 1
+            and mounted["ds004"] == 3 and mounted["ds006"] == 4
+            and hosts == ["esx001", "esx003", "esx003"] and datastores == set(["ds004"])
+            and latency["ds006"] == 80 and stats["hosts"][2]["load"] == 10,
+            "errors": [str(x) for x in errors if x is not None], "hosts": hosts, "datastores": sorted(datastores),
+            "first": first, "again": again}
+
+
+SCENARIOS = [scenario_parallel_clones, scenario_duplicate_name, scenario_competing_template_clone,
+             scenario_stale_clone_event,
+             scenario_sdrs_stale, scenario_sdrs_space, scenario_sdrs_exhausted, scenario_sdrs_bad_spec,
+             scenario_sdrs_staggered,
+             scenario_linked_snapshot_denied,
+             scenario_recommend_and_clone, scenario_wait_task, scenario_folder_race,
+             scenario_async_clone, scenario_async_reservations, scenario_customization_wait, scenario_guest_ip,
+             scenario_perf_placement]
+
+
+def _settings(values, parse=float):
+    """["Method=0.1", "*=0.01-0.05"] -> {"Method": 0.1, "*": (0.01, 0.05)}"""
+    settings = {}
+    for value in values or []:
+        for item in value.split(","):
+            key, seconds = item.split("=", 1)
+            if "-" in seconds:
+                low, high = seconds.split("-", 1)
+                settings[key] = (parse(low), parse(high))
+            else:
+                settings[key] = parse(seconds)
+    return settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run deploy scenarios against a simulated vCenter, or serve one.")
+    names = [x.__name__[len("scenario_"):] for x in SCENARIOS]
+    parser.add_argument("--scenario", action="append", choices=names,
+                        help="Scenario to run; may be repeated, default all")
+    parser.add_argument("--transport", choices=["inproc", "http"], default="inproc")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="Serve a simulated inventory on this port instead")
+    parser.add_argument("--vms", type=int, default=50)
+    parser.add_argument("--latency", action="append",
+                        help="METHOD=SECONDS or METHOD=LOW-HIGH, comma separated; * for every method")
+    parser.add_argument("--task-seconds", action="append",
+                        help="DESCRIPTION_ID=SECONDS or DESCRIPTION_ID=LOW-HIGH, comma separated")
+    parser.add_argument("--progress", choices=sorted(PROGRESS_CURVES), default="linear")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--module", default=MODULE,
+                        help="vsphere_clone_template.py to run the scenarios against")
+    args = parser.parse_args()
+    args.latency = _settings(args.latency)
+    args.task_seconds = _settings(args.task_seconds)
+
+    if args.serve is not None:
+        sim = SimulatedVcenter(args.latency, args.task_seconds, args.progress, args.seed)
+        build_inventory(sim, vms=args.vms)
+        endpoint = SoapEndpoint(sim, port=args.serve)
+        print("Simulated vCenter on http://%s:%s/sdk" % (endpoint.host, endpoint.port))
+        try:
+            endpoint.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    module = imp.load_source("vsphere_clone_template", args.module)
+    results = []
+    for func in SCENARIOS:
+        name = func.__name__[len("scenario_"):]
+        if args.scenario and name not in args.scenario:
+            continue
+        scenario = Scenario(module, args, **dict(getattr(func, "settings", {})))
+        scenario.sim.reset_calls()
+        scenario.started = time.time()
+        # wait_task prints every failed task; keep that for failed scenarios.
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            result = func(scenario)
+        except Exception as err:
+            result = {"ok": False, "errors": ["%s: %s" % (type(err).__name__, err)]}
+        finally:
+            output, sys.stdout = sys.stdout.getvalue(), stdout
+            elapsed = time.time() - scenario.started
+            scenario.close()
+        if not result["ok"] and output:
+            result["output"] = output
+        result["scenario"] = name
+        result["elapsed"] = round(elapsed, 3)
+        result["calls"] = dict(scenario.sim.calls)
+        results.append(result)
+        print("%-4s %-26s %6.2fs  %s" % ("ok" if result["ok"] else "FAIL", name, result["elapsed"],
+                                         "" if result["ok"] else "; ".join(result.get("errors", []))))
+        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump({"transport": args.transport, "results": results}, out, indent=2, default=str)
+    sys.exit(0 if all(x["ok"] for x in results) else 1)
+
+
+if __name__ == '__main__':
+    main()
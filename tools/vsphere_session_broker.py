@@ -0,0 +1,376 @@
+#!/usr/bin/python
+"""
+Long-lived vCenter session broker for the modules in this repository.
+
+Every Ansible fork normally logs in to vCenter on its own, so 50 forks
+means 50 SSO logins and 50 vCenter sessions. Run this broker once on the
+controller and point the modules' session_broker option at its socket:
+the broker keeps a small pool of logged-in pyVmomi sessions per vCenter
+and user, and lends their session cookies to the modules. Several modules
+share one session at a time, and the number of sessions per vCenter is
+capped, so forks wait for a lease instead of exhausting vCenter's session
+limit.
+
+Protocol: newline delimited JSON over a Unix stream socket, one response
+line per request line.
+
+    {"op": "acquire", "host": h, "user": u, "password": p, "timeout": 300}
+        -> {"ok": true, "lease": id, "cookie": cookie}
+    {"op": "release", "lease": id, "invalid": false}
+        -> {"ok": true}
+    {"op": "status"}
+        -> {"ok": true, "pools": [...]}
+
+Leases still held when a client disconnects are released, so a crashed
+fork cannot pin a session. Release with "invalid": true when vCenter
+rejected the session; the broker then logs it out and drops it.
+
+Usage:
+    vsphere_session_broker.py --socket ~/.ansible/vsphere_broker.sock \\
+        --max-sessions 4 --leases-per-session 8
+"""
+
+import argparse
+import atexit
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from pyVim.connect import SmartConnect, Disconnect
+
+
+class BrokerError(Exception):
+    pass
+
+
+def _connect(host, user, password):
+    try:
+        return SmartConnect(host=host, user=user, pwd=password)
+    except Exception:
+        import ssl
+        try:
+            ssl._create_default_https_context = ssl._create_unverified_context
+        except AttributeError:
+            pass
+        try:
+            return SmartConnect(host=host, user=user, pwd=password)
+        except Exception as err:
+            raise BrokerError("Cannot log in to %s as %s: %s" % (host, user, err))
+
+
+class SessionPool(object):
+    """
+    Logged-in sessions for one vCenter and user. A session is lent to at
+    most leases_per_session borrowers at once, and at most max_sessions
+    sessions exist.
+    """
+    def __init__(self, host, user, password, max_sessions, leases_per_session, connect=_connect):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.password_hash = self._hash(password)
+        self.max_sessions = max_sessions
+        self.leases_per_session = leases_per_session
+        self.connect = connect
+        self.sessions = []
+        self.logins = 0
+        self.lock = threading.Condition(threading.Lock())
+
+    @staticmethod
+    def _hash(password):
+        return hashlib.sha256(password.encode("utf-8")).hexdigest()
+
+    def check_password(self, password):
+        if self._hash(password) == self.password_hash:
+            return
+        # The password may have been rotated; only a successful login with
+        # the new one may replace it. The session joins the pool when there
+        # is a free slot and is logged out otherwise.
+        with self.lock:
+            session = self._reserve(set())
+        si = self._login(session, password)
+        with self.lock:
+            self.password = password
+            self.password_hash = self._hash(password)
+        if session is None:
+            self._logout({"si": si})
+
+    def _reserve(self, leases):
+        """
+        Takes a slot for a session that is about to log in; called with the
+        lock held.
+        Returns:
+            The reserved session, or None when the pool is full
+        """
+        if len(self.sessions) >= self.max_sessions:
+            return None
+        session = {"si": None, "leases": leases, "last_used": time.time()}
+        self.sessions.append(session)
+        return session
+
+    def _login(self, session, password):
+        """Log in without the lock; session, when given, is a reserved slot."""
+        try:
+            si = self.connect(self.host, self.user, password)
+        except Exception:
+            if session is not None:
+                with self.lock:
+                    self.sessions.remove(session)
+                    self.lock.notify_all()
+            raise
+        with self.lock:
+            self.logins += 1
+            if session is not None:
+                session["si"] = si
+            self.lock.notify_all()
+        return si
+
+    def acquire(self, lease, timeout):
+        deadline = time.time() + timeout
+        with self.lock:
+            while True:
+                candidates = [x for x in self.sessions if x["si"] is not None and len(x["leases"]) < self.leases_per_session]
+                if candidates:
+                    session = min(candidates, key=lambda x: len(x["leases"]))
+                    session["leases"].add(lease)
+                    session["last_used"] = time.time()
+                    return session
+                # Wait for a login in progress to finish rather than start
+                # another one next to it.
+                logging_in = [x for x in self.sessions if x["si"] is None and len(x["leases"]) < self.leases_per_session]
+                if not logging_in:
+                    session = self._reserve(set([lease]))
+                    if session is not None:
+                        break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise BrokerError("No free vCenter session for %s@%s after %s seconds" % (self.user, self.host, timeout))
+                self.lock.wait(remaining)
+
+        self._login(session, self.password)
+        return session
+
+    def release(self, session, lease, invalid=False):
+        """
+        An invalid session leaves the pool at once and is logged out when
+        its last lease is released, which may be a later, valid release.
+        """
+        with self.lock:
+            session["leases"].discard(lease)
+            session["last_used"] = time.time()
+            if invalid and session in self.sessions:
+                self.sessions.remove(session)
+                session["dropped"] = True
+            logout = session.get("dropped", False) and len(session["leases"]) == 0
+            self.lock.notify_all()
+        if logout:
+            self._logout(session)
+
+    def expire(self, idle_seconds):
+        """Log out idle sessions and drop the ones vCenter no longer knows."""
+        now = time.time()
+        with self.lock:
+            idle = [x for x in self.sessions if x["si"] is not None and len(x["leases"]) == 0]
+        for session in idle:
+            if now - session["last_used"] > idle_seconds:
+                self._remove(session)
+                self._logout(session)
+                continue
+            try:
+                alive = session["si"].content.sessionManager.currentSession is not None
+            except Exception:
+                alive = False
+            if not alive:
+                self._remove(session)
+
+    def _remove(self, session):
+        with self.lock:
+            if session in self.sessions and len(session["leases"]) == 0:
+                self.sessions.remove(session)
+            self.lock.notify_all()
+
+    def _logout(self, session):
+        try:
+            Disconnect(session["si"])
+        except Exception:
+            pass
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions)
+            self.sessions = []
+        for session in sessions:
+            if session["si"] is not None:
+                self._logout(session)
+
+    def status(self):
+        with self.lock:
+            return {"host": self.host,
+                    "user": self.user,
+                    "sessions": len(self.sessions),
+                    "leases": sum(len(x["leases"]) for x in self.sessions),
+                    "logins": self.logins}
+
+
+class Broker(object):
+    def __init__(self, max_sessions=4, leases_per_session=8, idle_seconds=900, connect=_connect):
+        self.max_sessions = max_sessions
+        self.leases_per_session = leases_per_session
+        self.idle_seconds = idle_seconds
+        self.connect = connect
+        self.pools = {}
+        self.leases = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def get_pool(self, host, user, password):
+        with self.lock:
+            pool = self.pools.get((host, user))
+            if pool is None:
+                pool = SessionPool(host, user, password, self.max_sessions, self.leases_per_session, self.connect)
+                self.pools[(host, user)] = pool
+                return pool
+        pool.check_password(password)
+        return pool
+
+    def acquire(self, host, user, password, timeout=300):
+        pool = self.get_pool(host, user, password)
+        lease = "lease-%s" % next(self._ids)
+        session = pool.acquire(lease, timeout)
+        with self.lock:
+            self.leases[lease] = (pool, session)
+        return lease, session["si"]._stub.cookie
+
+    def release(self, lease, invalid=False):
+        with self.lock:
+            entry = self.leases.pop(lease, None)
+        if entry is not None:
+            entry[0].release(entry[1], lease, invalid)
+
+    def expire(self):
+        with self.lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            pool.expire(self.idle_seconds)
+
+    def status(self):
+        with self.lock:
+            pools = list(self.pools.values())
+        return [x.status() for x in pools]
+
+    def close(self):
+        with self.lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            pool.close()
+
+
+class BrokerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        held = set()
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    response = self.dispatch(broker, request, held)
+                except BrokerError as err:
+                    response = {"ok": False, "msg": str(err)}
+                except Exception as err:
+                    logging.exception("broker request failed")
+                    response = {"ok": False, "msg": "%s: %s" % (type(err).__name__, err)}
+                self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+                self.wfile.flush()
+        finally:
+            for lease in held:
+                broker.release(lease)
+
+    def dispatch(self, broker, request, held):
+        op = request.get("op")
+        if op == "acquire":
+            lease, cookie = broker.acquire(request["host"], request["user"], request["password"],
+                                           float(request.get("timeout", 300)))
+            held.add(lease)
+            return {"ok": True, "lease": lease, "cookie": cookie}
+        if op == "release":
+            held.discard(request["lease"])
+            broker.release(request["lease"], bool(request.get("invalid", False)))
+            return {"ok": True}
+        if op == "status":
+            return {"ok": True, "pools": broker.status()}
+        raise BrokerError("Unknown op: %s" % op)
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, broker):
+        self.broker = broker
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        old_umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, BrokerRequestHandler)
+        finally:
+            os.umask(old_umask)
+        os.chmod(socket_path, 0o600)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pool and lend vCenter sessions to the vSphere modules.")
+    parser.add_argument("--socket", default="~/.ansible/vsphere_broker.sock")
+    parser.add_argument("--max-sessions", type=int, default=4,
+                        help="Sessions per vCenter and user")
+    parser.add_argument("--leases-per-session", type=int, default=8,
+                        help="Modules sharing one session at the same time")
+    parser.add_argument("--idle-seconds", type=int, default=900,
+                        help="Log out sessions nobody borrowed for this long")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    socket_path = os.path.expanduser(args.socket)
+    directory = os.path.dirname(socket_path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+
+    broker = Broker(args.max_sessions, args.leases_per_session, args.idle_seconds)
+    atexit.register(broker.close)
+    server = BrokerServer(socket_path, broker)
+
+    def keepalive():
+        while True:
+            time.sleep(60)
+            try:
+                broker.expire()
+            except Exception:
+                logging.exception("session expiry failed")
+
+    thread = threading.Thread(target=keepalive)
+    thread.daemon = True
+    thread.start()
+
+    logging.info("vSphere session broker listening on %s", socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    main()
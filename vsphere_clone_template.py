@@ -8,13 +8,32 @@ import random
 import operator
 import itertools
 import json
+import copy
+import os
+import sys
+import socket
+import hashlib
+import tempfile
+import threading
+import uuid
 from contextlib import contextmanager
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 HAS_PYVMOMI = False
 try:
     from pyVmomi import vim
     from pyVmomi import vmodl
-    from pyVim.connect import SmartConnect, Disconnect
+    from pyVmomi.VmomiSupport import GetVmodlType, ManagedObject, DataObject
+    from pyVim.connect import SmartConnect, SmartStubAdapter, Disconnect
     HAS_PYVMOMI = True
 
 except ImportError as e:
@@ -22,16 +41,30 @@ except ImportError as e:
 
 
 class VsphereHelpers(object):
+    # ContainerViews live on the vCenter side until destroyed, so they are
+    # created once per session, container and type list and torn down by
+    # destroy_views().
+    _views = {}
+    _views_lock = threading.Lock()
+
     @staticmethod
-    def create_storage_selection_spec(vi_content, datastore_cluster, desired_disks):
-        os_datastore_cluster = VsphereHelpers.get_obj(vi_content, [vim.StoragePod], datastore_cluster)
+    def create_storage_selection_spec(vi_content, datastore_cluster, desired_disks, pod_cache=None, inventory=None):
+        if pod_cache is None:
+            pod_cache = {}
+
+        def get_pod(name):
+            if name not in pod_cache:
+                pod_cache[name] = VsphereHelpers.get_obj(vi_content, [vim.StoragePod], name, inventory)
+            return pod_cache[name]
+
+        os_datastore_cluster = get_pod(datastore_cluster)
         podsel = vim.storageDrs.PodSelectionSpec()
         podsel.storagePod = os_datastore_cluster
         if len(desired_disks) > 0:
             pod_configs = []
             for key, group in itertools.groupby(sorted(desired_disks, key=operator.itemgetter("datastore_cluster")), lambda y: y["datastore_cluster"]):
                 pod_config = vim.VmPodConfigForPlacement()
-                current_dsc = VsphereHelpers.get_obj(vi_content, [vim.StoragePod], key)
+                current_dsc = get_pod(key)
                 pod_config.storagePod = current_dsc
                 dsc_disks = []
                 for disk in group:
@@ -64,13 +97,15 @@ class VsphereHelpers(object):
         return storage_spec
 
     @staticmethod
-    def create_clone_spec(relocate_spec, config_spec, customization_spec=None, isTemplate=False):
+    def create_clone_spec(relocate_spec, config_spec, customization_spec=None, isTemplate=False, snapshot=None):
         # Clone spec
         clonespec = vim.vm.CloneSpec()
         clonespec.location = relocate_spec
         clonespec.config = config_spec
         if customization_spec is not None:
             clonespec.customization = customization_spec
+        if snapshot is not None:
+            clonespec.snapshot = snapshot
         clonespec.powerOn = not isTemplate
         clonespec.template = isTemplate
         return clonespec
@@ -104,25 +139,231 @@ class VsphereHelpers(object):
 
     @staticmethod
     def wait_task(task, actionName='job', hideResult=False, timeout=600):
-        start_time = datetime.now()
-        while task.info.state == vim.TaskInfo.State.running:
-            time.sleep(2)
-            current_time = datetime.now()
-            if (current_time - start_time).seconds > timeout:
-                raise Exception("vCenter Timeout: Task took longer than %s seconds to complete." % timeout)
-
-        if task.info.state == vim.TaskInfo.State.success:
-           if task.info.result is not None and not hideResult:
-              out = '%s completed successfully, result: %s' % (actionName, task.info.result)
+        for finished in VsphereHelpers.wait_tasks([task], timeout=timeout):
+            pass
+
+        info = task.info
+        if info.state == vim.TaskInfo.State.success:
+           if info.result is not None and not hideResult:
+              out = '%s completed successfully, result: %s' % (actionName, info.result)
            else:
               out = '%s completed successfully.' % actionName
         else:
-           out = '%s did not complete successfully: %s' % (actionName, task.info.error)
+           out = '%s did not complete successfully: %s' % (actionName, info.error)
            print out
-           raise Exception(task.info.error) # should be a Fault... check XXX
+           raise Exception(info.error) # should be a Fault... check XXX
 
         # may not always be applicable, but can't hurt.
-        return task.info.result
+        return info.result
+
+    @staticmethod
+    def get_datastore_space(vi_content, datastores):
+        """
+        Free space and capacity of several datastores in one
+        RetrievePropertiesEx.
+        Returns:
+            A dict of datastore moId to {"free": bytes, "capacity": bytes}
+        """
+        obj_specs = []
+        for datastore in datastores:
+            obj_spec = vmodl.query.PropertyCollector.ObjectSpec()
+            obj_spec.obj = datastore
+            obj_spec.skip = False
+            obj_specs.append(obj_spec)
+
+        property_spec = vmodl.query.PropertyCollector.PropertySpec()
+        property_spec.type = vim.Datastore
+        property_spec.pathSet = ["summary.freeSpace", "summary.capacity"]
+
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = obj_specs
+        filter_spec.propSet = [property_spec]
+
+        space = {}
+        for obj in VsphereHelpers.retrieve_properties(vi_content.propertyCollector, [filter_spec]):
+            properties = dict((prop.name, prop.val) for prop in obj.propSet)
+            space[obj.obj._moId] = {"free": properties.get("summary.freeSpace") or 0,
+                                    "capacity": properties.get("summary.capacity") or 0}
+        return space
+
+    @staticmethod
+    def get_pod_datastores(vi_content, pod):
+        """
+        The member datastores of a storage pod with their space figures,
+        in one RetrievePropertiesEx.
+        Returns:
+            A list of dicts with obj, name, free, capacity, provisioned,
+            accessible and maintenance_mode
+        """
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec()
+        traversal_spec.name = "podToDatastore"
+        traversal_spec.type = vim.StoragePod
+        traversal_spec.path = "childEntity"
+        traversal_spec.skip = False
+
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec()
+        obj_spec.obj = pod
+        obj_spec.skip = True
+        obj_spec.selectSet = [traversal_spec]
+
+        property_spec = vmodl.query.PropertyCollector.PropertySpec()
+        property_spec.type = vim.Datastore
+        property_spec.pathSet = ["name", "summary.freeSpace", "summary.capacity", "summary.uncommitted",
+                                 "summary.accessible", "summary.maintenanceMode"]
+
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [obj_spec]
+        filter_spec.propSet = [property_spec]
+
+        datastores = []
+        for obj in VsphereHelpers.retrieve_properties(vi_content.propertyCollector, [filter_spec]):
+            properties = dict((prop.name, prop.val) for prop in obj.propSet)
+            free = properties.get("summary.freeSpace") or 0
+            capacity = properties.get("summary.capacity") or 0
+            datastores.append({"obj": obj.obj,
+                               "name": properties.get("name"),
+                               "free": free,
+                               "capacity": capacity,
+                               "provisioned": capacity - free + (properties.get("summary.uncommitted") or 0),
+                               "accessible": properties.get("summary.accessible", True),
+                               "maintenance_mode": properties.get("summary.maintenanceMode") or "normal"})
+        return datastores
+
+    @staticmethod
+    def get_recent_tasks(vi_content):
+        """
+        TaskManager.recentTask with the info of every task, in one
+        RetrievePropertiesEx instead of one read per task.
+        Returns:
+            A list of (vim.Task, vim.TaskInfo) tuples
+        """
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec()
+        traversal_spec.name = "recentTask"
+        traversal_spec.type = vim.TaskManager
+        traversal_spec.path = "recentTask"
+        traversal_spec.skip = False
+
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec()
+        obj_spec.obj = vi_content.taskManager
+        obj_spec.skip = True
+        obj_spec.selectSet = [traversal_spec]
+
+        property_spec = vmodl.query.PropertyCollector.PropertySpec()
+        property_spec.type = vim.Task
+        property_spec.pathSet = ["info"]
+
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [obj_spec]
+        filter_spec.propSet = [property_spec]
+
+        return [(x.obj, x.propSet[0].val)
+                for x in VsphereHelpers.retrieve_properties(vi_content.propertyCollector, [filter_spec])
+                if len(x.propSet) > 0]
+
+    @staticmethod
+    def get_task_states(vi_content, task_ids):
+        """
+        State of tasks by MoRef ID in one RetrievePropertiesEx, plus one
+        more for the names of the VMs finished clones created. Tasks
+        vCenter no longer knows (expired or from another vCenter) come back
+        with state "unknown".
+        Returns:
+            A list of dicts in the order of task_ids
+        """
+        stub = vi_content.propertyCollector._stub
+        tasks = [vim.Task(x, stub) for x in task_ids]
+        paths = ["info.state", "info.progress", "info.result", "info.error", "info.entityName",
+                 "info.descriptionId", "info.startTime", "info.completeTime"]
+        properties = {}
+        while len(tasks) > 0:
+            try:
+                properties = VsphereHelpers.get_objects_properties(vi_content, tasks, paths)
+                break
+            except vmodl.fault.ManagedObjectNotFound as err:
+                # One unknown task fails the whole request; drop it and ask again.
+                gone = getattr(err.obj, "_moId", None)
+                if gone not in [x._moId for x in tasks]:
+                    raise
+                tasks = [x for x in tasks if x._moId != gone]
+
+        def created_vm(result):
+            if isinstance(result, vmodl.DynamicData):
+                # ApplyStorageDrsRecommendation_Task returns the VM inside its result.
+                result = getattr(result, "vm", None)
+            return result if isinstance(result, vim.VirtualMachine) else None
+
+        vms = dict((x._moId, x) for x in [created_vm(y.get("info.result")) for y in properties.values()] if x is not None)
+        names = VsphereHelpers.get_objects_properties(vi_content, list(vms.values()), ["name"])
+
+        states = []
+        for task_id in task_ids:
+            props = properties.get(task_id, {})
+            state = {"task": task_id, "state": str(props.get("info.state") or "unknown")}
+            if "info.state" in props:
+                state["progress"] = props.get("info.progress")
+                state["description"] = props.get("info.descriptionId")
+                state["entity"] = props.get("info.entityName")
+                vm = created_vm(props.get("info.result"))
+                if vm is not None:
+                    state["vm"] = names.get(vm._moId, {}).get("name")
+                if props.get("info.error") is not None:
+                    state["msg"] = _get_error_message(Exception(props["info.error"]))
+                if props.get("info.startTime") is not None and props.get("info.completeTime") is not None:
+                    state["seconds"] = round((props["info.completeTime"] - props["info.startTime"]).total_seconds(), 3)
+            states.append(state)
+        return states
+
+    @staticmethod
+    def wait_tasks(tasks, timeout=600):
+        """
+        Wait for one or many tasks with a single PropertyCollector filter
+        instead of polling each task.
+        Args:
+            tasks (list): vim.Task objects sharing one connection
+            timeout (int): Seconds to wait for all tasks to finish
+        Returns:
+            A generator yielding each task as soon as it succeeds or fails
+        """
+        if len(tasks) == 0:
+            return
+
+        # A private collector keeps our filter away from anyone else
+        # waiting on the session's default collector.
+        si = vim.ServiceInstance("ServiceInstance", tasks[0]._stub)
+        collector = si.content.propertyCollector.CreatePropertyCollector()
+        try:
+            filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+            filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=task, skip=False) for task in tasks]
+            property_spec = vmodl.query.PropertyCollector.PropertySpec()
+            property_spec.type = vim.Task
+            property_spec.pathSet = ["info.state", "info.progress"]
+            filter_spec.propSet = [property_spec]
+            collector.CreateFilter(filter_spec, partialUpdates=True)
+
+            pending = dict((task._moId, task) for task in tasks)
+            done_states = (vim.TaskInfo.State.success, vim.TaskInfo.State.error)
+            start_time = datetime.now()
+            version = ""
+            while len(pending) > 0:
+                remaining = timeout - (datetime.now() - start_time).seconds
+                if remaining <= 0:
+                    raise Exception("vCenter Timeout: Task took longer than %s seconds to complete." % timeout)
+
+                options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=int(remaining))
+                update = collector.WaitForUpdatesEx(version, options)
+                if update is None:
+                    continue
+                version = update.version
+
+                for filter_set in update.filterSet:
+                    for obj_set in filter_set.objectSet:
+                        for change in obj_set.changeSet:
+                            if change.name == "info.state" and change.val in done_states:
+                                task = pending.pop(obj_set.obj._moId, None)
+                                if task is not None:
+                                    yield task
+        finally:
+            collector.DestroyPropertyCollector()
 
     @staticmethod
     def collect_properties(service_instance, view_ref, obj_type, path_set=None, include_mors=False):
@@ -142,35 +383,7 @@ class VsphereHelpers(object):
             A list of properties for the managed objects
         """
         collector = service_instance.content.propertyCollector
-
-        # Create object specification to define the starting point of
-        # inventory navigation
-        obj_spec = vmodl.query.PropertyCollector.ObjectSpec()
-        obj_spec.obj = view_ref
-        obj_spec.skip = True
-
-        # Create a traversal specification to identify the path for collection
-        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec()
-        traversal_spec.name = 'traverseEntities'
-        traversal_spec.path = 'view'
-        traversal_spec.skip = False
-        traversal_spec.type = view_ref.__class__
-        obj_spec.selectSet = [traversal_spec]
-
-        # Identify the properties to the retrieved
-        property_spec = vmodl.query.PropertyCollector.PropertySpec()
-        property_spec.type = obj_type
-
-        if not path_set:
-            property_spec.all = True
-
-        property_spec.pathSet = path_set
-
-        # Add the object and property specification to the
-        # property filter specification
-        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
-        filter_spec.objectSet = [obj_spec]
-        filter_spec.propSet = [property_spec]
+        filter_spec = VsphereHelpers.create_view_filter_spec(view_ref, [obj_type], path_set)
 
         # Retrieve properties
         props = collector.RetrieveContents([filter_spec])
@@ -187,29 +400,135 @@ class VsphereHelpers(object):
             data.append(properties)
         return data
 
+    @staticmethod
+    def retrieve_properties(collector, filter_specs):
+        """
+        RetrievePropertiesEx wrapper that follows continuation tokens, so
+        large inventories come back in pages instead of one huge response.
+        Returns:
+            A list of ObjectContent
+        """
+        objects = []
+        result = collector.RetrievePropertiesEx(filter_specs, vmodl.query.PropertyCollector.RetrieveOptions())
+        while result is not None:
+            objects.extend(result.objects)
+            if result.token is None:
+                break
+            result = collector.ContinueRetrievePropertiesEx(result.token)
+        return objects
+
+    @staticmethod
+    def get_object_properties(vi_content, obj, paths):
+        """
+        Several properties of one managed object in a single
+        RetrievePropertiesEx; unset properties are missing from the dict.
+        """
+        return VsphereHelpers.get_objects_properties(vi_content, [obj], paths).get(obj._moId, {})
+
+    @staticmethod
+    def get_objects_properties(vi_content, objs, paths):
+        """
+        The same properties of several managed objects in a single
+        RetrievePropertiesEx.
+        Returns:
+            A dict of moId to a dict of the properties that are set
+        """
+        if len(objs) == 0:
+            return {}
+
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False) for obj in objs]
+        filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=vimtype, pathSet=paths)
+                               for vimtype in set(type(obj) for obj in objs)]
+
+        properties = dict((obj._moId, {}) for obj in objs)
+        for content in VsphereHelpers.retrieve_properties(vi_content.propertyCollector, [filter_spec]):
+            properties[content.obj._moId].update((prop.name, prop.val) for prop in content.propSet)
+        return properties
+
     @staticmethod
     def get_container_view(service_instance, obj_type, container=None):
         """
         Get a vSphere Container View reference to all objects of type 'obj_type'
-        It is up to the caller to take care of destroying the View when no longer
-        needed.
+        The view is shared by every caller asking for the same container and
+        types; VsphereHelpers.destroy_views() destroys it.
         Args:
             obj_type (list): A list of managed object types
         Returns:
             A container view ref to the discovered managed objects
         """
+        return VsphereHelpers.get_content_view(service_instance.content, obj_type, container)
+
+    @staticmethod
+    def get_content_view(content, obj_type, container=None):
         if not container:
-            container = service_instance.content.rootFolder
+            container = content.rootFolder
+
+        key = (id(container._stub), container._moId, tuple(sorted(x.__name__ for x in obj_type)))
+        with VsphereHelpers._views_lock:
+            if key not in VsphereHelpers._views:
+                VsphereHelpers._views[key] = content.viewManager.CreateContainerView(
+                    container=container,
+                    type=obj_type,
+                    recursive=True
+                )
+            return VsphereHelpers._views[key]
 
-        view_ref = service_instance.content.viewManager.CreateContainerView(
-            container=container,
-            type=obj_type,
-            recursive=True
-        )
-        return view_ref
+    @staticmethod
+    def destroy_views():
+        with VsphereHelpers._views_lock:
+            views = list(VsphereHelpers._views.values())
+            VsphereHelpers._views.clear()
+
+        for view in views:
+            try:
+                view.DestroyView()
+            except Exception:
+                # The session may already be gone, taking its views with it.
+                pass
+
+    @staticmethod
+    def create_view_filter_spec(view_ref, obj_type, path_set=None):
+        """
+        Filter spec selecting every object of the types in obj_type from a
+        container view.
+        """
+        # Create object specification to define the starting point of
+        # inventory navigation
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec()
+        obj_spec.obj = view_ref
+        obj_spec.skip = True
+
+        # Create a traversal specification to identify the path for collection
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec()
+        traversal_spec.name = 'traverseEntities'
+        traversal_spec.path = 'view'
+        traversal_spec.skip = False
+        traversal_spec.type = view_ref.__class__
+        obj_spec.selectSet = [traversal_spec]
+
+        # Identify the properties to the retrieved
+        property_specs = []
+        for vimtype in obj_type:
+            property_spec = vmodl.query.PropertyCollector.PropertySpec()
+            property_spec.type = vimtype
+            if not path_set:
+                property_spec.all = True
+            property_spec.pathSet = path_set
+            property_specs.append(property_spec)
+
+        # Add the object and property specification to the
+        # property filter specification
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [obj_spec]
+        filter_spec.propSet = property_specs
+        return filter_spec
 
     @staticmethod
-    def get_vm(service_instance, vm_name):
+    def get_vm(service_instance, vm_name, inventory=None):
+        if inventory is not None:
+            return inventory.find([vim.VirtualMachine], vm_name)
+
         view = VsphereHelpers.get_container_view(service_instance,
                                        obj_type=[vim.VirtualMachine])
 
@@ -223,35 +542,630 @@ class VsphereHelpers(object):
         return vms
 
     @staticmethod
-    def get_obj(content, vimtype, name):
-        obj = None
-        container = content.viewManager.CreateContainerView(
-            content.rootFolder, vimtype, True)
-        for c in container.view:
-            if c.name == name:
-                obj = c
+    def get_vm_names(service_instance, inventory=None):
+        if inventory is not None:
+            return inventory.names([vim.VirtualMachine])
+
+        view = VsphereHelpers.get_container_view(service_instance,
+                                       obj_type=[vim.VirtualMachine])
+
+        vm_data = VsphereHelpers.collect_properties(service_instance, view_ref=view,
+                                          obj_type=vim.VirtualMachine,
+                                          path_set=["name"])
+
+        return [x["name"] for x in vm_data]
+
+    @staticmethod
+    def get_obj(content, vimtype, name, inventory=None):
+        if inventory is not None:
+            found = inventory.find(vimtype, name)
+            if len(found) > 0:
+                return found[0]
+            return None
+
+        view = VsphereHelpers.get_content_view(content, vimtype)
+        filter_spec = VsphereHelpers.create_view_filter_spec(view, vimtype, ["name"])
+        for obj in VsphereHelpers.retrieve_properties(content.propertyCollector, [filter_spec]):
+            if len(obj.propSet) > 0 and obj.propSet[0].val == name:
+                return obj.obj
+        return None
+
+
+class InventorySnapshot(object):
+    """
+    Names and lookup properties of the datacenters, folders, VMs, clusters,
+    networks, datastores and storage pods below a container, fetched with
+    one PropertyCollector request that traverses the inventory tree.
+    VsphereHelpers.get_vm, VsphereHelpers.get_obj, NetworkHelpers.get_network
+    and FolderHelpers.get_folder_objects answer from it when handed one.
+    """
+    # Order matters: StoragePod is a Folder and a DistributedVirtualPortgroup
+    # is a Network, the first matching type files the object.
+    PATHS = [(vim.VirtualMachine, ["name"]),
+             (vim.ClusterComputeResource, ["name", "resourcePool"]),
+             (vim.StoragePod, ["name"]),
+             (vim.Network, ["name"]),
+             (vim.Datastore, ["name"]),
+             (vim.Datacenter, ["name", "vmFolder"]),
+             (vim.Folder, ["name", "childEntity", "parent"])] if HAS_PYVMOMI else []
+
+    def __init__(self, service_instance, container=None):
+        if container is None:
+            container = service_instance.content.rootFolder
+
+        self.by_type = dict((vimtype, {}) for vimtype, path_set in InventorySnapshot.PATHS)
+        self.properties = {}
+
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=container, skip=False,
+                                                                          selectSet=InventorySnapshot.create_traversal_specs())]
+        filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=vimtype, pathSet=path_set, all=False)
+                               for vimtype, path_set in InventorySnapshot.PATHS]
+
+        collector = service_instance.content.propertyCollector
+        for obj in VsphereHelpers.retrieve_properties(collector, [filter_spec]):
+            vimtype = self._get_type(obj.obj)
+            if vimtype is None:
+                continue
+            properties = dict((prop.name, prop.val) for prop in obj.propSet)
+            properties["obj"] = obj.obj
+            self.properties[obj.obj._moId] = properties
+            self.by_type[vimtype].setdefault(properties.get("name"), []).append(obj.obj)
+
+    @staticmethod
+    def create_traversal_specs():
+        """
+        Traversal from the root folder down to every VM, cluster, network,
+        datastore and storage pod.
+        """
+        def traverse(name, vimtype, path, select_names):
+            spec = vmodl.query.PropertyCollector.TraversalSpec()
+            spec.name = name
+            spec.type = vimtype
+            spec.path = path
+            spec.skip = False
+            spec.selectSet = [vmodl.query.PropertyCollector.SelectionSpec(name=x) for x in select_names]
+            return spec
+
+        everything = ["folderToChild", "dcToVmFolder", "dcToHostFolder", "dcToDatastoreFolder",
+                      "dcToNetworkFolder", "vAppToVm"]
+        return [traverse("folderToChild", vim.Folder, "childEntity", everything),
+                traverse("dcToVmFolder", vim.Datacenter, "vmFolder", ["folderToChild"]),
+                traverse("dcToHostFolder", vim.Datacenter, "hostFolder", ["folderToChild"]),
+                traverse("dcToDatastoreFolder", vim.Datacenter, "datastoreFolder", ["folderToChild"]),
+                traverse("dcToNetworkFolder", vim.Datacenter, "networkFolder", ["folderToChild"]),
+                traverse("vAppToVm", vim.VirtualApp, "vm", [])]
+
+    def _get_type(self, obj):
+        for vimtype, path_set in InventorySnapshot.PATHS:
+            if isinstance(obj, vimtype):
+                return vimtype
+        return None
+
+    def find(self, vimtype, name):
+        """Objects named name whose type is in the vimtype list."""
+        found = []
+        for known_type in self.by_type:
+            if len([x for x in vimtype if issubclass(known_type, x)]) > 0:
+                found.extend(self.by_type[known_type].get(name, []))
+        return found
+
+    def names(self, vimtype):
+        names = []
+        for known_type in self.by_type:
+            if len([x for x in vimtype if issubclass(known_type, x)]) > 0:
+                for name, objs in self.by_type[known_type].items():
+                    names.extend([name] * len(objs))
+        return names
+
+    def get_properties(self, obj):
+        if obj is None:
+            return None
+        return self.properties.get(obj._moId)
+
+    def get_folders(self, root_folder):
+        """Folder property dicts for every plain folder below root_folder."""
+        folders = []
+        for folder_list in self.by_type[vim.Folder].values():
+            for folder in folder_list:
+                parent = self.get_properties(folder).get("parent")
+                while parent is not None and parent._moId != root_folder._moId:
+                    parent_props = self.get_properties(parent)
+                    parent = parent_props.get("parent") if parent_props is not None else None
+                if parent is not None:
+                    folders.append(self.get_properties(folder))
+        return folders
+
+
+class InventoryIndex(object):
+    """
+    On-disk index of inventory names to MoRef IDs that survives module runs.
+    The index remembers the PropertyCollector and the WaitForUpdatesEx
+    version it was last synced to; sync() asks that collector for the
+    changes since then and only falls back to a full download when the
+    collector is gone or the version is too old. Collectors belong to a
+    session, so deltas apply whenever the vCenter session outlives the run.
+    A full download destroys the collector it replaces. Runs sharing the
+    index take turns under an flock, as they share the collector too.
+    Offers the same lookups as InventorySnapshot.
+    """
+    PATHS = [(vim.VirtualMachine, ["name"]),
+             (vim.ClusterComputeResource, ["name"]),
+             (vim.StoragePod, ["name"]),
+             (vim.Network, ["name"]),
+             (vim.Datastore, ["name"]),
+             (vim.Datacenter, ["name"])] if HAS_PYVMOMI else []
+
+    def __init__(self, service_instance, cache_dir, vcenter_hostname, vcenter_username):
+        self.service_instance = service_instance
+        key = hashlib.sha1(("%s|%s" % (vcenter_hostname, vcenter_username)).encode("utf-8")).hexdigest()
+        self.path = os.path.join(os.path.expanduser(cache_dir), "inventory_%s.json" % key)
+        self.state = {"collector": None, "version": None, "entries": {}}
+        self.full_syncs = 0
+        self.changes_applied = 0
+        self._by_name = None
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                self.state = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            self.state = {"collector": None, "version": None, "entries": {}}
+        return self
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        handle, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, "w") as cache_file:
+            json.dump(self.state, cache_file)
+        os.chmod(tmp_path, 0o600)
+        os.rename(tmp_path, self.path)
+
+    @contextmanager
+    def _locked(self):
+        if fcntl is None:
+            yield
+            return
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        handle = os.fdopen(os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600), "r+")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+            handle.close()
+
+    def sync(self):
+        """Bring the index up to date, incrementally where vCenter allows."""
+        with self._locked():
+            # Another run may have moved the collector on while we waited.
+            self.load()
+            self._sync()
+        return self
+
+    def _sync(self):
+        self._by_name = None
+        if self.state.get("collector") is not None and self.state.get("version"):
+            collector = vmodl.query.PropertyCollector(self.state["collector"], self.service_instance._stub)
+            try:
+                self._apply_updates(collector, self.state["version"])
+                self.save()
+                return
+            except vmodl.MethodFault:
+                # InvalidCollectorVersion, or the collector died with its
+                # session: start over.
+                pass
+            try:
+                collector.DestroyPropertyCollector()
+            except vmodl.MethodFault:
+                pass
+
+        self.full_syncs += 1
+        self.state["entries"] = {}
+        collector = self.service_instance.content.propertyCollector.CreatePropertyCollector()
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=self.service_instance.content.rootFolder, skip=False,
+                                                                          selectSet=InventorySnapshot.create_traversal_specs())]
+        filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=vimtype, pathSet=path_set, all=False)
+                               for vimtype, path_set in InventoryIndex.PATHS]
+        collector.CreateFilter(filter_spec, partialUpdates=False)
+        self.state["collector"] = collector._moId
+        self._apply_updates(collector, "")
+        self.save()
+
+    def _apply_updates(self, collector, version):
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0)
+        while True:
+            update = collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                break
+            version = update.version
+            for filter_set in update.filterSet:
+                for obj_set in filter_set.objectSet:
+                    self._apply_object_update(obj_set)
+            if not update.truncated:
                 break
-        return obj
+        self.state["version"] = version
+
+    def _apply_object_update(self, obj_set):
+        type_name = obj_set.obj.__class__.__name__
+        entries = self.state["entries"].setdefault(type_name, {})
+        self.changes_applied += 1
+        if obj_set.kind == "leave":
+            entries.pop(obj_set.obj._moId, None)
+            return
+        for change in obj_set.changeSet:
+            if change.name == "name":
+                entries[obj_set.obj._moId] = change.val
+
+    def _get_name_index(self):
+        if self._by_name is None:
+            self._by_name = {}
+            for type_name, entries in self.state["entries"].items():
+                known_type = GetVmodlType(type_name)
+                for moid, name in entries.items():
+                    self._by_name.setdefault(name, []).append((known_type, moid))
+        return self._by_name
+
+    def find(self, vimtype, name):
+        return [known_type(moid, self.service_instance._stub)
+                for known_type, moid in self._get_name_index().get(name, [])
+                if len([x for x in vimtype if issubclass(known_type, x)]) > 0]
+
+    def names(self, vimtype):
+        return [name for name, entries in self._get_name_index().items()
+                for known_type, moid in entries if len([x for x in vimtype if issubclass(known_type, x)]) > 0]
+
+    def get_properties(self, obj):
+        return None
+
+    def get_folders(self, root_folder):
+        return None
+
+
+class SessionCache(object):
+    """
+    Keeps the vCenter session cookie in a 0600 file keyed by host and user
+    so later module runs can skip the SSO login. A cached session is only
+    reused after vCenter confirms it is still logged in; it is never logged
+    out at exit.
+    """
+    def __init__(self, cache_dir, vcenter_hostname, vcenter_username):
+        self.vcenter_hostname = vcenter_hostname
+        key = hashlib.sha1(("%s|%s" % (vcenter_hostname, vcenter_username)).encode("utf-8")).hexdigest()
+        self.path = os.path.join(os.path.expanduser(cache_dir), "session_%s" % key)
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                return cache_file.read().strip() or None
+        except (IOError, OSError):
+            return None
+
+    def save(self, si):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        handle, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, "w") as cache_file:
+            cache_file.write(si._stub.cookie)
+        os.chmod(tmp_path, 0o600)
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def resume(self):
+        """
+        Returns:
+            A ServiceInstance on the cached session, or None when there is
+            no cached session or vCenter no longer accepts it
+        """
+        cookie = self.load()
+        if cookie is None:
+            return None
+
+        si = resume_session(self.vcenter_hostname, cookie)
+        if si is None:
+            self.clear()
+        return si
+
+
+class SessionBroker(object):
+    """
+    Client for tools/vsphere_session_broker.py. Borrows a pooled session
+    cookie for the length of the module run. The session belongs to the
+    broker: it is released, never logged out, and the broker takes the
+    lease back by itself if this process dies.
+    """
+    def __init__(self, socket_path):
+        self.lease = None
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(os.path.expanduser(socket_path))
+        self.reader = self.sock.makefile("rb")
+
+    def _call(self, **request):
+        self.sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        line = self.reader.readline()
+        if not line:
+            raise Exception("vSphere session broker closed the connection")
+        response = json.loads(line.decode("utf-8"))
+        if not response.get("ok"):
+            raise Exception(response.get("msg"))
+        return response
+
+    def connect(self, vcenter_hostname, vcenter_username, vcenter_password, timeout=300):
+        """
+        Returns:
+            A ServiceInstance on a borrowed session, or None when the broker
+            only handed out sessions vCenter no longer accepts
+        """
+        for attempt in range(2):
+            response = self._call(op="acquire", host=vcenter_hostname, user=vcenter_username,
+                                  password=vcenter_password, timeout=timeout)
+            self.lease = response["lease"]
+            si = resume_session(vcenter_hostname, response["cookie"])
+            if si is not None:
+                return si
+            self.release(invalid=True, close=False)
+        return None
+
+    def release(self, invalid=False, close=True):
+        if self.lease is not None:
+            try:
+                self._call(op="release", lease=self.lease, invalid=invalid)
+            except Exception:
+                pass
+            self.lease = None
+        if close:
+            self.reader.close()
+            self.sock.close()
+
+
+def resume_session(vcenter_hostname, cookie):
+    """
+    Returns:
+        A ServiceInstance on the session behind cookie, or None when vCenter
+        no longer accepts it
+    """
+    try:
+        stub = _connect_with_ssl_fallback(lambda: SmartStubAdapter(host=vcenter_hostname))
+        stub.cookie = cookie
+        si = vim.ServiceInstance("ServiceInstance", stub)
+        session_manager = si.content.sessionManager
+        session = session_manager.currentSession
+        if session is None:
+            return None
+        try:
+            if not session_manager.SessionIsActive(session.key, session.userName):
+                return None
+        except vim.fault.NoPermission:
+            # SessionIsActive needs Sessions.ValidateSession; a
+            # non-empty currentSession is proof enough without it.
+            pass
+        return si
+    except Exception:
+        return None
+
+
+def _connect_with_ssl_fallback(connect):
+    try:
+        return connect()
+    except Exception:
+        import ssl
+        try:
+            ssl._create_default_https_context = ssl._create_unverified_context
+        except AttributeError:
+            pass
+        return connect()
+
+
+class Timings(object):
+    """
+    Wall clock spans of the phases of a run. Each span is a dict with
+    phase, start (epoch seconds), seconds and the context and attributes
+    it was opened with; a child() adds context (such as the guest) and
+    reports its spans to the parent as well.
+    """
+    def __init__(self, parent=None, **context):
+        self.parent = parent
+        self.context = context
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def child(self, **context):
+        merged = dict(self.context)
+        merged.update(context)
+        return Timings(self, **merged)
+
+    @contextmanager
+    def span(self, phase, **attrs):
+        start = time.time()
+        try:
+            yield
+        except BaseException:
+            attrs["failed"] = True
+            raise
+        finally:
+            self.record(phase, start, **attrs)
+
+    def record(self, phase, start, **attrs):
+        """A span from start until now."""
+        entry = dict(self.context)
+        entry.update(attrs)
+        entry.update(phase=phase, start=round(start, 3), seconds=round(time.time() - start, 3))
+        self._add(entry)
+
+    def _add(self, entry):
+        with self.lock:
+            self.spans.append(entry)
+        if self.parent is not None:
+            self.parent._add(entry)
+
+    def write(self, path):
+        """Append the spans to path as JSON lines, in one write."""
+        with self.lock:
+            lines = "".join(json.dumps(x, sort_keys=True) + "\n" for x in self.spans)
+        if len(lines) == 0:
+            return
+        handle = os.open(os.path.expanduser(path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(handle, lines.encode("utf-8"))
+        finally:
+            os.close(handle)
+
+
+class SoapStats(object):
+    """
+    Opt-in accounting of the SOAP calls a run makes: calls, request and
+    response bytes and latency per method, and calls per method for each
+    helper that made them. install() wraps pyVmomi's SoapStubAdapter for
+    the whole process, so the login is counted as well. Response bytes are
+    the bytes read off the wire, before any gzip decoding.
+    """
+    # Generic plumbing is never reported as the caller; the helper that
+    # went through it is.
+    PLUMBING = ("retrieve_properties", "get_objects_properties", "get_object_properties",
+                "collect_properties", "wait_task", "wait_tasks", "InvokeMethod", "SerializeRequest",
+                "GetConnection", "read", "add", "_caller")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.methods = {}
+        self.callers = {}
+        self.response_classes = {}
+        self.saved = {}
+
+    def install(self):
+        from pyVmomi import SoapAdapter
+        adapter = SoapAdapter.SoapStubAdapter
+        stats = self
+        for name in ("InvokeMethod", "SerializeRequest", "GetConnection"):
+            self.saved[name] = adapter.__dict__.get(name)
+        invoke_method = adapter.InvokeMethod
+        serialize_request = adapter.SerializeRequest
+        get_connection = adapter.GetConnection
+
+        def InvokeMethod(stub, mo, info, args, outerStub=None):
+            stats.local.request_bytes = 0
+            stats.local.response_bytes = 0
+            start = time.time()
+            try:
+                return invoke_method(stub, mo, info, args, outerStub)
+            finally:
+                stats.add(info.wsdlName, time.time() - start, stats.local.request_bytes, stats.local.response_bytes)
+
+        def SerializeRequest(stub, mo, info, args):
+            request = serialize_request(stub, mo, info, args)
+            stats.local.request_bytes = getattr(stats.local, "request_bytes", 0) + len(request)
+            return request
+
+        def GetConnection(stub):
+            conn = get_connection(stub)
+            conn.response_class = stats._counting_response(conn.response_class)
+            return conn
+
+        adapter.InvokeMethod = InvokeMethod
+        adapter.SerializeRequest = SerializeRequest
+        adapter.GetConnection = GetConnection
+        return self
+
+    def uninstall(self):
+        from pyVmomi import SoapAdapter
+        adapter = SoapAdapter.SoapStubAdapter
+        for name, original in self.saved.items():
+            if original is None:
+                delattr(adapter, name)
+            else:
+                setattr(adapter, name, original)
+        self.saved = {}
+
+    def _counting_response(self, response_class):
+        if getattr(response_class, "counts_for", None) is self:
+            return response_class
+        if response_class not in self.response_classes:
+            stats = self
+
+            class CountingResponse(response_class):
+                counts_for = stats
+
+                def read(self, *args, **kwargs):
+                    data = response_class.read(self, *args, **kwargs)
+                    stats.local.response_bytes = getattr(stats.local, "response_bytes", 0) + len(data)
+                    return data
+            self.response_classes[response_class] = CountingResponse
+        return self.response_classes[response_class]
+
+    def _caller(self):
+        home = sys._getframe(0).f_code.co_filename
+        frame = sys._getframe(1)
+        while frame is not None:
+            code = frame.f_code
+            if code.co_filename == home and code.co_name not in self.PLUMBING:
+                return code.co_name
+            frame = frame.f_back
+        return "other"
+
+    def add(self, method, seconds, request_bytes, response_bytes, caller=None):
+        if caller is None:
+            caller = self._caller()
+        with self.lock:
+            entry = self.methods.setdefault(method, {"calls": 0, "request_bytes": 0, "response_bytes": 0,
+                                                     "seconds": 0.0, "max_seconds": 0.0})
+            entry["calls"] += 1
+            entry["request_bytes"] += request_bytes
+            entry["response_bytes"] += response_bytes
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            calls = self.callers.setdefault(caller, {})
+            calls[method] = calls.get(method, 0) + 1
+
+    def report(self):
+        with self.lock:
+            methods = dict((name, dict(x, seconds=round(x["seconds"], 3), max_seconds=round(x["max_seconds"], 3)))
+                           for name, x in self.methods.items())
+            callers = dict((name, dict(x)) for name, x in self.callers.items())
+        return {"calls": sum(x["calls"] for x in methods.values()),
+                "request_bytes": sum(x["request_bytes"] for x in methods.values()),
+                "response_bytes": sum(x["response_bytes"] for x in methods.values()),
+                "seconds": round(sum(x["seconds"] for x in methods.values()), 3),
+                "methods": methods,
+                "callers": callers}
 
 
 class MediaHelpers(object):
     @staticmethod
     def get_media_drive(vsphere, template):
         if template is not None:
-            cd = [x for x in template.config.hardware.device if type(x) == vim.vm.device.VirtualCdrom]
-            if len(cd) > 0:
-                media_device = vim.vm.device.VirtualDeviceSpec()
-                media_device.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
-                media_device.device = cd[0]
-                media_device.device.connectable.startConnected = False
-                media_device.device.backing = vim.vm.device.VirtualCdrom.IsoBackingInfo()
-                return media_device
-            else:
-                return None
+            return MediaHelpers.create_media_drive_spec(template.config.hardware.device)
+
+    @staticmethod
+    def create_media_drive_spec(template_devices):
+        cd = [x for x in template_devices if type(x) == vim.vm.device.VirtualCdrom]
+        if len(cd) > 0:
+            media_device = vim.vm.device.VirtualDeviceSpec()
+            media_device.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
+            media_device.device = cd[0]
+            media_device.device.connectable.startConnected = False
+            media_device.device.backing = vim.vm.device.VirtualCdrom.IsoBackingInfo()
+            return media_device
+        else:
+            return None
 
 class NetworkHelpers(object):
     @staticmethod
-    def get_network(service_instance, network_name):
+    def get_network(service_instance, network_name, inventory=None):
+        if inventory is not None and network_name is not None:
+            return inventory.find([vim.Network], network_name)
+
         view = VsphereHelpers.get_container_view(service_instance, obj_type=[vim.Network])
 
         network_data = VsphereHelpers.collect_properties(service_instance, view_ref=view,
@@ -264,6 +1178,74 @@ class NetworkHelpers(object):
         else:
             return network_data
 
+    @staticmethod
+    def get_cluster_network_index(service_instance, cluster):
+        """
+        Resolve every network attached to cluster in one RetrievePropertiesEx.
+        The traversal climbs from the cluster to its datacenter and walks the
+        network folder, so distributed portgroups come back with their key
+        and their switch's UUID already filled in.
+        Returns:
+            A dict of network name to a list of dicts with obj, name, and for
+            distributed portgroups key and switch_uuid
+        """
+        def traverse(name, vimtype, path, select_names):
+            spec = vmodl.query.PropertyCollector.TraversalSpec()
+            spec.name = name
+            spec.type = vimtype
+            spec.path = path
+            spec.skip = False
+            spec.selectSet = [vmodl.query.PropertyCollector.SelectionSpec(name=x) for x in select_names]
+            return spec
+
+        traversal_specs = [traverse("clusterToParent", vim.ClusterComputeResource, "parent", ["folderToParent", "dcToNetworkFolder"]),
+                           traverse("folderToParent", vim.Folder, "parent", ["folderToParent", "dcToNetworkFolder"]),
+                           traverse("dcToNetworkFolder", vim.Datacenter, "networkFolder", ["networkFolderToChild"]),
+                           traverse("networkFolderToChild", vim.Folder, "childEntity", ["networkFolderToChild"])]
+
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec()
+        obj_spec.obj = cluster
+        obj_spec.skip = False
+        obj_spec.selectSet = [vmodl.query.PropertyCollector.SelectionSpec(name="clusterToParent")] + traversal_specs
+
+        property_specs = []
+        for vimtype, path_set in [(vim.ClusterComputeResource, ["network"]),
+                                  (vim.Network, ["name"]),
+                                  (vim.dvs.DistributedVirtualPortgroup, ["name", "key", "config.distributedVirtualSwitch"]),
+                                  (vim.DistributedVirtualSwitch, ["uuid"])]:
+            property_spec = vmodl.query.PropertyCollector.PropertySpec()
+            property_spec.type = vimtype
+            property_spec.pathSet = path_set
+            property_specs.append(property_spec)
+
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [obj_spec]
+        filter_spec.propSet = property_specs
+
+        cluster_networks = set()
+        networks = []
+        switch_uuids = {}
+        for obj in VsphereHelpers.retrieve_properties(service_instance.content.propertyCollector, [filter_spec]):
+            properties = dict((prop.name, prop.val) for prop in obj.propSet)
+            if isinstance(obj.obj, vim.ClusterComputeResource):
+                cluster_networks.update(x._moId for x in properties.get("network") or [])
+            elif isinstance(obj.obj, vim.DistributedVirtualSwitch):
+                switch_uuids[obj.obj._moId] = properties.get("uuid")
+            else:
+                networks.append((obj.obj, properties))
+
+        index = {}
+        for network, properties in networks:
+            if network._moId not in cluster_networks:
+                continue
+            info = {"obj": network, "name": properties.get("name")}
+            if "key" in properties:
+                info["key"] = properties["key"]
+                switch = properties.get("config.distributedVirtualSwitch")
+                info["switch_uuid"] = switch_uuids.get(switch._moId) if switch is not None else None
+            index.setdefault(info["name"], []).append(info)
+        return index
+
     @staticmethod
     def get_cluster_network(cluster, network_name):
         if network_name is not None:
@@ -271,7 +1253,12 @@ class NetworkHelpers(object):
             return networks
 
     @staticmethod
-    def create_nic_spec(network, nic_type="vmxnet3"):
+    def create_nic_spec(network, nic_type="vmxnet3", network_info=None):
+        """
+        network_info is an entry from get_cluster_network_index; when given,
+        its prefetched name, portgroup key and switch UUID are used instead
+        of reading them off network.
+        """
         nicspec = vim.vm.device.VirtualDeviceSpec()
         nicspec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
 
@@ -289,16 +1276,24 @@ class NetworkHelpers(object):
             nic_controller = vim.vm.device.VirtualVmxnet3()
 
         nicspec.device = nic_controller
-        if hasattr(network, "key"):
+        if network_info is not None:
+            is_portgroup = "key" in network_info
+        else:
+            is_portgroup = hasattr(network, "key")
+        if is_portgroup:
             nicspec.device.backing = vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo()
             dvs_port_connection = vim.dvs.PortConnection()
-            dvs_port_connection.portgroupKey = network.key
-            dvs_port_connection.switchUuid = network.config.distributedVirtualSwitch.uuid
+            if network_info is not None and network_info["switch_uuid"] is not None:
+                dvs_port_connection.portgroupKey = network_info["key"]
+                dvs_port_connection.switchUuid = network_info["switch_uuid"]
+            else:
+                dvs_port_connection.portgroupKey = network.key
+                dvs_port_connection.switchUuid = network.config.distributedVirtualSwitch.uuid
             nicspec.device.backing.port = dvs_port_connection
         else:
           nicspec.device.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
           nicspec.device.backing.network = network
-          nicspec.device.backing.deviceName = network.name
+          nicspec.device.backing.deviceName = network_info["name"] if network_info is not None else network.name
 
         nicspec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
         nicspec.device.connectable.startConnected = True
@@ -307,6 +1302,12 @@ class NetworkHelpers(object):
 
 
 class DiskHelpers(object):
+    # SCSI bus 0 holds the template's own disks; data disks go on buses 1
+    # to MAX_DATA_CONTROLLERS. The controller takes unit 7, and unit 0 is
+    # left unused so single controller VMs keep the units they always had.
+    MAX_DATA_CONTROLLERS = 3
+    SCSI_UNITS = [x for x in range(1, 16) if x != 7]
+
     @staticmethod
     def create_disk_ctrl_spec(type="paravirtual", bus_number=1, control_key=1, scsi_sharing=vim.vm.device.VirtualSCSIController.Sharing.noSharing):
         control_spec = vim.vm.device.VirtualDeviceSpec()
@@ -358,6 +1359,21 @@ class DiskHelpers(object):
 
         return diskspec
 
+    @staticmethod
+    def get_template_disks(template, template_devices=None):
+        """
+        Returns:
+            A list of (device key, capacity in bytes) for the template's disks
+        """
+        if template_devices is None:
+            template_devices = template.config.hardware.device
+        disks = []
+        for device in template_devices:
+            if isinstance(device, vim.vm.device.VirtualDisk):
+                capacity = getattr(device, "capacityInBytes", None) or device.capacityInKB * 1024
+                disks.append((device.key, capacity))
+        return disks
+
     @staticmethod
     def get_defined_disk_info(disk_key, disk):
         datastore = None
@@ -395,15 +1411,139 @@ class DiskHelpers(object):
         else:
             raise Exception("fs_type not specified for disk: %s" % json.dumps(disk))
 
+        controller = None
+        if disk.get("controller") is not None:
+            controller = int(disk["controller"])
+            if not 1 <= controller <= DiskHelpers.MAX_DATA_CONTROLLERS:
+                raise Exception("controller must be between 1 and %s for disk: %s" % (DiskHelpers.MAX_DATA_CONTROLLERS, json.dumps(disk)))
+
         return {"datastore": datastore,
                 "datastore_cluster": datastore_cluster,
                 "size_gb": disk_size,
                 "type": disk_type,
                 "label": disk_key,
                 "mount_point": mount_point,
-                "fs_type": fs_type
+                "fs_type": fs_type,
+                "controller": controller
         }
 
+    @staticmethod
+    def assign_controllers(disks, controllers=1):
+        """
+        Spread disks round-robin, in order, over the data controllers on
+        SCSI buses 1 to controllers; a disk naming its own controller goes
+        there instead. Sets "controller" and "unit_number" on every disk.
+        Returns:
+            The sorted bus numbers of the controllers in use
+        """
+        controllers = max(1, min(int(controllers), DiskHelpers.MAX_DATA_CONTROLLERS))
+        free = dict((bus, list(DiskHelpers.SCSI_UNITS)) for bus in range(1, DiskHelpers.MAX_DATA_CONTROLLERS + 1))
+        next_bus = 0
+        for disk in disks:
+            if disk.get("controller") is not None:
+                bus = disk["controller"]
+                if len(free[bus]) == 0:
+                    raise Exception("No free unit left on controller %s for disk %s" % (bus, disk["label"]))
+            else:
+                candidates = [x for x in range(1, controllers + 1) if len(free[x]) > 0]
+                if len(candidates) == 0:
+                    raise Exception("No free unit left on %s controllers for disk %s" % (controllers, disk["label"]))
+                # Round-robin, passing over full controllers.
+                bus = sorted(candidates, key=lambda x: (x - 1 - next_bus) % controllers)[0]
+                next_bus = bus % controllers
+            disk["controller"] = bus
+            disk["unit_number"] = free[bus].pop(0)
+        return sorted(set(x["controller"] for x in disks))
+
+
+class SnapshotHelpers(object):
+    # Name of the snapshot created when a linked clone asks for the latest
+    # snapshot of a template that has none.
+    LINKED_CLONE_SNAPSHOT = "linked-clone-base"
+
+    @staticmethod
+    def find_snapshot(snapshot_info, snapshot_name=None):
+        """
+        The snapshot named snapshot_name, or without a name the current
+        snapshot, falling back to the most recent one.
+        """
+        if snapshot_info is None:
+            return None
+        if snapshot_name is None and snapshot_info.currentSnapshot is not None:
+            return snapshot_info.currentSnapshot
+
+        found = []
+        pending = list(snapshot_info.rootSnapshotList)
+        while len(pending) > 0:
+            tree = pending.pop()
+            pending.extend(tree.childSnapshotList)
+            if snapshot_name is None or tree.name == snapshot_name:
+                found.append(tree)
+        if len(found) == 0:
+            return None
+        if snapshot_name is not None and len(found) > 1:
+            raise Exception("Found more than one snapshot named: %s" % snapshot_name)
+        return max(found, key=lambda x: x.createTime).snapshot
+
+    @staticmethod
+    def get_linked_clone_snapshot(vi_content, template, resource_pool, snapshot_name=None, timeout=600):
+        """
+        Snapshot to base linked clones of template on, created when it is
+        missing. A template cannot be snapshotted, so it is turned into a VM
+        for the snapshot and back into a template afterwards. When another
+        run is creating the snapshot at the same time, wait for theirs; any
+        other failure is raised at once.
+        """
+        properties = VsphereHelpers.get_object_properties(vi_content, template, ["snapshot", "config.template"])
+        snapshot = SnapshotHelpers.find_snapshot(properties.get("snapshot"), snapshot_name)
+        if snapshot is not None:
+            return snapshot
+
+        name = snapshot_name or SnapshotHelpers.LINKED_CLONE_SNAPSHOT
+        is_template = properties.get("config.template", False)
+        try:
+            if is_template:
+                template.MarkAsVirtualMachine(pool=resource_pool)
+            try:
+                task = template.CreateSnapshot(name=name, description="Base disk for linked clones",
+                                               memory=False, quiesce=False)
+                return VsphereHelpers.wait_task(task, 'Snapshot task')
+            finally:
+                if is_template:
+                    template.MarkAsTemplate()
+        except Exception as err:
+            properties = VsphereHelpers.get_object_properties(vi_content, template, ["snapshot", "config.template"])
+            snapshot = SnapshotHelpers.find_snapshot(properties.get("snapshot"), name)
+            if snapshot is not None and properties.get("config.template", False) == is_template:
+                return snapshot
+            if not SnapshotHelpers._is_concurrent(err, is_template, properties.get("config.template", False)):
+                raise
+            create_error = _get_error_message(err)
+
+        start_time = time.time()
+        while time.time() - start_time < timeout:
+            properties = VsphereHelpers.get_object_properties(vi_content, template, ["snapshot", "config.template"])
+            snapshot = SnapshotHelpers.find_snapshot(properties.get("snapshot"), name)
+            if snapshot is not None and properties.get("config.template", False) == is_template:
+                return snapshot
+            time.sleep(5)
+        raise Exception("Could not create snapshot %s of %s: %s" % (name, template.name, create_error))
+
+    @staticmethod
+    def _is_concurrent(err, was_template, is_template):
+        """
+        Whether err comes from another run working on the template right
+        now; was_template is what this run read before it started.
+        """
+        fault = _get_fault(err)
+        if isinstance(fault, (vim.fault.TaskInProgress, vim.fault.ConcurrentAccess)):
+            return True
+        if isinstance(fault, vim.fault.InvalidState) and not isinstance(fault, vim.fault.InvalidHostState):
+            return True
+        # Marking or snapshotting a template that another run has turned
+        # into a VM, or back, in the meantime.
+        return isinstance(fault, vmodl.fault.NotSupported) and was_template != is_template
+
 
 class CustomizationHelpers(object):
     @staticmethod
@@ -494,36 +1634,68 @@ class CustomizationHelpers(object):
 
         return customspec
 
+    @staticmethod
+    def create_guestinfo_config(desired_networks, domain, guest_name):
+        """
+        The network identity of create_linux_customization_spec as guestinfo
+        extraConfig, for guests that configure themselves at boot (instant
+        clones cannot run guest customization). Adapters are numbered in
+        position order: guestinfo.nic0.ip, .netmask, .gateway and .domain.
+        """
+        values = {"guestinfo.hostname": guest_name,
+                  "guestinfo.dns.servers": ",".join(sorted(set([x for y in [n.get("dns", []) for n in desired_networks] for x in y])))}
+        if domain is not None:
+            values["guestinfo.domain"] = domain
+            values["guestinfo.dns.suffixes"] = domain
+        for index, network in enumerate(desired_networks):
+            prefix = "guestinfo.nic%s." % index
+            if "ip" in network and "netmask" in network:
+                values[prefix + "ip"] = network["ip"]
+                values[prefix + "netmask"] = network["netmask"]
+                if int(network.get("position", -1)) == 0 and "gateway" in network:
+                    values[prefix + "gateway"] = network["gateway"]
+            if "domain" in network:
+                values[prefix + "domain"] = network["domain"]
+        return [vim.option.OptionValue(key=k, value=values[k]) for k in sorted(values)]
+
 
 class FolderHelpers(object):
     @staticmethod
-    def get_congo_folder(vsphere, folder_structure, template_vm):
+    def get_congo_folder(vsphere, folder_structure, template_vm, inventory=None):
         if folder_structure is None or len(folder_structure) == 0:
             return template_vm.parent
 
         folder_structure = [x for x in folder_structure if x is not None and x != ""]
 
-        datacenter_folder = FolderHelpers.get_datacenter_folder(template_vm)
+        datacenter_folder = FolderHelpers.get_datacenter_folder(template_vm, inventory)
         if datacenter_folder is not None:
-            folder_objects = FolderHelpers.get_folder_objects(vsphere, datacenter_folder["dc"])
+            folder_objects = FolderHelpers.get_folder_objects(vsphere, datacenter_folder["dc"], inventory)
             folder_mor, folder_children = FolderHelpers.find_folder(vsphere, folder_structure, folder_objects, datacenter_folder)
             return folder_mor
 
 
     @staticmethod
     def create_folder(root_folder, new_name):
-        return root_folder.CreateFolder(new_name)
+        try:
+            return root_folder.CreateFolder(new_name)
+        except vim.fault.DuplicateName as err:
+            # A parallel deploy created it between our lookup and now.
+            return err.object
 
     @staticmethod
-    def get_folder_objects(vsphere, root_folder):
-        view = VsphereHelpers.get_container_view(vsphere,
-                                       obj_type=[vim.Folder], container=root_folder)
-
-        folders = VsphereHelpers.collect_properties(vsphere,
-                                                    view_ref=view,
-                                                    obj_type=vim.Folder,
-                                                    path_set=['name', 'childEntity', 'parent'],
-                                                    include_mors=True)
+    def get_folder_objects(vsphere, root_folder, inventory=None):
+        folders = None
+        if inventory is not None:
+            folders = inventory.get_folders(root_folder)
+        if folders is None:
+            view = VsphereHelpers.get_container_view(vsphere,
+                                           obj_type=[vim.Folder], container=root_folder)
+
+            folders = VsphereHelpers.collect_properties(vsphere,
+                                                        view_ref=view,
+                                                        obj_type=vim.Folder,
+                                                        path_set=['name', 'childEntity', 'parent'],
+                                                        include_mors=True)
 
         folder_objects = [{"folder": x["obj"],
                            "child": x["childEntity"],
@@ -540,15 +1712,21 @@ class FolderHelpers(object):
         return vm_folders
 
     @staticmethod
-    def get_datacenter_folder(template_vm):
+    def get_datacenter_folder(template_vm, inventory=None):
         parent = template_vm.parent
         while type(parent) is not vim.Datacenter:
             if parent is None or not hasattr(parent, "parent"):
                 break
-            parent = parent.parent
+            if inventory is not None and inventory.get_properties(parent) is not None:
+                parent = inventory.get_properties(parent).get("parent")
+            else:
+                parent = parent.parent
             continue
 
         if parent is not None:
+            if inventory is not None and inventory.get_properties(parent) is not None:
+                dc_props = inventory.get_properties(parent)
+                return {"dc": parent, "folder": dc_props["vmFolder"], "name": dc_props["name"]}
             return {"dc": parent, "folder": parent.vmFolder, "name": parent.name}
         else:
             return None
@@ -691,14 +1869,224 @@ class pytree:
         return ",".join(rep_arr[::-1])
 
 
-def deploy_template(vsphere, vi_content, guest, template_src, cluster_name, domain, vm_cpu, vm_memory_mb, os_family, vm_disk, vm_nic, windows_product_id=None, windows_org_name=None, windows_provision_user=None, is_template=False, folder_structure=None):
-    template_vm_arr = VsphereHelpers.get_vm(vsphere, template_src)
+class CloneSpecSkeleton(object):
+    """
+    The template derived parts of a clone spec, built once per run by
+    resolve_deploy_targets: the CD-ROM edit spec, the template's disks, the
+    data disk controllers and one NIC spec per network and adapter type.
+    deploy_template takes copies and only fills in the per guest fields.
+    """
+    def __init__(self, template, template_devices):
+        self.template = template
+        self.lock = threading.Lock()
+        self._media_drive = MediaHelpers.create_media_drive_spec(template_devices)
+        self.template_disks = DiskHelpers.get_template_disks(template, template_devices)
+        self._disk_ctrls = {}
+        self._nic_specs = {}
+        self._nics = [x for x in template_devices if isinstance(x, vim.vm.device.VirtualEthernetCard)]
+
+    @staticmethod
+    def get(vi_content, template):
+        properties = VsphereHelpers.get_object_properties(vi_content, template, ["config.hardware.device"])
+        return CloneSpecSkeleton(template, properties.get("config.hardware.device") or [])
+
+    @staticmethod
+    def _copy(spec):
+        """
+        deepcopy that keeps managed object references: copying one would
+        copy its stub, connection pool and locks included.
+        """
+        memo = {}
+        pending = [spec]
+        while len(pending) > 0:
+            value = pending.pop()
+            if isinstance(value, ManagedObject):
+                memo[id(value)] = value
+            elif isinstance(value, DataObject):
+                pending.extend(getattr(value, x.name) for x in value._GetPropertyList())
+            elif isinstance(value, list):
+                pending.extend(value)
+        return copy.deepcopy(spec, memo)
+
+    def media_drive(self):
+        return self._copy(self._media_drive) if self._media_drive is not None else None
+
+    def disk_ctrl(self, bus_number=1):
+        with self.lock:
+            if bus_number not in self._disk_ctrls:
+                # The controller's key is its bus number; disks refer to it.
+                self._disk_ctrls[bus_number] = DiskHelpers.create_disk_ctrl_spec(bus_number=bus_number, control_key=bus_number)
+            return self._copy(self._disk_ctrls[bus_number])
+
+    def nic_spec(self, network_info, nic_type="vmxnet3"):
+        key = (network_info["obj"]._moId, nic_type)
+        with self.lock:
+            if key not in self._nic_specs:
+                self._nic_specs[key] = NetworkHelpers.create_nic_spec(network_info["obj"], nic_type, network_info)
+            return self._copy(self._nic_specs[key])
+
+    def nic_edit_specs(self, network_infos):
+        """
+        Specs moving the template's existing adapters, in device order, to
+        network_infos; instant clones cannot add or remove adapters. Adapters
+        beyond network_infos keep their network but, like the rest, get a
+        new MAC address.
+        """
+        if len(network_infos) > len(self._nics):
+            raise Exception("%s has %s network adapters, %s requested" % (self.template.name, len(self._nics), len(network_infos)))
+        specs = []
+        for index, nic in enumerate(self._nics):
+            spec = vim.vm.device.VirtualDeviceSpec()
+            spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
+            spec.device = self._copy(nic)
+            if index < len(network_infos):
+                spec.device.backing = self.nic_spec(network_infos[index]).device.backing
+            # Keeping the parent's MAC would put two VMs on the wire with it.
+            spec.device.macAddress = None
+            spec.device.addressType = "generated"
+            specs.append(spec)
+        return specs
+
+
+def resolve_deploy_targets(vsphere, vi_content, template_src, cluster_name, folder_structure=None, inventory=None, clone_mode="full", clone_snapshot=None, template_replicas=False, replica_arrays=None, placement_metrics=False):
+    """
+    Resolve the inventory objects shared by every guest cloned from one
+    template, so a batch pays for the lookups once. With an
+    InventorySnapshot every lookup is answered without another scan.
+    Linked clones also resolve, or create, the template snapshot; full
+    clones with template_replicas load the template's replicas. With
+    placement_metrics the load of the cluster's hosts and datastores is
+    read once, for the whole batch.
+    """
+    template_vm_arr = VsphereHelpers.get_vm(vsphere, template_src, inventory)
     if len(template_vm_arr) < 1:
         raise Exception("Could not find VM Template: %s" % template_src)
-    
-    template_vm = template_vm_arr[0]    
-    cluster = VsphereHelpers.get_obj(vi_content, [vim.ClusterComputeResource], cluster_name)
-    resource_pool = cluster.resourcePool
+
+    template_vm = template_vm_arr[0]
+    cluster = VsphereHelpers.get_obj(vi_content, [vim.ClusterComputeResource], cluster_name, inventory)
+    if cluster is None:
+        raise Exception("Could not find cluster: %s" % cluster_name)
+
+    cluster_props = inventory.get_properties(cluster) if inventory is not None else None
+    if cluster_props is not None:
+        resource_pool = cluster_props["resourcePool"]
+    else:
+        resource_pool = cluster.resourcePool
+
+    snapshot = None
+    if clone_mode == "linked":
+        snapshot = SnapshotHelpers.get_linked_clone_snapshot(vi_content, template_vm, resource_pool, clone_snapshot)
+    elif clone_mode == "instant":
+        # Instant clones fork the memory of a running (or frozen) parent.
+        parent = VsphereHelpers.get_object_properties(vi_content, template_vm, ["config.template", "runtime.powerState"])
+        if parent.get("config.template") or parent.get("runtime.powerState") != vim.VirtualMachine.PowerState.poweredOn:
+            raise Exception("Instant clone parent %s must be a powered on VM" % template_src)
+
+    replicas = None
+    if template_replicas and clone_mode == "full":
+        replicas = TemplateReplicas(vsphere, vi_content, template_vm, template_src, inventory, replica_arrays)
+
+    load = None
+    if placement_metrics:
+        load = PerfMetrics(vi_content).cluster_load(cluster)
+
+    return {"template": template_vm,
+            "cluster": cluster,
+            "resource_pool": resource_pool,
+            "cluster_networks": NetworkHelpers.get_cluster_network_index(vsphere, cluster),
+            "folder": FolderHelpers.get_congo_folder(vsphere, folder_structure, template_vm, inventory),
+            "inventory": inventory,
+            "lock": threading.Lock(),
+            "datastores": {},
+            "storage_pods": {},
+            "snapshot": snapshot,
+            "clone_mode": clone_mode,
+            "replicas": replicas,
+            "load": load,
+            "skeleton": CloneSpecSkeleton.get(vi_content, template_vm)}
+
+
+def _get_cached_target(targets, kind, name, lookup):
+    with targets["lock"]:
+        if name not in targets[kind]:
+            targets[kind][name] = lookup(name)
+        return targets[kind][name]
+
+
+class CloneRetryError(Exception):
+    """Raised when the Storage DRS clone gives up; attempts says why."""
+    def __init__(self, message, attempts):
+        super(CloneRetryError, self).__init__(message)
+        self.attempts = attempts
+
+
+# max_attempts counts every RecommendDatastores round; retryable failures
+# wait backoff_base * 2^n seconds (capped at backoff_max), half of it jitter.
+SDRS_RETRY_DEFAULTS = {"max_attempts": 5, "backoff_base": 5, "backoff_max": 60}
+
+
+def _get_error_message(err):
+    fault = _get_fault(err)
+    if isinstance(fault, vmodl.MethodFault):
+        # The str() of a fault is a multi line dump of every field.
+        if fault.msg:
+            return "%s: %s" % (fault._wsdlName, fault.msg)
+        return fault._wsdlName
+    if hasattr(err, "message") and err.message != "":
+        return str(err.message)
+    elif hasattr(err, "msg"):
+        return str(err.msg)
+    else:
+        return str(err)
+
+
+def _get_fault(err):
+    if not isinstance(err, vmodl.MethodFault) and len(getattr(err, "args", ())) > 0:
+        # wait_task raises Exception(task.info.error)
+        return err.args[0]
+    return err
+
+
+def _classify_clone_error(err):
+    """
+    Sort a failed recommend and clone round into "stale" (the recommendation
+    went out of date, ask Storage DRS again right away), "fatal" (retrying
+    cannot help) or "retryable". An InvalidArgument is only stale when it
+    names the recommendation key or a datastore; anything else is a bad
+    spec that fails the same way every time.
+    """
+    fault = _get_fault(err)
+    if isinstance(fault, vmodl.fault.InvalidArgument):
+        invalid = (fault.invalidProperty or "").split(".")[-1]
+        return "stale" if invalid in ("key", "datastore") else "fatal"
+    if isinstance(fault, (vim.fault.InvalidDatastore, vim.fault.InvalidDatastoreState)):
+        return "stale"
+    if isinstance(fault, (vim.fault.DuplicateName, vim.fault.FileAlreadyExists, vim.fault.InvalidName,
+                          vim.fault.NoPermission, vim.fault.NotAuthenticated, vim.fault.InvalidVmConfig,
+                          vim.fault.CustomizationFault, vmodl.fault.NotSupported, vmodl.fault.InvalidRequest,
+                          vmodl.fault.ManagedObjectNotFound, vmodl.fault.InvalidType,
+                          vmodl.fault.RequestCanceled)):
+        return "fatal"
+    return "retryable"
+
+
+def deploy_template(vsphere, vi_content, guest, template_src, cluster_name, domain, vm_cpu, vm_memory_mb, os_family, vm_disk, vm_nic, windows_product_id=None, windows_org_name=None, windows_provision_user=None, is_template=False, folder_structure=None, targets=None, inventory=None, sdrs_retry=None, local_placement=None, clone_mode="full", clone_snapshot=None, template_replicas=False, replica_arrays=None, timings=None, wait=True, disk_controllers=1, placement_metrics=False):
+    if timings is None:
+        timings = Timings()
+    if targets is None:
+        with timings.span("resolve_targets"):
+            targets = resolve_deploy_targets(vsphere, vi_content, template_src, cluster_name, folder_structure, inventory,
+                                             clone_mode, clone_snapshot, template_replicas, replica_arrays,
+                                             placement_metrics)
+    if local_placement is None:
+        local_placement = targets.get("local_placement")
+    # build_spec covers everything up to the clone; local_placement and
+    # customization_spec are also reported on their own.
+    spec_start = time.time()
+
+    template_vm = targets["template"]
+    resource_pool = targets["resource_pool"]
+    inventory = targets["inventory"]
 
     storage_select_spec = None
     datastore = None
@@ -706,23 +2094,32 @@ def deploy_template(vsphere, vi_content, guest, template_src, cluster_name, doma
     #Define devices
     devices = []
 
+    skeleton = targets["skeleton"]
+
     #CDROM Setup
-    media_drive = MediaHelpers.get_media_drive(vsphere, template_vm)
+    media_drive = skeleton.media_drive()
     if media_drive is not None:
         devices.append(media_drive)
 
     #NIC Setup
+    desired_networks = []
+    network_infos = []
     if vm_nic is not None:
         desired_networks = sorted(vm_nic.values(), key=operator.itemgetter("position"))
         for net in desired_networks:
-            potential_networks = [x for x in NetworkHelpers.get_network(vsphere, net["name"]) if x in cluster.network]
+            potential_networks = targets["cluster_networks"].get(net["name"], [])
             if len(potential_networks) == 1:
-                devices.append(NetworkHelpers.create_nic_spec(potential_networks[0]))
+                network_infos.append(potential_networks[0])
             elif len(potential_networks) == 0:
                 raise Exception("Could not find network named: %s attached to cluster: %s" % (net["name"], cluster_name))
             else:
                 raise Exception("Found more than one network named: %s attached to cluster: %s" % (net["name"], cluster_name))
 
+    if targets.get("clone_mode") == "instant":
+        return _instant_clone(vi_content, guest, domain, vm_disk, desired_networks, network_infos, targets, timings, spec_start, wait)
+
+    devices.extend(skeleton.nic_spec(x) for x in network_infos)
+
     #Datastore Selection
     os_disk = None
     if "os_disk" in vm_disk:
@@ -737,27 +2134,66 @@ def deploy_template(vsphere, vi_content, guest, template_src, cluster_name, doma
     desired_disk_details = []
     if not is_template:
         if len(tmp_disk.keys()) > 0:
-            devices.append(DiskHelpers.create_disk_ctrl_spec())
-            vm_disk_count = len(tmp_disk) - 1
             desired_disk_details = [DiskHelpers.get_defined_disk_info(k,tmp_disk[k]) for k in sorted(tmp_disk)]
 
-            for k, disk in enumerate(desired_disk_details):
-                disk["drive_id"] = str(k+1)
-                disk["vsphere_key"] = -(k+1)
-                devices.append(DiskHelpers.create_disk_spec(datastore=disk["datastore"], disk_type=disk["type"], size=disk["size_gb"], disk_number=disk["drive_id"], disk_key=disk["vsphere_key"]))
-
+    template_disks = skeleton.template_disks
+    placed = {}
+    if local_placement is not None:
+        with timings.span("local_placement", parent="build_spec"):
+            placed = local_placement.place(guest, os_disk, desired_disk_details, template_disks, targets)
+
+    def get_datastore(name):
+        return _get_cached_target(targets, "datastores", name,
+                                  lambda name: VsphereHelpers.get_obj(vi_content, [vim.Datastore], name, inventory))
+
+    clone_datastores = []
+    if len(desired_disk_details) > 0:
+        for bus_number in DiskHelpers.assign_controllers(desired_disk_details, disk_controllers):
+            devices.append(skeleton.disk_ctrl(bus_number))
+        vm_disk_count = len(tmp_disk) - 1
+
+        for k, disk in enumerate(desired_disk_details):
+            disk["drive_id"] = str(k+1)
+            disk["vsphere_key"] = -(k+1)
+            if disk["label"] in placed:
+                disk_datastore = placed[disk["label"]]
+                disk["datastore"] = placed[disk["label"]].name
+            elif disk["datastore"] is not None:
+                disk_datastore = get_datastore(disk["datastore"])
+            else:
+                disk_datastore = None
+            if disk_datastore is not None:
+                clone_datastores.append(disk_datastore)
+            devices.append(DiskHelpers.create_disk_spec(datastore=disk_datastore, disk_type=disk["type"], size=disk["size_gb"], disk_control_key=disk["controller"], disk_number=disk["unit_number"], disk_key=disk["vsphere_key"]))
 
     if os_disk is not None:
-        if "datastore_cluster" in os_disk:
-            storage_select_spec = VsphereHelpers.create_storage_selection_spec(vi_content, os_disk["datastore_cluster"], desired_disk_details)
+        if "os_disk" in placed:
+            datastore = placed["os_disk"]
+        elif "datastore_cluster" in os_disk:
+            storage_select_spec = VsphereHelpers.create_storage_selection_spec(vi_content, os_disk["datastore_cluster"], desired_disk_details, targets["storage_pods"], inventory)
         elif "datastore" in os_disk:
-            datastore = VsphereHelpers.get_obj(vi_content, [vim.Datastore], os_disk["datastore"])
+            datastore = get_datastore(os_disk["datastore"])
 
     relocate_spec = VsphereHelpers.create_relocation_spec(resource_pool, datastore)
+    if targets.get("load") is not None:
+        if datastore is not None:
+            clone_datastores.append(datastore)
+        relocate_spec.host = PerfMetrics.pick_host(targets["load"], clone_datastores, targets["lock"])
+    if "os_disk" in placed:
+        relocate_spec.disk = [vim.vm.RelocateSpec.DiskLocator(diskId=key, datastore=datastore) for key, capacity in template_disks]
+    if targets.get("snapshot") is not None:
+        # Linked clone: the clone's disks are child disks of the snapshot's.
+        relocate_spec.diskMoveType = "createNewChildDiskBacking"
 
     config_spec = VsphereHelpers.create_config_spec(vm_memory_mb, vm_cpu, devices)
 
+    # Copy from the replica nearest to the target, so the array can offload it.
+    source_vm = template_vm
+    if targets.get("replicas") is not None:
+        source_vm = targets["replicas"].select(datastore, storage_select_spec.storagePod if storage_select_spec is not None else None)
+
     # Not going to customize templates
+    customization_start = time.time()
     if not is_template:
         guest_family = os_family.lower()
         if "windows" not in guest_family:
@@ -766,67 +2202,1182 @@ def deploy_template(vsphere, vi_content, guest, template_src, cluster_name, doma
             customization_spec = CustomizationHelpers.create_windows_customization_spec(desired_networks, guest, windows_product_id, windows_org_name, windows_provision_user)
     else:
         customization_spec = None
+    timings.record("customization_spec", customization_start, parent="build_spec")
 
-    clone_spec = VsphereHelpers.create_clone_spec(relocate_spec, config_spec, customization_spec, is_template)
-    # Find folder logic needs to be included
-    folder = FolderHelpers.get_congo_folder(vsphere, folder_structure, template_vm)
+    clone_spec = VsphereHelpers.create_clone_spec(relocate_spec, config_spec, customization_spec, is_template, targets.get("snapshot"))
+    folder = targets["folder"]
+    timings.record("build_spec", spec_start)
 
+    if local_placement is not None:
+        try:
+            result = _clone(vsphere, vi_content, guest, source_vm, folder, clone_spec, storage_select_spec, resource_pool,
+                            vm_disk, desired_disk_details, is_template, targets, sdrs_retry, timings, wait)
+        except Exception:
+            local_placement.release(guest, consumed=False)
+            raise
+        # A submitted clone is still copying: its reservation has to outlive this call.
+        local_placement.release(guest, consumed=True, keep=not wait)
+        return result
+    return _clone(vsphere, vi_content, guest, source_vm, folder, clone_spec, storage_select_spec, resource_pool,
+                  vm_disk, desired_disk_details, is_template, targets, sdrs_retry, timings, wait)
+
+
+def _instant_clone(vi_content, guest, domain, vm_disk, desired_networks, network_infos, targets, timings, spec_start, wait=True):
+    """
+    InstantClone_Task from the running parent. The clone shares the parent's
+    disks, CPU and memory; its network identity is handed to the guest in
+    guestinfo variables instead of a customization spec.
+    """
+    os_disk = vm_disk.get("os_disk", {})
+    if len([x for x in vm_disk if x != "os_disk"]) > 0:
+        raise Exception("Instant clones share the parent's disks; data disks are not supported")
+    if "datastore_cluster" in os_disk:
+        raise Exception("Instant clones need a fixed os_disk datastore, not a datastore_cluster")
+
+    location = vim.vm.RelocateSpec()
+    location.pool = targets["resource_pool"]
+    location.folder = targets["folder"]
+    if os_disk.get("datastore") is not None:
+        location.datastore = _get_cached_target(targets, "datastores", os_disk["datastore"],
+                                                lambda name: VsphereHelpers.get_obj(vi_content, [vim.Datastore], name, targets["inventory"]))
+    location.deviceChange = targets["skeleton"].nic_edit_specs(network_infos)
+
+    spec = vim.vm.InstantCloneSpec()
+    spec.name = guest
+    spec.location = location
+    spec.config = CustomizationHelpers.create_guestinfo_config(desired_networks, domain, guest)
+    timings.record("build_spec", spec_start)
+
+    if not wait:
+        with timings.span("clone_submit", mode="instant"):
+            task = targets["template"].InstantClone_Task(spec=spec)
+        return {"vm": guest, "disk": {}, "task": task._moId}
+    with timings.span("clone_task", mode="instant"):
+        task = targets["template"].InstantClone_Task(spec=spec)
+        vm = VsphereHelpers.wait_task(task, 'VM instant clone task')
+    return {"vm": guest, "disk": {}, "moid": _cloned_vm_id(vi_content, location.folder, guest, vm)}
+
+
+def _clone(vsphere, vi_content, guest, template_vm, folder, clone_spec, storage_select_spec, resource_pool, vm_disk, desired_disk_details, is_template, targets, sdrs_retry, timings=None, wait=True):
+    """
+    Clone through Storage DRS when storage_select_spec is set, straight
+    from template_vm otherwise. Without wait the clone task is only
+    submitted and its MoRef ID returned as "task"; Storage DRS errors up to
+    the submission are still retried.
+    """
+    if timings is None:
+        timings = Timings()
     if storage_select_spec is not None:
         storage_placement_spec = VsphereHelpers.create_storage_placement_spec(guest, folder, storage_select_spec, template_vm, clone_spec, resource_pool)
+        retry = dict(SDRS_RETRY_DEFAULTS)
+        if sdrs_retry is not None:
+            retry.update((k, v) for k, v in sdrs_retry.items() if v is not None)
+        if retry["max_attempts"] < 1:
+            raise Exception("Storage DRS max_attempts must be at least 1")
+
         errors = []
-        clone_attempt = 0
+        attempts = []
+        backoffs = 0
         clone_result = None
-        while clone_attempt < 3:
-            clone_attempt += 1
+        while len(attempts) < retry["max_attempts"]:
+            attempt = {"attempt": len(attempts) + 1}
+            attempts.append(attempt)
+            attempt_timings = timings.child(attempt=attempt["attempt"])
             try:
-                clone_result = _recommend_and_clone(vi_content, storage_placement_spec, vm_disk, desired_disk_details, is_template)
+                if targets.get("placement_planner") is not None:
+                    clone_result = targets["placement_planner"].recommend_and_clone(storage_placement_spec, vm_disk, desired_disk_details, is_template, attempt_timings)
+                else:
+                    clone_result = _recommend_and_clone(vi_content, storage_placement_spec, vm_disk, desired_disk_details, is_template, attempt_timings, wait)
+                attempt["result"] = "cloned"
                 break
             except Exception as err:
-                if hasattr(err, "message") and err.message != "":
-                    message = str(err.message)
-                elif hasattr(err, "msg"):
-                    message = str(err.msg)
-                else:
-                    message = str(err)
+                message = _get_error_message(err)
 
                 if "DuplicateName" in message and is_template:
+                    try:
+                        sources = [targets["template"]]
+                        if targets.get("replicas") is not None:
+                            sources.extend(x["vm"] for x in targets["replicas"].replicas)
+                        with attempt_timings.span("competing_clone_wait"):
+                            _wait_for_competing_clone(vsphere, vi_content, sources, guest, folder)
+                    except Exception as competing_err:
+                        attempt["cause"] = "Competing clone failed: %s" % _get_error_message(competing_err)
+                        attempt["result"] = "fatal"
+                        errors.append(attempt["cause"])
+                        break
                     # def clone_result():
                     #     vm = guest
                     clone_result = lambda: None
                     setattr(clone_result, "vm", guest)
-                    time.sleep(360)
+                    attempt["result"] = "duplicate"
                     break
                 if message not in errors:
                     errors.append(message)
 
-                time.sleep(60)
+                attempt["cause"] = message
+                attempt["result"] = _classify_clone_error(err)
                 clone_result = None
+                if attempt["result"] == "fatal" or len(attempts) >= retry["max_attempts"]:
+                    break
 
+                # A stale recommendation only needs a fresh RecommendDatastores;
+                # anything else backs off exponentially with jitter.
+                if attempt["result"] == "stale":
+                    delay = 0
+                else:
+                    ceiling = min(retry["backoff_max"], retry["backoff_base"] * 2 ** backoffs)
+                    delay = ceiling / 2.0 + random.uniform(0, ceiling / 2.0)
+                    backoffs += 1
+                attempt["delay"] = round(delay, 3)
+                if delay > 0:
+                    with attempt_timings.span("sdrs_backoff"):
+                        time.sleep(delay)
+
+        if isinstance(clone_result, vim.Task):
+            return {"vm": guest, "disk": _convert_disk_list_to_dict(desired_disk_details), "sdrs_attempts": attempts,
+                    "task": clone_result._moId}
         if clone_result is not None and hasattr(clone_result, "vm"):
-            return {"vm": guest, "disk": _convert_disk_list_to_dict(desired_disk_details)}
+            return {"vm": guest, "disk": _convert_disk_list_to_dict(desired_disk_details), "sdrs_attempts": attempts,
+                    "moid": _cloned_vm_id(vi_content, folder, guest, clone_result.vm)}
         else:
-            raise Exception("Could not clone VM after %s attempts: %s" % (clone_attempt, json.dumps(errors)))
+            raise CloneRetryError("Could not clone VM after %s attempts: %s" % (len(attempts), json.dumps(errors)), attempts)
     else:
+        if not wait:
+            with timings.span("clone_submit"):
+                task = template_vm.Clone(folder=folder, name=guest, spec=clone_spec)
+            return {"vm": guest, "disk": _convert_disk_list_to_dict(desired_disk_details), "task": task._moId}
         # fire the clone task
-        task = template_vm.Clone(folder=folder, name=guest, spec=clonespec)
-        result = VsphereHelpers.wait_task(task, 'VM clone task')
-        return {"vm": guest, "disk": _convert_disk_list_to_dict(desired_disk_details)}
+        with timings.span("clone_task"):
+            task = template_vm.Clone(folder=folder, name=guest, spec=clone_spec)
+            result = VsphereHelpers.wait_task(task, 'VM clone task')
+        return {"vm": guest, "disk": _convert_disk_list_to_dict(desired_disk_details),
+                "moid": _cloned_vm_id(vi_content, folder, guest, result)}
+
+
+def _cloned_vm_id(vi_content, folder, guest, vm):
+    """
+    MoRef ID of the clone guest: vm when the clone task returned it,
+    otherwise a SearchIndex FindChild in folder (batched Storage DRS
+    clones and competing runs only name the VM).
+    """
+    if not isinstance(vm, vim.VirtualMachine):
+        vm = vi_content.searchIndex.FindChild(folder, guest)
+    return vm._moId if vm is not None else None
+
+
+def deploy_guests(vsphere, vi_content, guests, defaults, max_in_flight=4, inventory=None, batch_placement=True, local_placement=None, timings=None):
+    """
+    Clone every entry of guests from one template, sharing the session and
+    the resolved template, cluster, folder, network and datastore objects.
+    Each entry is a dict holding at least "guest"; vm_nic, vm_disk, vm_cpu,
+    vm_memory_mb and vm_domain override the values in defaults. At most
+    max_in_flight clones are running at any time. With batch_placement the
+    Storage DRS placements of concurrent clones go through one
+    StoragePlacementPlanner; a LocalPlacement replaces Storage DRS.
+    Returns a list of per guest result dicts in the order of guests; each
+    has the guest's own spans under timings.
+    """
+    duplicates = _duplicate_guests(guests)
+    if len(duplicates) > 0:
+        # Two workers would race to clone the same name.
+        raise Exception("Guests listed more than once: %s" % ", ".join(duplicates))
+    if timings is None:
+        timings = Timings()
+    if inventory is None:
+        with timings.span("inventory"):
+            inventory = InventorySnapshot(vsphere)
+    with timings.span("resolve_targets"):
+        targets = resolve_deploy_targets(vsphere, vi_content, defaults["template_src"],
+                                         defaults["cluster_name"], defaults["folder_structure"], inventory,
+                                         defaults.get("clone_mode", "full"), defaults.get("clone_snapshot"),
+                                         defaults.get("template_replicas", False), defaults.get("replica_arrays"),
+                                         defaults.get("placement_metrics", False))
+    existing = set(VsphereHelpers.get_vm_names(vsphere, inventory))
+    if local_placement is not None:
+        targets["local_placement"] = local_placement
+    elif batch_placement:
+        targets["placement_planner"] = StoragePlacementPlanner(vsphere, vi_content, wait=defaults.get("wait", True))
+
+    results = [None] * len(guests)
+    pending = queue.Queue()
+    for position, entry in enumerate(guests):
+        pending.put((position, entry))
+
+    def worker():
+        while True:
+            try:
+                position, entry = pending.get_nowait()
+            except queue.Empty:
+                return
+            results[position] = _deploy_guest(vsphere, vi_content, entry, defaults, targets, existing, timings)
 
+    workers = [threading.Thread(target=worker) for x in range(max(1, min(int(max_in_flight), len(guests))))]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
 
-def _recommend_and_clone(vi_content, storage_placement_spec, vm_disk, desired_disk_details, is_template):
-    rec_result = vi_content.storageResourceManager.RecommendDatastores(storage_placement_spec)
+    return results
+
+
+def _duplicate_guests(guests):
+    """Names that appear in more than one entry of guests, sorted."""
+    return [name for name, group in itertools.groupby(sorted(x["guest"] for x in guests)) if len(list(group)) > 1]
+
+
+def _deploy_guest(vsphere, vi_content, entry, defaults, targets, existing, timings):
+    guest = entry["guest"]
+    guest_timings = timings.child(guest=guest)
+    params = copy.deepcopy(defaults)
+    for key in ("vm_nic", "vm_disk", "vm_cpu", "vm_memory_mb", "vm_domain"):
+        if entry.get(key) is not None:
+            params[key] = copy.deepcopy(entry[key])
+
+    result = {"guest": guest, "changed": False, "failed": False}
+    start_time = time.time()
+    try:
+        if guest in existing:
+            if not params["is_template"]:
+                result["failed"] = True
+                result["msg"] = "Found existing VM with name %s" % guest
+            return result
+
+        result["changes"] = deploy_template(vsphere=vsphere,
+                                            vi_content=vi_content,
+                                            guest=guest,
+                                            template_src=params["template_src"],
+                                            cluster_name=params["cluster_name"],
+                                            domain=params["vm_domain"],
+                                            vm_cpu=params["vm_cpu"],
+                                            vm_memory_mb=params["vm_memory_mb"],
+                                            os_family=params["os_family"],
+                                            vm_disk=params["vm_disk"],
+                                            vm_nic=params["vm_nic"],
+                                            windows_product_id=params["windows_product_id"],
+                                            windows_org_name=params["windows_org_name"],
+                                            windows_provision_user=params["windows_provision_user"],
+                                            is_template=params["is_template"],
+                                            folder_structure=params["folder_structure"],
+                                            targets=targets,
+                                            sdrs_retry=params.get("sdrs_retry"),
+                                            timings=guest_timings,
+                                            wait=params.get("wait", True),
+                                            disk_controllers=params.get("disk_controllers", 1))
+        result["changed"] = True
+    except Exception as err:
+        result["failed"] = True
+        result["msg"] = str(err)
+        if isinstance(err, CloneRetryError):
+            result["sdrs_attempts"] = err.attempts
+    finally:
+        guest_timings.record("deploy", start_time)
+        result["seconds"] = round(time.time() - start_time, 3)
+        result["timings"] = guest_timings.spans
+    return result
+
+
+def load_inventory(vsphere, inventory_cache_dir, vcenter_hostname, vcenter_username):
+    """
+    InventoryIndex synced from inventory_cache_dir when a cache directory
+    is configured, a fresh InventorySnapshot otherwise.
+    """
+    if inventory_cache_dir:
+        return InventoryIndex(vsphere, inventory_cache_dir, vcenter_hostname, vcenter_username).sync()
+    return InventorySnapshot(vsphere)
+
+
+class StoragePlacementPlanner(object):
+    """
+    Batches the Storage DRS placements of concurrent deploy_template calls.
+    Every caller asks RecommendDatastores on its own thread, then waits
+    until all callers that have started asking have their
+    recommendations in (or gather_seconds passed). One of them picks a recommendation per VM
+    against a single free space snapshot of the candidate datastores,
+    charging each pick to its datastore so the batch spreads over the pod
+    instead of piling onto the emptiest member, and applies all picks with
+    one ApplyStorageDrsRecommendation_Task.
+    VMs whose disks need recommendations from more than one pod are
+    placed one at a time as before. Without wait every VM of a batch gets
+    the batch's task back instead of waiting for it.
+    """
+    def __init__(self, vsphere, vi_content, gather_seconds=10, wait=True):
+        self.vsphere = vsphere
+        self.vi_content = vi_content
+        self.gather_seconds = gather_seconds
+        self.wait = wait
+        self.lock = threading.Condition(threading.Lock())
+        self.apply_lock = threading.Lock()
+        self.active = 0
+        self.waiting = []
+        self.space = {}
+        self.planned = {}
+        self.batches = 0
+
+    def recommend_and_clone(self, storage_placement_spec, vm_disk, desired_disk_details, is_template, timings=None):
+        if timings is None:
+            timings = Timings()
+        if not is_template:
+            needed_rec_length = len(set([x["datastore_cluster"] for x in vm_disk.values()]))
+        else:
+            needed_rec_length = 1
+        if needed_rec_length != 1:
+            return _recommend_and_clone(self.vi_content, storage_placement_spec, vm_disk, desired_disk_details, is_template, timings, self.wait)
+
+        with self.lock:
+            self.active += 1
+        return self._gather(storage_placement_spec, desired_disk_details, timings)
+
+    def _gather(self, storage_placement_spec, desired_disk_details, timings):
+        """
+        active counts the callers that are asking or waiting for a batch;
+        a caller leaves it once its request is handed to a batch, so the
+        next batch does not wait for clones that are already running.
+        """
+        try:
+            with timings.span("sdrs_recommend"):
+                rec_result = self.vi_content.storageResourceManager.RecommendDatastores(storage_placement_spec)
+        except Exception:
+            with self.lock:
+                self.active -= 1
+                self.lock.notify_all()
+            raise
+        request = {"guest": storage_placement_spec.cloneName,
+                   "folder": storage_placement_spec.folder,
+                   "recommendations": rec_result.recommendations or [],
+                   "drive_ids": [int(x["vsphere_key"]) for x in desired_disk_details],
+                   "size": sum([int(x.get("size_gb") or 0) for x in desired_disk_details]) * 1024 ** 3,
+                   "done": False}
+
+        # A batched guest's clone_task span includes gathering the batch.
+        wait_start = time.time()
+        deadline = time.time() + self.gather_seconds
+        with self.lock:
+            self.waiting.append(request)
+            self.lock.notify_all()
+            while not request["done"]:
+                if len(self.waiting) > 0 and (len(self.waiting) >= self.active or time.time() >= deadline):
+                    batch = self.waiting
+                    self.waiting = []
+                    self.active -= len(batch)
+                    self.lock.release()
+                    try:
+                        self._apply(batch)
+                    finally:
+                        self.lock.acquire()
+                        self.lock.notify_all()
+                else:
+                    self.lock.wait(max(0.1, deadline - time.time()))
+        timings.record("clone_task" if self.wait else "clone_submit", wait_start, batch=True)
+
+        if request["error"] is not None:
+            raise request["error"]
+        return request["result"]
+
+    def _apply(self, batch):
+        """
+        Pick and submit under apply_lock, so batches charge the free space
+        snapshot one after the other, then wait for the clones outside it
+        so the next batch can start meanwhile.
+        """
+        with self.apply_lock:
+            try:
+                self._pick(batch)
+            except Exception as err:
+                for request in batch:
+                    request.update(error=err, done=True)
+                return
+            task, error = self._submit(batch)
+
+        if task is not None and error is None and self.wait:
+            try:
+                VsphereHelpers.wait_task(task)
+            except Exception as err:
+                error = err
+
+        created = set()
+        if error is not None:
+            # One bad key fails the whole task; keep the clones that made it.
+            created = set(x["guest"] for x in batch
+                          if self.vi_content.searchIndex.FindChild(x["folder"], x["guest"]) is not None)
+        with self.apply_lock:
+            self._finish(batch, task, error, created)
+
+    def _submit(self, batch):
+        keys = [request["key"] for request in batch if request["key"] is not None]
+        if len(keys) == 0:
+            return None, None
+        self.batches += 1
+        try:
+            return self.vi_content.storageResourceManager.ApplyStorageDrsRecommendation_Task(keys), None
+        except Exception as err:
+            return None, err
+
+    def _finish(self, batch, task, error, created):
+        for request in batch:
+            if request["key"] is None:
+                request.update(error=Exception("Storage DRS returned no recommendation for %s" % request["guest"]), result=None)
+            elif error is None and not self.wait:
+                request.update(error=None, result=task)
+            elif error is None or request["guest"] in created:
+                clone_result = lambda: None
+                setattr(clone_result, "vm", request["guest"])
+                request.update(error=None, result=clone_result)
+            else:
+                self._unplan(request)
+                request.update(error=error, result=None)
+            request["done"] = True
+
+    def _pick(self, batch):
+        destinations = {}
+        for request in batch:
+            for recommendation in request["recommendations"]:
+                for action in recommendation.action:
+                    destination = getattr(action, "destination", None)
+                    if destination is not None:
+                        destinations[destination._moId] = destination
+        missing = [x for x in destinations.values() if x._moId not in self.space]
+        if len(missing) > 0:
+            self.space.update(VsphereHelpers.get_datastore_space(self.vi_content, missing))
+
+        for request in batch:
+            request["key"] = None
+            best = None
+            for recommendation in request["recommendations"]:
+                if not self._covers(recommendation, request["drive_ids"]):
+                    continue
+                demand = {}
+                for action in recommendation.action:
+                    destination = getattr(action, "destination", None)
+                    if destination is None:
+                        continue
+                    demand[destination._moId] = demand.get(destination._moId, 0) + self._get_action_size(action, request)
+                headroom = min([self.space.get(x, {}).get("free", 0) - self.planned.get(x, 0) - y for x, y in demand.items()] or [0])
+                if best is None or headroom > best[0]:
+                    best = (headroom, recommendation.key, demand)
+            if best is not None:
+                request["key"] = best[1]
+                request["demand"] = best[2]
+                for moid, size in best[2].items():
+                    self.planned[moid] = self.planned.get(moid, 0) + size
+
+    @staticmethod
+    def _covers(recommendation, drive_ids):
+        """A recommendation that places the whole VM, every new disk included."""
+        placed = set()
+        for action in recommendation.action:
+            relocate_spec = getattr(action, "relocateSpec", None)
+            if relocate_spec is None:
+                return False
+            if len(relocate_spec.disk) == 0:
+                return True
+            placed.update(x.diskId for x in relocate_spec.disk)
+        return set(drive_ids) <= placed
+
+    def _unplan(self, request):
+        for moid, size in request.get("demand", {}).items():
+            self.planned[moid] = self.planned.get(moid, 0) - size
+
+    def _get_action_size(self, action, request):
+        # Storage DRS reports the placement as a utilization change of the
+        # destination; fall back to the requested disk sizes without it.
+        capacity = self.space.get(action.destination._moId, {}).get("capacity", 0)
+        before = getattr(action, "spaceUtilBefore", None)
+        after = getattr(action, "spaceUtilAfter", None)
+        if capacity and before is not None and after is not None and after > before:
+            return max(int((after - before) / 100.0 * capacity), request["size"])
+        return request["size"]
+
+
+class LocalPlacement(object):
+    """
+    Client side stand-in for Storage DRS: picks a member of the requested
+    datastore cluster for the OS disk and every data disk without a
+    RecommendDatastores round trip.
+    Each pod is read once (free space, capacity and provisioned bytes) and
+    each disk goes to the member it fits most tightly on, keeping
+    min_free_pct of the capacity free and provisioned bytes under
+    max_overcommit times the capacity. Space handed to clones that are
+    still running is held as a reservation; with reservation_file the
+    reservations are shared, under an flock, with other module runs.
+    When the targets carry the cluster's load (PerfMetrics), members whose
+    read plus write latency is above max_latency_ms are only used when no
+    other member fits.
+    """
+    def __init__(self, vi_content, reservation_file=None, min_free_pct=10, max_overcommit=2.0, reservation_seconds=7200, max_latency_ms=20):
+        self.vi_content = vi_content
+        self.reservation_file = os.path.expanduser(reservation_file) if reservation_file else None
+        self.min_free_pct = min_free_pct
+        self.max_overcommit = max_overcommit
+        self.reservation_seconds = reservation_seconds
+        self.max_latency_ms = max_latency_ms
+        self.lock = threading.Lock()
+        self.pods = {}
+        self.reservations = []
+        self.placed = {}
+        self.charged = set()
+        about = vi_content.about
+        self.vcenter_id = getattr(about, "instanceUuid", None) or about.name
+
+    @contextmanager
+    def _locked_reservations(self):
+        """
+        Yields the live reservation list; changes made to it in place are
+        saved when the block finishes without an exception.
+        """
+        with self.lock:
+            if self.reservation_file is None:
+                now = time.time()
+                self.reservations[:] = [x for x in self.reservations if x["expires"] > now]
+                yield self.reservations
+                return
+
+            if fcntl is None:
+                raise Exception("placement_reservation_file needs fcntl")
+            directory = os.path.dirname(self.reservation_file)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            handle = os.fdopen(os.open(self.reservation_file, os.O_RDWR | os.O_CREAT, 0o600), "r+")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+                handle.seek(0)
+                try:
+                    reservations = json.loads(handle.read() or "[]")
+                except ValueError:
+                    reservations = []
+                now = time.time()
+                reservations = [x for x in reservations if x["expires"] > now]
+                yield reservations
+                handle.seek(0)
+                handle.truncate()
+                handle.write(json.dumps(reservations))
+                handle.flush()
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+                handle.close()
+
+    def _get_members(self, pod_name, targets):
+        pod = _get_cached_target(targets, "storage_pods", pod_name,
+                                 lambda name: VsphereHelpers.get_obj(self.vi_content, [vim.StoragePod], name, targets["inventory"]))
+        if pod is None:
+            raise Exception("Could not find datastore cluster: %s" % pod_name)
+        with self.lock:
+            if pod._moId not in self.pods:
+                self.pods[pod._moId] = VsphereHelpers.get_pod_datastores(self.vi_content, pod)
+            return self.pods[pod._moId]
+
+    def place(self, guest, os_disk, desired_disk_details, template_disks, targets):
+        """
+        Returns:
+            A dict of "os_disk" or a data disk label to the vim.Datastore
+            chosen for it, for every disk that asks for a datastore_cluster
+        """
+        demands = []
+        if os_disk is not None and os_disk.get("datastore_cluster"):
+            demands.append(("os_disk", os_disk["datastore_cluster"], sum([capacity for key, capacity in template_disks])))
+        for disk in desired_disk_details:
+            if disk["datastore_cluster"] is not None:
+                demands.append((disk["label"], disk["datastore_cluster"], disk["size_gb"] * 1024 ** 3))
+        if len(demands) == 0:
+            return {}
+
+        members = dict((pod_name, self._get_members(pod_name, targets)) for label, pod_name, size in demands)
+        latency = {}
+        if targets.get("load") is not None:
+            latency = dict((x["moid"], x["load"]) for x in targets["load"]["datastores"] if x["load"] is not None)
+        placed = {}
+        mine = []
+        with self._locked_reservations() as reservations:
+            reserved = {}
+            for reservation in reservations:
+                if reservation["guest"] in self.charged:
+                    # Already in the cached pod figures.
+                    continue
+                reserved[reservation["datastore"]] = reserved.get(reservation["datastore"], 0) + reservation["bytes"]
+
+            for label, pod_name, size in demands:
+                best = None
+                for member in members[pod_name]:
+                    if not member["accessible"] or member["maintenance_mode"] != "normal":
+                        continue
+                    key = "%s/%s" % (self.vcenter_id, member["obj"]._moId)
+                    taken = reserved.get(key, 0) + size
+                    left = member["free"] - taken - member["capacity"] * self.min_free_pct / 100.0
+                    if left < 0 or member["provisioned"] + taken > member["capacity"] * self.max_overcommit:
+                        continue
+                    slow = latency.get(member["obj"]._moId, 0) > self.max_latency_ms
+                    if best is None or (slow, left) < (best[3], best[0]):
+                        best = (left, key, member, slow)
+                if best is None:
+                    raise Exception("No datastore in %s has %s GB free for %s of %s" % (pod_name, size / 1024 ** 3, label, guest))
+
+                reserved[best[1]] = reserved.get(best[1], 0) + size
+                mine.append({"guest": guest, "datastore": best[1], "bytes": size,
+                             "expires": time.time() + self.reservation_seconds,
+                             "member": best[2]})
+                placed[label] = best[2]["obj"]
+
+            reservations.extend(dict((k, v) for k, v in x.items() if k != "member") for x in mine)
+        self.placed[guest] = mine
+        return placed
+
+    def release(self, guest, consumed=True, keep=False):
+        """
+        Drop the reservations of guest. When the clone consumed the space,
+        the cached pod figures are charged with it, as vCenter's own
+        figures were read before the clone. With keep (a clone that was
+        only submitted) the reservations stay until reservation_seconds
+        expires them, since other runs cannot see the space the running
+        clone will take; only the cached figures are charged.
+        """
+        mine = self.placed.pop(guest, [])
+        if len(mine) == 0:
+            return
+        if keep:
+            with self.lock:
+                self.charged.add(guest)
+                for reservation in mine:
+                    reservation["member"]["free"] -= reservation["bytes"]
+                    reservation["member"]["provisioned"] += reservation["bytes"]
+            return
+        with self._locked_reservations() as reservations:
+            reservations[:] = [x for x in reservations if x["guest"] != guest]
+            if consumed:
+                for reservation in mine:
+                    reservation["member"]["free"] -= reservation["bytes"]
+                    reservation["member"]["provisioned"] += reservation["bytes"]
+
+
+class PerfMetrics(object):
+    """
+    Live load from PerformanceManager. Counter names (group.name.rollup,
+    e.g. cpu.usage.average) are resolved to counter IDs with one read of
+    perfCounter per instance; a run creates one. query()
+    asks for many entities and counters in one QueryPerf of the realtime
+    samples, as CSV to keep the response small.
+    """
+    HOST_COUNTERS = ["cpu.usage.average", "mem.usage.average"]
+    DATASTORE_COUNTERS = ["datastore.totalReadLatency.average", "datastore.totalWriteLatency.average"]
+    REALTIME_INTERVAL = 20
+    # Projected cpu.usage percent a host gains from each clone placed on it.
+    CLONE_LOAD = 10
+
+    def __init__(self, vi_content):
+        self.vi_content = vi_content
+        self._counters = None
+
+    def counters(self, names):
+        """
+        Returns:
+            A dict of counter name to (counter ID, unit)
+        """
+        if self._counters is None:
+            infos = VsphereHelpers.get_object_properties(self.vi_content, self.vi_content.perfManager, ["perfCounter"]).get("perfCounter") or []
+            self._counters = dict(("%s.%s.%s" % (x.groupInfo.key, x.nameInfo.key, x.rollupType), (x.key, x.unitInfo.key)) for x in infos)
+        known = self._counters
+        missing = [x for x in names if x not in known]
+        if len(missing) > 0:
+            raise Exception("Unknown performance counters: %s" % ", ".join(missing))
+        return dict((x, known[x]) for x in names)
+
+    def query(self, entities, counters, samples=3, instances=None):
+        """
+        The latest realtime samples of counters for every entity in one
+        QueryPerf.
+        Args:
+            instances (dict): Counter name to the instance to read; "" (the
+                              entity's aggregate) by default, "*" for all
+        Returns:
+            A dict of entity moId to {counter name: {instance: [values]}},
+            oldest sample first; samples vCenter has no data for are left out
+        """
+        if len(entities) == 0 or len(counters) == 0:
+            return {}
+        ids = self.counters(counters)
+        names = dict((counter_id, name) for name, (counter_id, unit) in ids.items())
+        metric_ids = [vim.PerformanceManager.MetricId(counterId=ids[x][0], instance=(instances or {}).get(x, ""))
+                      for x in counters]
+        specs = [vim.PerformanceManager.QuerySpec(entity=x, metricId=metric_ids, intervalId=self.REALTIME_INTERVAL,
+                                                  maxSample=samples, format="csv")
+                 for x in entities]
+
+        data = {}
+        for entity_metric in self.vi_content.perfManager.QueryPerf(querySpec=specs) or []:
+            series = data.setdefault(entity_metric.entity._moId, {})
+            for value in entity_metric.value or []:
+                # -1 marks a sample with no data.
+                values = [int(x) for x in (value.value or "").split(",") if x != "" and int(x) >= 0]
+                series.setdefault(names.get(value.id.counterId), {})[value.id.instance or ""] = values
+        return data
+
+    def cluster_load(self, cluster, counters=None, samples=3):
+        """
+        Load of a cluster's hosts and datastores from one QueryPerf on the
+        hosts: counters of the datastore group come with one instance per
+        datastore the host mounts, named by the UUID in the datastore's
+        URL, and a datastore's series is the worst host's.
+        Returns:
+            A dict with the interval, the units and, sorted by name, the
+            hosts and datastores with their series and a "load" figure:
+            mean cpu.usage.average in percent for hosts, mean read plus
+            write latency in milliseconds for datastores. "objects" maps
+            moIds to the managed objects. Datastore rows list the moIds
+            of the hosts that have them mounted and accessible as "hosts".
+        """
+        if counters is None:
+            counters = self.HOST_COUNTERS + self.DATASTORE_COUNTERS
+        cluster_props = VsphereHelpers.get_object_properties(self.vi_content, cluster, ["host", "datastore"])
+        hosts = cluster_props.get("host") or []
+        datastores = cluster_props.get("datastore") or []
+        host_props = VsphereHelpers.get_objects_properties(self.vi_content, hosts, ["name", "runtime.connectionState"])
+        datastore_props = VsphereHelpers.get_objects_properties(self.vi_content, datastores, ["name", "summary.url", "host"])
+        units = dict((name, unit) for name, (counter_id, unit) in self.counters(counters).items())
+        instances = dict((x, "*") for x in counters if x.startswith("datastore."))
+        data = self.query(hosts, counters, samples, instances)
+
+        by_uuid = dict(((props.get("summary.url") or "").rstrip("/").split("/")[-1], moid)
+                       for moid, props in datastore_props.items())
+        host_rows = []
+        datastore_series = dict((x, {}) for x in datastore_props)
+        for host in hosts:
+            row = {"name": host_props[host._moId].get("name"), "moid": host._moId,
+                   "connected": host_props[host._moId].get("runtime.connectionState", "connected") == "connected"}
+            for counter, series in data.get(host._moId, {}).items():
+                if counter in instances:
+                    for instance, values in series.items():
+                        merged = datastore_series.get(by_uuid.get(instance))
+                        if merged is None:
+                            continue
+                        previous = merged.get(counter, [])
+                        merged[counter] = [max(x) for x in zip(previous, values)] if previous else values
+                else:
+                    row[counter] = series.get("", [])
+            cpu = row.get("cpu.usage.average") or []
+            # cpu.usage is reported in hundredths of a percent.
+            row["load"] = round(sum(cpu) / 100.0 / len(cpu), 2) if cpu else None
+            host_rows.append(row)
+
+        datastore_rows = []
+        for moid, series in datastore_series.items():
+            row = {"name": datastore_props[moid].get("name"), "moid": moid,
+                   "hosts": sorted(x.key._moId for x in datastore_props[moid].get("host") or []
+                                   if x.mountInfo.accessible is not False and x.mountInfo.mounted is not False)}
+            row.update(series)
+            latency = [sum(x) / float(len(x)) for x in [series.get(y) for y in self.DATASTORE_COUNTERS] if x]
+            row["load"] = round(sum(latency), 2) if latency else None
+            datastore_rows.append(row)
+
+        return {"interval": self.REALTIME_INTERVAL,
+                "units": units,
+                "hosts": sorted(host_rows, key=lambda x: x["name"]),
+                "datastores": sorted(datastore_rows, key=lambda x: x["name"]),
+                "objects": dict([(x._moId, x) for x in hosts] + [(x._moId, x) for x in datastores])}
+
+    @staticmethod
+    def pick_host(load, datastores=None, lock=None):
+        """
+        The connected host, among those mounting every one of datastores
+        that load knows, with the lowest projected load: its measured load
+        plus CLONE_LOAD for each clone already picked for it from this
+        load. None when no host qualifies, leaving the choice to vCenter.
+        """
+        with lock or threading.Lock():
+            hosts = [x for x in load["hosts"] if x["connected"]]
+            mounts = dict((x["moid"], set(x["hosts"])) for x in load["datastores"])
+            for datastore in datastores or []:
+                if datastore._moId in mounts:
+                    hosts = [x for x in hosts if x["moid"] in mounts[datastore._moId]]
+            if len(hosts) == 0:
+                return None
+            host = min(hosts, key=lambda x: ((x["load"] if x["load"] is not None else 100) + x.get("picks", 0) * PerfMetrics.CLONE_LOAD,
+                                             x.get("picks", 0), x["name"]))
+            host["picks"] = host.get("picks", 0) + 1
+            return load["objects"][host["moid"]]
+
+
+class TemplateReplicas(object):
+    """
+    Copies of a template on other datastores, named <template>@<datastore>,
+    so a clone can copy from a replica on the target datastore (or another
+    datastore of the same array, per arrays: datastore name -> array name)
+    and the array can offload the copy. Each replica records the master's
+    config.changeVersion it was made from in its extraConfig; replicas that
+    are behind the master are not used. sync() creates and refreshes them.
+    """
+    SEPARATOR = "@"
+    VERSION_KEY = "template_replica.change_version"
+
+    def __init__(self, vsphere, vi_content, template, template_name, inventory=None, arrays=None):
+        self.vsphere = vsphere
+        self.vi_content = vi_content
+        self.template = template
+        self.template_name = template_name
+        self.inventory = inventory
+        self.lock = threading.Lock()
+        self.pods = {}
+        self.arrays = {}
+        for datastore_name, array in (arrays or {}).items():
+            datastore = VsphereHelpers.get_obj(vi_content, [vim.Datastore], datastore_name, inventory)
+            if datastore is not None:
+                self.arrays[datastore._moId] = array
+        self.load()
+
+    @staticmethod
+    def replica_name(template_name, datastore_name):
+        return "%s%s%s" % (template_name, TemplateReplicas.SEPARATOR, datastore_name)
+
+    def _find_replica_vms(self):
+        prefix = self.template_name + self.SEPARATOR
+        if self.inventory is not None:
+            names = [x for x in VsphereHelpers.get_vm_names(self.vsphere, self.inventory) if x.startswith(prefix)]
+            return [(name, vm) for name in names for vm in VsphereHelpers.get_vm(self.vsphere, name, self.inventory)]
+
+        view = VsphereHelpers.get_container_view(self.vsphere, obj_type=[vim.VirtualMachine])
+        vm_data = VsphereHelpers.collect_properties(self.vsphere, view_ref=view, obj_type=vim.VirtualMachine,
+                                                    path_set=["name"], include_mors=True)
+        return [(x["name"], x["obj"]) for x in vm_data if x["name"].startswith(prefix)]
+
+    def load(self):
+        """Read the master's and every replica's version and datastores in one call."""
+        found = self._find_replica_vms()
+        properties = VsphereHelpers.get_objects_properties(self.vi_content, [self.template] + [vm for name, vm in found],
+                                                           ["config.changeVersion", "config.extraConfig", "datastore", "parent"])
+        master = properties[self.template._moId]
+        self.master_version = master.get("config.changeVersion")
+        self.master_folder = master.get("parent")
+        self.replicas = []
+        for name, vm in found:
+            replica = properties[vm._moId]
+            versions = [x.value for x in replica.get("config.extraConfig") or [] if x.key == self.VERSION_KEY]
+            self.replicas.append({"name": name,
+                                  "vm": vm,
+                                  "datastores": [x._moId for x in replica.get("datastore") or []],
+                                  "version": versions[0] if len(versions) > 0 else None})
+        return self
+
+    def in_sync(self):
+        return [x for x in self.replicas if x["version"] == self.master_version and not x["name"].endswith(".sync")]
+
+    def _pod_members(self, pod):
+        with self.lock:
+            if pod._moId not in self.pods:
+                self.pods[pod._moId] = [x["obj"]._moId for x in VsphereHelpers.get_pod_datastores(self.vi_content, pod)]
+            return self.pods[pod._moId]
+
+    def select(self, datastore=None, pod=None):
+        """
+        The in sync replica on datastore (or on a member of pod), else one
+        on the same array, else the master template.
+        """
+        if datastore is not None:
+            targets = [datastore._moId]
+        elif pod is not None:
+            targets = self._pod_members(pod)
+        else:
+            return self.template
+
+        replicas = self.in_sync()
+        for replica in replicas:
+            if len(set(replica["datastores"]) & set(targets)) > 0:
+                return replica["vm"]
+        arrays = set(self.arrays[x] for x in targets if x in self.arrays)
+        for replica in replicas:
+            if len(arrays & set(self.arrays.get(x) for x in replica["datastores"])) > 0:
+                return replica["vm"]
+        return self.template
+
+    def sync(self, datastore_names, resource_pool, timeout=3600):
+        """
+        Bring <template>@<datastore> up to the master's changeVersion on
+        every datastore in datastore_names. Outdated replicas are replaced:
+        the new copy is cloned next to the master as <replica>.sync, then
+        the old replica is destroyed and the copy renamed.
+        Returns:
+            A list of dicts with datastore, replica, changed and, on
+            failure, msg
+        """
+        by_name = dict((x["name"], x) for x in self.replicas)
+        results = []
+        tasks = {}
+        for datastore_name in datastore_names:
+            name = self.replica_name(self.template_name, datastore_name)
+            result = {"datastore": datastore_name, "replica": name, "changed": False}
+            results.append(result)
+            if name in by_name and by_name[name]["version"] == self.master_version:
+                continue
+
+            datastore = VsphereHelpers.get_obj(self.vi_content, [vim.Datastore], datastore_name, self.inventory)
+            if datastore is None:
+                result["msg"] = "Could not find datastore: %s" % datastore_name
+                continue
+            if name + ".sync" in by_name:
+                # Left over from an interrupted sync.
+                VsphereHelpers.wait_task(by_name[name + ".sync"]["vm"].Destroy(), 'Replica cleanup task')
+
+            config_spec = vim.vm.ConfigSpec()
+            config_spec.extraConfig = [vim.option.OptionValue(key=self.VERSION_KEY, value=self.master_version)]
+            clone_spec = VsphereHelpers.create_clone_spec(VsphereHelpers.create_relocation_spec(resource_pool, datastore),
+                                                          config_spec, isTemplate=True)
+            task = self.template.Clone(folder=self.master_folder, name=name + ".sync", spec=clone_spec)
+            tasks[task._moId] = (task, result)
+
+        for task in VsphereHelpers.wait_tasks([x[0] for x in tasks.values()], timeout=timeout):
+            result = tasks[task._moId][1]
+            info = task.info
+            if info.state != vim.TaskInfo.State.success:
+                result["msg"] = _get_error_message(Exception(info.error))
+                continue
+            try:
+                if result["replica"] in by_name:
+                    VsphereHelpers.wait_task(by_name[result["replica"]]["vm"].Destroy(), 'Replica destroy task')
+                VsphereHelpers.wait_task(info.result.Rename(newName=result["replica"]), 'Replica rename task')
+                result["changed"] = True
+            except Exception as err:
+                result["msg"] = _get_error_message(err)
+        return results
+
+
+def _recommend_and_clone(vi_content, storage_placement_spec, vm_disk, desired_disk_details, is_template, timings=None, wait=True):
+    if timings is None:
+        timings = Timings()
+    with timings.span("sdrs_recommend"):
+        rec_result = vi_content.storageResourceManager.RecommendDatastores(storage_placement_spec)
     if not is_template:
         needed_rec_length = len(set([x["datastore_cluster"] for x in vm_disk.values()]))
     else:
         needed_rec_length = 1
     drive_ids = [int(x["vsphere_key"]) for x in desired_disk_details]
     rec_keys = _get_required_recommendations(rec_result, needed_rec_length, drive_ids)
-    task = vi_content.storageResourceManager.ApplyStorageDrsRecommendation_Task(rec_keys)
-    # task = vi_content.storageResourceManager.ApplyStorageDrsRecommendation_Task(rec_key[1].key)
-    result = VsphereHelpers.wait_task(task)
+    if not wait:
+        with timings.span("clone_submit"):
+            return vi_content.storageResourceManager.ApplyStorageDrsRecommendation_Task(rec_keys)
+    with timings.span("clone_task"):
+        task = vi_content.storageResourceManager.ApplyStorageDrsRecommendation_Task(rec_keys)
+        # task = vi_content.storageResourceManager.ApplyStorageDrsRecommendation_Task(rec_key[1].key)
+        result = VsphereHelpers.wait_task(task)
     return result
 
 
+def _wait_for_competing_clone(vsphere, vi_content, source_vms, guest, folder, timeout=3600):
+    """
+    Another run got DuplicateName's slot first: find the clone producing
+    guest and wait for it instead of sleeping. VmBeingClonedEvent on the
+    source (the template or one of its replicas) names the destination,
+    and its chainId is the eventChainId of the clone task. Chains whose
+    task failed on DuplicateName, this run's own attempt among them,
+    never produce guest and are skipped; a chain whose task is still
+    queued or running is waited for. When none is, the clone already
+    ended: guest in folder means it succeeded, otherwise this raises with
+    the newest clone failure.
+    """
+    begin_time = vsphere.CurrentTime() - timedelta(days=1)
+    events = []
+    for source_vm in source_vms:
+        event_filter = vim.event.EventFilterSpec()
+        event_filter.entity = vim.event.EventFilterSpec.ByEntity(entity=source_vm, recursion="self")
+        event_filter.eventTypeId = ["VmBeingClonedEvent"]
+        event_filter.time = vim.event.EventFilterSpec.ByTime(beginTime=begin_time)
+        events.extend(x for x in vi_content.eventManager.QueryEvents(event_filter) or [] if x.destName == guest)
+
+    recent = dict((info.eventChainId, (task, info)) for task, info in VsphereHelpers.get_recent_tasks(vi_content))
+    chains = []
+    for event in sorted(events, key=lambda x: x.createdTime, reverse=True):
+        task, info = recent.get(event.chainId, (None, None))
+        if info is not None and info.state == vim.TaskInfo.State.error and isinstance(info.error, vim.fault.DuplicateName):
+            continue
+        if info is not None and info.state in (vim.TaskInfo.State.queued, vim.TaskInfo.State.running):
+            VsphereHelpers.wait_task(task, 'Competing clone of %s' % guest, True, timeout)
+            return
+        chains.append(event.chainId)
+
+    if vi_content.searchIndex.FindChild(folder, guest) is not None:
+        return
+    for chain_id in chains:
+        # The task may have aged out of recentTask; its events tell how it ended.
+        event_filter = vim.event.EventFilterSpec()
+        event_filter.eventChainId = chain_id
+        for event in vi_content.eventManager.QueryEvents(event_filter) or []:
+            if isinstance(event, vim.event.VmCloneFailedEvent):
+                raise Exception(event.reason if event.reason is not None else event.fullFormattedMessage)
+    raise Exception("No clone of %s is running and it does not exist" % guest)
+
+
+CUSTOMIZATION_FAILED_EVENTS = ["CustomizationFailed", "CustomizationLinuxIdentityFailed", "CustomizationNetworkSetupFailed",
+                               "CustomizationSysprepFailed", "CustomizationUnknownFailure"]
+
+
+def wait_for_customization(vi_content, guests, begin_time, timeout=1800, entity=None, page_size=100):
+    """
+    Wait for the CustomizationSucceeded or CustomizationFailed event of
+    every VM named in guests. One EventHistoryCollector, filtered by
+    vCenter to customization events below entity (the root folder by
+    default) since begin_time, is read in pages of page_size; between
+    reads a private PropertyCollector blocks in WaitForUpdatesEx on the
+    collector's latestPage instead of polling.
+    Args:
+        begin_time (datetime): vCenter time from before the clones started
+        timeout (int): Seconds to wait for all guests together
+    Returns:
+        A dict of guest name to {"state", "seconds", "msg"}; state is
+        succeeded, failed or timeout, seconds are counted from begin_time
+    """
+    pending = set(guests)
+    results = {}
+    if len(pending) == 0:
+        return results
+
+    event_filter = vim.event.EventFilterSpec()
+    event_filter.entity = vim.event.EventFilterSpec.ByEntity(entity=entity or vi_content.rootFolder, recursion="all")
+    event_filter.eventTypeId = ["CustomizationSucceeded"] + CUSTOMIZATION_FAILED_EVENTS
+    event_filter.time = vim.event.EventFilterSpec.ByTime(beginTime=begin_time)
+    event_collector = vi_content.eventManager.CreateCollectorForEvents(event_filter)
+    collector = vi_content.propertyCollector.CreatePropertyCollector()
+    try:
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=event_collector, skip=False)]
+        filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=vim.event.EventHistoryCollector,
+                                                                          pathSet=["latestPage"])]
+        collector.CreateFilter(filter_spec, partialUpdates=True)
+        # Start from the collector's current version so the first wait blocks.
+        update = collector.WaitForUpdatesEx("", vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0))
+        version = update.version if update is not None else ""
+        # Read from the oldest match; later reads continue where this one stopped.
+        event_collector.RewindCollector()
+
+        deadline = time.time() + timeout
+        while True:
+            # A short page means we are through to the latest event.
+            events = [None] * page_size
+            while len(events) == page_size:
+                events = event_collector.ReadNextEvents(page_size) or []
+                for event in events:
+                    guest = event.vm.name if event.vm is not None else None
+                    if guest not in pending:
+                        continue
+                    pending.discard(guest)
+                    result = {"state": "succeeded", "seconds": round((event.createdTime - begin_time).total_seconds(), 3)}
+                    if isinstance(event, vim.event.CustomizationFailed):
+                        result["state"] = "failed"
+                        result["msg"] = "%s (log: %s)" % (event.fullFormattedMessage, event.logLocation)
+                    results[guest] = result
+
+            # Sleep until latestPage changes, then read what came in.
+            update = None
+            while update is None and len(pending) > 0 and time.time() < deadline:
+                options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=int(deadline - time.time()) + 1)
+                update = collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                break
+            version = update.version
+    finally:
+        collector.DestroyPropertyCollector()
+        event_collector.DestroyCollector()
+
+    for guest in pending:
+        results[guest] = {"state": "timeout",
+                          "msg": "No customization event for %s within %s seconds" % (guest, timeout)}
+    return results
+
+
+def _routable_ips(addresses):
+    return [x for x in addresses or [] if not x.lower().startswith("fe80:") and not x.startswith("169.254.")]
+
+
+def wait_for_guest_ips(vi_content, expected, vm_ids, timeout=1800, since=None):
+    """
+    Wait until VMware Tools runs in every guest of expected and the guest
+    reports its addresses. guest.net, guest.ipAddress and
+    guest.toolsRunningStatus of all the VMs are watched through one
+    PropertyCollector filter, so the call blocks in WaitForUpdatesEx until
+    one of them changes instead of polling each VM.
+    Args:
+        expected (dict): Guest name to {"ips": [addresses], "nics": count};
+                         a guest is ready when every address in ips is
+                         reported and at least nics NICs have a routable
+                         address, which covers NICs on DHCP
+        vm_ids (dict): Guest name to the MoRef ID of its VM, the "moid"
+                       of the clone result
+        timeout (int): Seconds to wait for all guests together
+        since (float): time.time() the time-to-IP is counted from, now by default
+    Returns:
+        A dict of guest name to {"state", "seconds", "ips", "nics", "tools"};
+        state is ready, timeout or missing
+    """
+    if since is None:
+        since = time.time()
+    results = {}
+    vms = dict((guest, vim.VirtualMachine(vm_ids[guest], vi_content.propertyCollector._stub))
+               for guest in expected if vm_ids.get(guest) is not None)
+    for guest in expected:
+        if guest not in vms:
+            results[guest] = {"state": "missing", "msg": "Could not find VM %s" % guest}
+    if len(vms) == 0:
+        return results
+
+    names = dict((vm._moId, guest) for guest, vm in vms.items())
+    guests = dict((guest, {}) for guest in vms)
+    collector = vi_content.propertyCollector.CreatePropertyCollector()
+    try:
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=vm, skip=False) for vm in vms.values()]
+        filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.VirtualMachine, pathSet=["guest.net", "guest.ipAddress", "guest.toolsRunningStatus"])]
+        # Whole values: guest.net changes arrive as a new list, not per NIC.
+        collector.CreateFilter(filter_spec, partialUpdates=False)
+
+        deadline = time.time() + timeout
+        version = ""
+        while len(results) < len(expected):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=int(remaining) + 1)
+            update = collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                continue
+            version = update.version
+
+            for filter_set in update.filterSet:
+                for obj_set in filter_set.objectSet:
+                    guest = names.get(obj_set.obj._moId)
+                    if guest is None or guest in results:
+                        continue
+                    guests[guest].update((change.name, change.val) for change in obj_set.changeSet)
+                    state = guests[guest]
+                    nics = [{"network": x.network, "mac": x.macAddress, "ips": _routable_ips(x.ipAddress)}
+                            for x in state.get("guest.net") or []]
+                    ips = set(_routable_ips([state.get("guest.ipAddress")] if state.get("guest.ipAddress") else []))
+                    for nic in nics:
+                        ips.update(nic["ips"])
+                    wanted = expected[guest]
+                    if (state.get("guest.toolsRunningStatus") == "guestToolsRunning"
+                            and set(wanted.get("ips") or []).issubset(ips)
+                            and len([x for x in nics if x["ips"]]) >= wanted.get("nics", 0)):
+                        results[guest] = {"state": "ready",
+                                          "seconds": round(time.time() - since, 3),
+                                          "ips": sorted(ips),
+                                          "nics": nics,
+                                          "tools": state.get("guest.toolsRunningStatus")}
+    finally:
+        collector.DestroyPropertyCollector()
+
+    for guest in guests:
+        if guest not in results:
+            state = guests[guest]
+            results[guest] = {"state": "timeout",
+                              "ips": sorted(_routable_ips([x for y in state.get("guest.net") or [] for x in y.ipAddress or []])),
+                              "tools": state.get("guest.toolsRunningStatus"),
+                              "msg": "%s did not report %s within %s seconds" % (
+                                  guest, ", ".join(expected[guest].get("ips") or ["an address"]), timeout)}
+    return results
+
+
+def expected_guest_ips(vm_nic):
+    """wait_for_guest_ips expectation for a vm_nic parameter."""
+    networks = (vm_nic or {}).values()
+    return {"ips": [x["ip"] for x in networks if "ip" in x and "netmask" in x], "nics": len(networks)}
+
+
 def _convert_disk_list_to_dict(disks):
     disk_dict = {}
     for disk in range(len(disks)):
@@ -864,10 +3415,41 @@ def main():
             vcenter_hostname=dict(required=True, type='str'),
             vcenter_username=dict(required=True, type='str'),
             vcenter_password=dict(required=True, type='str'),
-            guest=dict(required=True, type='str'),
-            template_src=dict(required=True, type='str'),
-            vm_disk=dict(required=True, type='dict'),
-            cluster=dict(required=True, type='str'),
+            guest=dict(required=False, type='str'),
+            guests=dict(required=False, default=None, type='list'),
+            max_in_flight=dict(required=False, default=4, type='int'),
+            batch_placement=dict(required=False, default=True, type='bool'),
+            placement_mode=dict(required=False, default='sdrs', choices=['sdrs', 'local']),
+            placement_reservation_file=dict(required=False, default=None, type='str'),
+            placement_min_free_pct=dict(required=False, default=10, type='float'),
+            placement_max_overcommit=dict(required=False, default=2.0, type='float'),
+            placement_metrics=dict(required=False, default=False, type='bool'),
+            placement_max_latency_ms=dict(required=False, default=20, type='float'),
+            sdrs_max_attempts=dict(required=False, default=SDRS_RETRY_DEFAULTS["max_attempts"], type='int'),
+            sdrs_backoff_base=dict(required=False, default=SDRS_RETRY_DEFAULTS["backoff_base"], type='float'),
+            sdrs_backoff_max=dict(required=False, default=SDRS_RETRY_DEFAULTS["backoff_max"], type='float'),
+            inventory_cache_dir=dict(required=False, default=None, type='str'),
+            session_cache_dir=dict(required=False, default=None, type='str'),
+            session_broker=dict(required=False, default=None, type='str'),
+            timings_file=dict(required=False, default=None, type='str'),
+            soap_stats=dict(required=False, default=False, type='bool'),
+            wait=dict(required=False, default=True, type='bool'),
+            task_ids=dict(required=False, default=None, type='list'),
+            stats=dict(required=False, default=None, type='list'),
+            stats_samples=dict(required=False, default=3, type='int'),
+            wait_for_customization=dict(required=False, default=False, type='bool'),
+            customization_timeout=dict(required=False, default=1800, type='int'),
+            wait_for_ip=dict(required=False, default=False, type='bool'),
+            ip_timeout=dict(required=False, default=1800, type='int'),
+            template_src=dict(required=False, type='str'),
+            clone_mode=dict(required=False, default='full', choices=['full', 'linked', 'instant']),
+            clone_snapshot=dict(required=False, default=None, type='str'),
+            template_replicas=dict(required=False, default=False, type='bool'),
+            template_replica_arrays=dict(required=False, default=None, type='dict'),
+            sync_template_replicas=dict(required=False, default=None, type='list'),
+            vm_disk=dict(required=False, type='dict'),
+            disk_controllers=dict(required=False, default=1, choices=[1, 2, 3], type='int'),
+            cluster=dict(required=False, type='str'),
             vm_domain=dict(required=False, type='str'),
             guest_family=dict(required=False, type='str'),
             vm_cpu=dict(required=False, type='int'),
@@ -879,6 +3461,8 @@ def main():
             windows_organization=dict(required=False, default=None, type='str'),
             windows_provisioner_name=dict(required=False, default=None, type='str'),
         ),
+        mutually_exclusive=[['guest', 'guests', 'sync_template_replicas', 'task_ids', 'stats']],
+        required_one_of=[['guest', 'guests', 'sync_template_replicas', 'task_ids', 'stats']],
         supports_check_mode=False,
     )
 
@@ -889,9 +3473,44 @@ def main():
     vcenter_username = module.params['vcenter_username']
     vcenter_password = module.params['vcenter_password']
     guest = module.params['guest']
+    guests = module.params['guests']
+    max_in_flight = module.params['max_in_flight']
+    batch_placement = module.params['batch_placement']
+    placement_mode = module.params['placement_mode']
+    sdrs_retry = {"max_attempts": module.params['sdrs_max_attempts'],
+                  "backoff_base": module.params['sdrs_backoff_base'],
+                  "backoff_max": module.params['sdrs_backoff_max']}
+    inventory_cache_dir = module.params['inventory_cache_dir']
+    session_cache_dir = module.params['session_cache_dir']
+    session_broker = module.params['session_broker']
     template_src = module.params['template_src']
+    clone_mode = module.params['clone_mode']
+    clone_snapshot = module.params['clone_snapshot']
+    template_replicas = module.params['template_replicas']
+    replica_arrays = module.params['template_replica_arrays']
+    sync_template_replicas = module.params['sync_template_replicas']
+    task_ids = module.params['task_ids']
+    stats = module.params['stats']
+    placement_metrics = module.params['placement_metrics']
+    wait = module.params['wait']
+    customization_timeout = module.params['customization_timeout']
+    ip_timeout = module.params['ip_timeout']
     vm_disk = module.params['vm_disk']
     cluster = module.params['cluster']
+    if stats is not None and cluster is None:
+        module.fail_json(msg="cluster is required for stats")
+    if task_ids is None and stats is None and (template_src is None or cluster is None):
+        module.fail_json(msg="template_src and cluster are required to clone guests")
+    if vm_disk is None and sync_template_replicas is None and task_ids is None and stats is None:
+        module.fail_json(msg="vm_disk is required to clone guests")
+    if module.params['wait_for_customization'] and (not wait or clone_mode == 'instant'):
+        module.fail_json(msg="wait_for_customization needs wait and a full or linked clone")
+    if clone_mode == 'instant' and module.params['create_template']:
+        module.fail_json(msg="Instant clones are running VMs and cannot be created as templates")
+    if module.params['wait_for_ip'] and not wait:
+        module.fail_json(msg="wait_for_ip needs wait")
+    if sdrs_retry["max_attempts"] < 1:
+        module.fail_json(msg="sdrs_max_attempts must be at least 1")
 
     if "vm_cpu" in module.params:
         vm_cpu = module.params['vm_cpu']
@@ -908,6 +3527,10 @@ def main():
     else:
         create_template = False
 
+    # Templates are not customized.
+    customize_wait = module.params['wait_for_customization'] and not create_template
+    ip_wait = module.params['wait_for_ip'] and not create_template
+
     if "vm_domain" in module.params:
         vm_domain = module.params['vm_domain']
     else:
@@ -944,35 +3567,221 @@ def main():
         windows_provisioner_name = None
 
     # guest_attributes = module.params['guest_attributes']
+    timings = Timings(run=uuid.uuid4().hex, vcenter=vcenter_hostname)
+    if module.params['timings_file']:
+        atexit.register(timings.write, module.params['timings_file'])
+
+    if module.params['soap_stats']:
+        soap_stats = SoapStats().install()
+        # Every result, failures included, reports the calls made so far.
+        exit_json, fail_json = module.exit_json, module.fail_json
+        module.exit_json = lambda **kwargs: exit_json(soap_stats=soap_stats.report(), **kwargs)
+        module.fail_json = lambda **kwargs: fail_json(soap_stats=soap_stats.report(), **kwargs)
+
+    login_start = time.time()
+    login = "login"
     si = None
-    try:
-        si = SmartConnect(
-            host=vcenter_hostname,
-            user=vcenter_username,
-            pwd=vcenter_password
-            )
-
-    except Exception as exc:
+    session_cache = None
+    broker = None
+    if session_broker:
         try:
-            import ssl
-            try:
-                ssl._create_default_https_context = ssl._create_unverified_context
-            except AttributeError:
-                pass
-
-            si = SmartConnect(
+            broker = SessionBroker(session_broker)
+            si = broker.connect(vcenter_hostname, vcenter_username, vcenter_password)
+        except Exception as exc:
+            module.fail_json(msg="Cannot borrow a session from %s: %s" % (session_broker, exc))
+        if si is None:
+            broker.release()
+            broker = None
+        else:
+            login = "broker"
+    elif session_cache_dir:
+        session_cache = SessionCache(session_cache_dir, vcenter_hostname, vcenter_username)
+        si = session_cache.resume()
+        if si is not None:
+            login = "session_cache"
+
+    if si is None:
+        try:
+            si = _connect_with_ssl_fallback(lambda: SmartConnect(
                 host=vcenter_hostname,
                 user=vcenter_username,
                 pwd=vcenter_password
-                )
+                ))
         except Exception as exc1:
             module.fail_json(msg="Creating unverified context failed. Cannot connect to %s: %s" %(vcenter_hostname, exc1))
 
-    atexit.register(Disconnect, si)
+        if session_cache is not None:
+            session_cache.save(si)
+    timings.record("login", login_start, method=login)
+
+    if broker is not None:
+        atexit.register(broker.release)
+    elif session_cache is None:
+        atexit.register(Disconnect, si)
+    # atexit runs last in first out: drop our views before logging out.
+    atexit.register(VsphereHelpers.destroy_views)
+
+    if task_ids is not None:
+        # Status of clones submitted with wait: false; one call for all of them.
+        try:
+            tasks = VsphereHelpers.get_task_states(si.RetrieveContent(), task_ids)
+        except Exception as err:
+            module.fail_json(msg="Could not read tasks: %s" % _get_error_message(err))
+
+        pending = len([x for x in tasks if x["state"] in (vim.TaskInfo.State.queued, vim.TaskInfo.State.running)])
+        failed = [x["task"] for x in tasks if x["state"] == vim.TaskInfo.State.error]
+        if len(failed) > 0:
+            module.fail_json(msg="Tasks failed: %s" % ", ".join(failed),
+                             vcenter=vcenter_hostname,
+                             tasks=tasks,
+                             pending=pending)
+        module.exit_json(changed=False, vcenter=vcenter_hostname, tasks=tasks, pending=pending, done=pending == 0)
+
+    if stats is not None:
+        # The load placement_metrics places by; an empty list reads its counters.
+        try:
+            content = si.RetrieveContent()
+            inventory = load_inventory(si, inventory_cache_dir, vcenter_hostname, vcenter_username)
+            cluster_obj = VsphereHelpers.get_obj(content, [vim.ClusterComputeResource], cluster, inventory)
+            if cluster_obj is None:
+                module.fail_json(msg="Could not find cluster: %s" % cluster)
+            with timings.span("stats"):
+                load = PerfMetrics(content).cluster_load(cluster_obj, stats or None, module.params['stats_samples'])
+        except Exception as err:
+            module.fail_json(msg="Could not read performance counters: %s" % _get_error_message(err))
+        load.pop("objects")
+        module.exit_json(changed=False, vcenter=vcenter_hostname, stats=load, timings=timings.spans)
+
+    local_placement = None
+    if placement_mode == 'local':
+        local_placement = LocalPlacement(si.content,
+                                         reservation_file=module.params['placement_reservation_file'],
+                                         min_free_pct=module.params['placement_min_free_pct'],
+                                         max_overcommit=module.params['placement_max_overcommit'],
+                                         max_latency_ms=module.params['placement_max_latency_ms'])
+
+    if sync_template_replicas is not None:
+        try:
+            content = si.RetrieveContent()
+            inventory = load_inventory(si, inventory_cache_dir, vcenter_hostname, vcenter_username)
+            template_vm = VsphereHelpers.get_vm(si, template_src, inventory)
+            cluster_obj = VsphereHelpers.get_obj(content, [vim.ClusterComputeResource], cluster, inventory)
+            if len(template_vm) < 1 or cluster_obj is None:
+                module.fail_json(msg="Could not find VM Template %s or cluster %s" % (template_src, cluster))
+            replicas = TemplateReplicas(si, content, template_vm[0], template_src, inventory, replica_arrays)
+            results = replicas.sync(sync_template_replicas, cluster_obj.resourcePool)
+        except Exception as err:
+            module.fail_json(msg="Could not sync template replicas: %s" % _get_error_message(err))
+
+        changed = len([x for x in results if x["changed"]]) > 0
+        failed = [x["replica"] for x in results if "msg" in x]
+        if len(failed) > 0:
+            module.fail_json(msg="Could not sync template replicas: %s" % ", ".join(failed),
+                             changed=changed,
+                             replicas=results)
+        module.exit_json(changed=changed, vcenter=vcenter_hostname, replicas=results)
+
+    if guests is not None:
+        for entry in guests:
+            if not isinstance(entry, dict) or "guest" not in entry:
+                module.fail_json(msg="Every entry in guests needs a guest name: %s" % json.dumps(entry))
+        duplicates = _duplicate_guests(guests)
+        if len(duplicates) > 0:
+            module.fail_json(msg="Guests listed more than once: %s" % ", ".join(duplicates))
+
+        try:
+            content = si.RetrieveContent()
+            with timings.span("inventory"):
+                inventory = load_inventory(si, inventory_cache_dir, vcenter_hostname, vcenter_username)
+            if customize_wait:
+                customization_since = si.CurrentTime()
+            deploy_start = time.time()
+            results = deploy_guests(si, content, guests,
+                                    defaults={"template_src": template_src,
+                                              "cluster_name": cluster,
+                                              "vm_domain": vm_domain,
+                                              "vm_cpu": vm_cpu,
+                                              "vm_memory_mb": vm_memory_mb,
+                                              "os_family": os_family,
+                                              "vm_disk": vm_disk,
+                                              "vm_nic": vm_nic,
+                                              "windows_product_id": product_id,
+                                              "windows_org_name": windows_organization,
+                                              "windows_provision_user": windows_provisioner_name,
+                                              "is_template": create_template,
+                                              "folder_structure": folder_structure,
+                                              "sdrs_retry": sdrs_retry,
+                                              "clone_mode": clone_mode,
+                                              "clone_snapshot": clone_snapshot,
+                                              "template_replicas": template_replicas,
+                                              "replica_arrays": replica_arrays,
+                                              "wait": wait,
+                                              "disk_controllers": module.params['disk_controllers'],
+                                              "placement_metrics": placement_metrics},
+                                    max_in_flight=max_in_flight,
+                                    inventory=inventory,
+                                    batch_placement=batch_placement,
+                                    local_placement=local_placement,
+                                    timings=timings)
+        except Exception as err:
+            module.fail_json(msg="Could not clone guests: %s" % err, timings=timings.spans)
+
+        if customize_wait:
+            cloned = [x["guest"] for x in results if x["changed"]]
+            try:
+                with timings.span("customization_wait", guests=len(cloned)):
+                    customized = wait_for_customization(content, cloned, customization_since, customization_timeout)
+            except Exception as err:
+                module.fail_json(msg="Could not wait for guest customization: %s" % _get_error_message(err),
+                                 changed=True, vcenter=vcenter_hostname, results=results)
+            for result in results:
+                if result["guest"] in customized:
+                    result["customization"] = customized[result["guest"]]
+                    if customized[result["guest"]]["state"] != "succeeded":
+                        result["failed"] = True
+                        result["msg"] = customized[result["guest"]]["msg"]
+
+        if ip_wait:
+            nics = dict((x["guest"], x.get("vm_nic") or vm_nic) for x in guests)
+            expected = dict((x["guest"], expected_guest_ips(nics[x["guest"]])) for x in results if x["changed"] and not x["failed"])
+            try:
+                with timings.span("ip_wait", guests=len(expected)):
+                    vm_ids = dict((x["guest"], x["changes"].get("moid")) for x in results if x["guest"] in expected)
+                    addresses = wait_for_guest_ips(content, expected, vm_ids, ip_timeout, deploy_start)
+            except Exception as err:
+                module.fail_json(msg="Could not wait for guest addresses: %s" % _get_error_message(err),
+                                 changed=True, vcenter=vcenter_hostname, results=results)
+            for result in results:
+                if result["guest"] in addresses:
+                    result["guest_ip"] = addresses[result["guest"]]
+                    if addresses[result["guest"]]["state"] != "ready":
+                        result["failed"] = True
+                        result["msg"] = addresses[result["guest"]]["msg"]
+
+        changed = len([x for x in results if x["changed"]]) > 0
+        failed = [x["guest"] for x in results if x["failed"]]
+        if len(failed) > 0:
+            module.fail_json(msg="Could not clone guests: %s" % ", ".join(failed),
+                             changed=changed,
+                             vcenter=vcenter_hostname,
+                             results=results,
+                             timings=[x for x in timings.spans if "guest" not in x])
+
+        # Batched Storage DRS clones share a task.
+        submitted = sorted(set(x["changes"]["task"] for x in results if "task" in x.get("changes", {})))
+        module.exit_json(
+            changed=changed,
+            vcenter=vcenter_hostname,
+            results=results,
+            task_ids=submitted,
+            timings=[x for x in timings.spans if "guest" not in x]
+        )
 
     try:
         content = si.RetrieveContent()
-        vm_array = VsphereHelpers.get_vm(si, guest)
+        with timings.span("inventory"):
+            inventory = load_inventory(si, inventory_cache_dir, vcenter_hostname, vcenter_username)
+        vm_array = VsphereHelpers.get_vm(si, guest, inventory)
         if len(vm_array) > 0:
             if create_template:
                 module.exit_json(changed=False)
@@ -980,6 +3789,9 @@ def main():
                 module.fail_json(msg="Found existing VM with name %s" % guest)
         
         changed = False
+        if customize_wait:
+            customization_since = si.CurrentTime()
+        deploy_start = time.time()
         try:
             changes = deploy_template(vsphere=si,
                                               vi_content=content,
@@ -996,17 +3808,54 @@ def main():
                                               windows_org_name=windows_organization,
                                               windows_provision_user=windows_provisioner_name,
                                               is_template=create_template,
-                                              folder_structure=folder_structure)
+                                              folder_structure=folder_structure,
+                                              inventory=inventory,
+                                              sdrs_retry=sdrs_retry,
+                                              local_placement=local_placement,
+                                              clone_mode=clone_mode,
+                                              clone_snapshot=clone_snapshot,
+                                              template_replicas=template_replicas,
+                                              replica_arrays=replica_arrays,
+                                              timings=timings.child(guest=guest),
+                                              wait=wait,
+                                              disk_controllers=module.params['disk_controllers'],
+                                              placement_metrics=placement_metrics)
+        except CloneRetryError as err:
+            module.fail_json(msg=err.message, sdrs_attempts=err.attempts, timings=timings.spans)
         except Exception as err:
-            module.fail_json(msg=err.message)
+            module.fail_json(msg=err.message, timings=timings.spans)
 
         if len(changes) > 0:
             changed = True
 
+        if customize_wait:
+            try:
+                with timings.span("customization_wait", guest=guest):
+                    changes["customization"] = wait_for_customization(content, [guest], customization_since,
+                                                                      customization_timeout)[guest]
+            except Exception as err:
+                module.fail_json(msg="Could not wait for guest customization: %s" % _get_error_message(err),
+                                 changed=changed, changes=changes, timings=timings.spans)
+            if changes["customization"]["state"] != "succeeded":
+                module.fail_json(msg=changes["customization"]["msg"], changed=changed, changes=changes, timings=timings.spans)
+
+        if ip_wait:
+            try:
+                with timings.span("ip_wait", guest=guest):
+                    changes["guest_ip"] = wait_for_guest_ips(content, {guest: expected_guest_ips(vm_nic)},
+                                                             {guest: changes.get("moid")}, ip_timeout, deploy_start)[guest]
+            except Exception as err:
+                module.fail_json(msg="Could not wait for guest addresses: %s" % _get_error_message(err),
+                                 changed=changed, changes=changes, timings=timings.spans)
+            if changes["guest_ip"]["state"] != "ready":
+                module.fail_json(msg=changes["guest_ip"]["msg"], changed=changed, changes=changes, timings=timings.spans)
+
         module.exit_json(
             changed=changed,
             vcenter=vcenter_hostname,
-            changes=changes
+            changes=changes,
+            task_ids=[changes["task"]] if "task" in changes else [],
+            timings=timings.spans
         )
     except Exception, err:
         module.fail_json(msg="Could not clone vm: %s. %s" % (guest, err))
@@ -1,12 +1,20 @@
 #!/usr/bin/python
 
 import atexit
+import hashlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
 
 HAS_PYVMOMI = False
 try:
     from pyVmomi import vim
     from pyVmomi import vmodl
-    from pyVim.connect import SmartConnect, Disconnect
+    from pyVim.connect import SmartConnect, SmartStubAdapter, Disconnect
     HAS_PYVMOMI = True
 
 except ImportError as e:
@@ -77,25 +85,52 @@ def collect_properties(service_instance, view_ref, obj_type, path_set=None,
     return data
 
 
+# ContainerViews live on the vCenter side until destroyed, so they are
+# created once per session, container and type list and torn down by
+# destroy_views().
+_views = {}
+_views_lock = threading.Lock()
+
+
 def get_container_view(service_instance, obj_type, container=None):
     """
     Get a vSphere Container View reference to all objects of type 'obj_type'
-    It is up to the caller to take care of destroying the View when no longer
-    needed.
+    The view is shared by every caller asking for the same container and
+    types; destroy_views() destroys it.
     Args:
         obj_type (list): A list of managed object types
     Returns:
         A container view ref to the discovered managed objects
     """
+    return get_content_view(service_instance.content, obj_type, container)
+
+
+def get_content_view(content, obj_type, container=None):
     if not container:
-        container = service_instance.content.rootFolder
+        container = content.rootFolder
+
+    key = (id(container._stub), container._moId, tuple(sorted(x.__name__ for x in obj_type)))
+    with _views_lock:
+        if key not in _views:
+            _views[key] = content.viewManager.CreateContainerView(
+                container=container,
+                type=obj_type,
+                recursive=True
+            )
+        return _views[key]
 
-    view_ref = service_instance.content.viewManager.CreateContainerView(
-        container=container,
-        type=obj_type,
-        recursive=True
-    )
-    return view_ref
+
+def destroy_views():
+    with _views_lock:
+        views = list(_views.values())
+        _views.clear()
+
+    for view in views:
+        try:
+            view.DestroyView()
+        except Exception:
+            # The session may already be gone, taking its views with it.
+            pass
 
 
 def get_vm(service_instance, vm_name):
@@ -113,14 +148,273 @@ def get_vm(service_instance, vm_name):
 
 
 def get_obj(content, vimtype, name):
-    obj = None
-    container = content.viewManager.CreateContainerView(
-        content.rootFolder, vimtype, True)
-    for c in container.view:
-        if c.name == name:
-            obj = c
+    view = get_content_view(content, vimtype)
+
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True)
+    obj_spec.selectSet = [vmodl.query.PropertyCollector.TraversalSpec(name='traverseEntities', path='view',
+                                                                      skip=False, type=view.__class__)]
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [obj_spec]
+    filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=x, pathSet=["name"], all=False) for x in vimtype]
+
+    collector = content.propertyCollector
+    result = collector.RetrievePropertiesEx([filter_spec], vmodl.query.PropertyCollector.RetrieveOptions())
+    while result is not None:
+        for obj in result.objects:
+            if len(obj.propSet) > 0 and obj.propSet[0].val == name:
+                if result.token is not None:
+                    collector.CancelRetrievePropertiesEx(result.token)
+                return obj.obj
+        if result.token is None:
             break
-    return obj
+        result = collector.ContinueRetrievePropertiesEx(result.token)
+    return None
+
+class SoapStats(object):
+    """
+    Opt-in accounting of the SOAP calls a run makes: calls, request and
+    response bytes and latency per method, and calls per method for each
+    helper that made them. install() wraps pyVmomi's SoapStubAdapter for
+    the whole process, so the login is counted as well. Response bytes are
+    the bytes read off the wire, before any gzip decoding.
+    """
+    # Generic plumbing is never reported as the caller; the helper that
+    # went through it is.
+    PLUMBING = ("collect_properties", "InvokeMethod", "SerializeRequest", "GetConnection",
+                "read", "add", "_caller")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.methods = {}
+        self.callers = {}
+        self.response_classes = {}
+        self.saved = {}
+
+    def install(self):
+        from pyVmomi import SoapAdapter
+        adapter = SoapAdapter.SoapStubAdapter
+        stats = self
+        for name in ("InvokeMethod", "SerializeRequest", "GetConnection"):
+            self.saved[name] = adapter.__dict__.get(name)
+        invoke_method = adapter.InvokeMethod
+        serialize_request = adapter.SerializeRequest
+        get_connection = adapter.GetConnection
+
+        def InvokeMethod(stub, mo, info, args, outerStub=None):
+            stats.local.request_bytes = 0
+            stats.local.response_bytes = 0
+            start = time.time()
+            try:
+                return invoke_method(stub, mo, info, args, outerStub)
+            finally:
+                stats.add(info.wsdlName, time.time() - start, stats.local.request_bytes, stats.local.response_bytes)
+
+        def SerializeRequest(stub, mo, info, args):
+            request = serialize_request(stub, mo, info, args)
+            stats.local.request_bytes = getattr(stats.local, "request_bytes", 0) + len(request)
+            return request
+
+        def GetConnection(stub):
+            conn = get_connection(stub)
+            conn.response_class = stats._counting_response(conn.response_class)
+            return conn
+
+        adapter.InvokeMethod = InvokeMethod
+        adapter.SerializeRequest = SerializeRequest
+        adapter.GetConnection = GetConnection
+        return self
+
+    def uninstall(self):
+        from pyVmomi import SoapAdapter
+        adapter = SoapAdapter.SoapStubAdapter
+        for name, original in self.saved.items():
+            if original is None:
+                delattr(adapter, name)
+            else:
+                setattr(adapter, name, original)
+        self.saved = {}
+
+    def _counting_response(self, response_class):
+        if getattr(response_class, "counts_for", None) is self:
+            return response_class
+        if response_class not in self.response_classes:
+            stats = self
+
+            class CountingResponse(response_class):
+                counts_for = stats
+
+                def read(self, *args, **kwargs):
+                    data = response_class.read(self, *args, **kwargs)
+                    stats.local.response_bytes = getattr(stats.local, "response_bytes", 0) + len(data)
+                    return data
+            self.response_classes[response_class] = CountingResponse
+        return self.response_classes[response_class]
+
+    def _caller(self):
+        home = sys._getframe(0).f_code.co_filename
+        frame = sys._getframe(1)
+        while frame is not None:
+            code = frame.f_code
+            if code.co_filename == home and code.co_name not in self.PLUMBING:
+                return code.co_name
+            frame = frame.f_back
+        return "other"
+
+    def add(self, method, seconds, request_bytes, response_bytes, caller=None):
+        if caller is None:
+            caller = self._caller()
+        with self.lock:
+            entry = self.methods.setdefault(method, {"calls": 0, "request_bytes": 0, "response_bytes": 0,
+                                                     "seconds": 0.0, "max_seconds": 0.0})
+            entry["calls"] += 1
+            entry["request_bytes"] += request_bytes
+            entry["response_bytes"] += response_bytes
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            calls = self.callers.setdefault(caller, {})
+            calls[method] = calls.get(method, 0) + 1
+
+    def report(self):
+        with self.lock:
+            methods = dict((name, dict(x, seconds=round(x["seconds"], 3), max_seconds=round(x["max_seconds"], 3)))
+                           for name, x in self.methods.items())
+            callers = dict((name, dict(x)) for name, x in self.callers.items())
+        return {"calls": sum(x["calls"] for x in methods.values()),
+                "request_bytes": sum(x["request_bytes"] for x in methods.values()),
+                "response_bytes": sum(x["response_bytes"] for x in methods.values()),
+                "seconds": round(sum(x["seconds"] for x in methods.values()), 3),
+                "methods": methods,
+                "callers": callers}
+
+
+class SessionCache(object):
+    """
+    Keeps the vCenter session cookie in a 0600 file keyed by host and user
+    so later module runs can skip the SSO login. A cached session is only
+    reused after vCenter confirms it is still logged in; it is never logged
+    out at exit.
+    """
+    def __init__(self, cache_dir, vcenter_hostname, vcenter_username):
+        self.vcenter_hostname = vcenter_hostname
+        key = hashlib.sha1(("%s|%s" % (vcenter_hostname, vcenter_username)).encode("utf-8")).hexdigest()
+        self.path = os.path.join(os.path.expanduser(cache_dir), "session_%s" % key)
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                return cache_file.read().strip() or None
+        except (IOError, OSError):
+            return None
+
+    def save(self, si):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        handle, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, "w") as cache_file:
+            cache_file.write(si._stub.cookie)
+        os.chmod(tmp_path, 0o600)
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def resume(self):
+        """
+        Returns:
+            A ServiceInstance on the cached session, or None when there is
+            no cached session or vCenter no longer accepts it
+        """
+        cookie = self.load()
+        if cookie is None:
+            return None
+
+        si = resume_session(self.vcenter_hostname, cookie)
+        if si is None:
+            self.clear()
+        return si
+
+
+class SessionBroker(object):
+    """
+    Client for tools/vsphere_session_broker.py. Borrows a pooled session
+    cookie for the length of the module run. The session belongs to the
+    broker: it is released, never logged out, and the broker takes the
+    lease back by itself if this process dies.
+    """
+    def __init__(self, socket_path):
+        self.lease = None
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(os.path.expanduser(socket_path))
+        self.reader = self.sock.makefile("rb")
+
+    def _call(self, **request):
+        self.sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        line = self.reader.readline()
+        if not line:
+            raise Exception("vSphere session broker closed the connection")
+        response = json.loads(line.decode("utf-8"))
+        if not response.get("ok"):
+            raise Exception(response.get("msg"))
+        return response
+
+    def connect(self, vcenter_hostname, vcenter_username, vcenter_password, timeout=300):
+        """
+        Returns:
+            A ServiceInstance on a borrowed session, or None when the broker
+            only handed out sessions vCenter no longer accepts
+        """
+        for attempt in range(2):
+            response = self._call(op="acquire", host=vcenter_hostname, user=vcenter_username,
+                                  password=vcenter_password, timeout=timeout)
+            self.lease = response["lease"]
+            si = resume_session(vcenter_hostname, response["cookie"])
+            if si is not None:
+                return si
+            self.release(invalid=True, close=False)
+        return None
+
+    def release(self, invalid=False, close=True):
+        if self.lease is not None:
+            try:
+                self._call(op="release", lease=self.lease, invalid=invalid)
+            except Exception:
+                pass
+            self.lease = None
+        if close:
+            self.reader.close()
+            self.sock.close()
+
+
+def resume_session(vcenter_hostname, cookie):
+    """
+    Returns:
+        A ServiceInstance on the session behind cookie, or None when vCenter
+        no longer accepts it
+    """
+    try:
+        stub = SmartStubAdapter(host=vcenter_hostname)
+        stub.cookie = cookie
+        si = vim.ServiceInstance("ServiceInstance", stub)
+        session_manager = si.content.sessionManager
+        session = session_manager.currentSession
+        if session is None:
+            return None
+        try:
+            if not session_manager.SessionIsActive(session.key, session.userName):
+                return None
+        except vim.fault.NoPermission:
+            # SessionIsActive needs Sessions.ValidateSession; a
+            # non-empty currentSession is proof enough without it.
+            pass
+        return si
+    except Exception:
+        return None
+
 
 def main():
 
@@ -133,6 +427,9 @@ def main():
             vcenter_password=dict(required=True, type='str'),
             guest_attributes=dict(required=True, type='dict'),
             guest=dict(required=True, type='str'),
+            session_cache_dir=dict(required=False, default=None, type='str'),
+            session_broker=dict(required=False, default=None, type='str'),
+            soap_stats=dict(required=False, default=False, type='bool'),
         ),
         supports_check_mode=False,
     )
@@ -145,18 +442,53 @@ def main():
     vcenter_password = module.params['vcenter_password']
     guest_attributes = module.params['guest_attributes']
     guest = module.params['guest']
-    si = None
-    try:
-        si = SmartConnect(
-            host=vcenter_hostname,
-            user=vcenter_username,
-            pwd=vcenter_password
-            )
-    except Exception, err:
-        module.fail_json(msg="Cannot connect to %s: %s" %(vcenter_hostname, err))
+    session_cache_dir = module.params['session_cache_dir']
+    session_broker = module.params['session_broker']
+
+    if module.params['soap_stats']:
+        soap_stats = SoapStats().install()
+        # Every result, failures included, reports the calls made so far.
+        exit_json, fail_json = module.exit_json, module.fail_json
+        module.exit_json = lambda **kwargs: exit_json(soap_stats=soap_stats.report(), **kwargs)
+        module.fail_json = lambda **kwargs: fail_json(soap_stats=soap_stats.report(), **kwargs)
 
-    # disconnect this thing
-    atexit.register(Disconnect, si)
+    si = None
+    session_cache = None
+    broker = None
+    if session_broker:
+        try:
+            broker = SessionBroker(session_broker)
+            si = broker.connect(vcenter_hostname, vcenter_username, vcenter_password)
+        except Exception, err:
+            module.fail_json(msg="Cannot borrow a session from %s: %s" % (session_broker, err))
+        if si is None:
+            broker.release()
+            broker = None
+    elif session_cache_dir:
+        session_cache = SessionCache(session_cache_dir, vcenter_hostname, vcenter_username)
+        si = session_cache.resume()
+
+    if si is None:
+        try:
+            si = SmartConnect(
+                host=vcenter_hostname,
+                user=vcenter_username,
+                pwd=vcenter_password
+                )
+        except Exception, err:
+            module.fail_json(msg="Cannot connect to %s: %s" %(vcenter_hostname, err))
+
+        if session_cache is not None:
+            session_cache.save(si)
+
+    # disconnect this thing, unless the session is cached for the next run
+    # or borrowed from the broker
+    if broker is not None:
+        atexit.register(broker.release)
+    elif session_cache is None:
+        atexit.register(Disconnect, si)
+    # atexit runs last in first out: drop our views before logging out.
+    atexit.register(destroy_views)
 
     try:
         content = si.RetrieveContent()
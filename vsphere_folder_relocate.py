@@ -7,14 +7,19 @@ except ImportError:
 HAS_PYSPHERE = False
 HAS_NET_HELPER = False
 try:
-    from pysphere import VIServer, VIProperty, MORTypes
+    from pysphere import VIServer, VIProperty, MORTypes, VIMor
     from pysphere.resources import VimService_services as VI
     from pysphere.vi_task import VITask
     from pysphere import VIException, VIApiException  #, FaultType
     from tempfile import NamedTemporaryFile
+    import tempfile
 
+    import hashlib
     import os
+    import socket
+    import sys
     import time
+    from Cookie import SimpleCookie
     HAS_PYSPHERE = True
 
 except ImportError as e:
@@ -52,6 +57,28 @@ options:
     description:
       - Array of strings representing the folder structure desired.
     required: true
+  session_cache_dir:
+    description:
+      - Directory in which to keep the vCenter session cookie between runs.
+        A cached session is reused while vCenter still accepts it and is
+        not logged out when the module finishes.
+    required: false
+    default: null
+  session_broker:
+    description:
+      - Unix socket of a running tools/vsphere_session_broker.py. The
+        module borrows one of the broker's pooled vCenter sessions instead
+        of logging in, and hands it back when it finishes. Takes precedence
+        over session_cache_dir.
+    required: false
+    default: null
+  soap_stats:
+    description:
+      - Count the SOAP calls made after login, with request and response
+        bytes and latency per method and the calls each function made,
+        and return them as soap_stats.
+    required: false
+    default: false
 
 notes:
   - This module should run from a system that can access vSphere directly.
@@ -264,6 +291,211 @@ def find_folder(viserver, folder_structure, folder_objects, dc_folder):
     return folder_mor, folder_children
 
 
+def get_session_cache_path(cache_dir, vcenter_hostname, vcenter_username):
+    # pysphere keeps a JSON dict of cookies, not the raw cookie the pyVmomi
+    # modules keep under session_<key> in the same directory.
+    key = hashlib.sha1("%s|%s" % (vcenter_hostname, vcenter_username)).hexdigest()
+    return os.path.join(os.path.expanduser(cache_dir), "pysphere_session_%s" % key)
+
+
+def save_session(viserver, cache_path):
+    cookies = dict((name, morsel.value) for name, morsel in viserver._proxy.binding.cookies.items())
+    directory = os.path.dirname(cache_path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    handle, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, "w") as cache_file:
+        json.dump(cookies, cache_file)
+    os.chmod(tmp_path, 0o600)
+    os.rename(tmp_path, cache_path)
+
+
+def resume_session(vcenter_hostname, vcenter_username, cache_path):
+    """
+    Rebuild a VIServer around the cached session cookie. Returns None when
+    there is no cached session or vCenter no longer accepts it.
+    """
+    try:
+        with open(cache_path) as cache_file:
+            cookies = json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+    viserver = resume_session_cookies(vcenter_hostname, vcenter_username, cookies)
+    if viserver is None:
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+    return viserver
+
+
+def resume_session_cookies(vcenter_hostname, vcenter_username, cookies):
+    """
+    Rebuild a VIServer around an existing session. Returns None when
+    vCenter no longer accepts the session cookies.
+    """
+    viserver = VIServer()
+    try:
+        # Mirrors VIServer.connect, minus the Login call.
+        viserver._proxy = VI.VimServiceLocator().getVimPortType(url='https://%s/sdk' % vcenter_hostname)
+        viserver._proxy.binding.AddHeader("User-Agent", "VMware VI Client/5.0.0")
+        for name, value in cookies.items():
+            viserver._proxy.binding.cookies[str(name)] = str(value)
+
+        request = VI.RetrieveServiceContentRequestMsg()
+        mor_service_instance = request.new__this('ServiceInstance')
+        mor_service_instance.set_attribute_type(MORTypes.ServiceInstance)
+        request.set_element__this(mor_service_instance)
+        viserver._do_service_content = viserver._proxy.RetrieveServiceContent(request)._returnval
+
+        # VIServer keeps its login state in name mangled attributes.
+        viserver._VIServer__server_type = viserver._do_service_content.About.Name
+        viserver._VIServer__api_version = viserver._do_service_content.About.ApiVersion
+        viserver._VIServer__api_type = viserver._do_service_content.About.ApiType
+        viserver._VIServer__user = vcenter_username
+        viserver._VIServer__logged = True
+
+        session = viserver._get_object_properties(VIMor(viserver._do_service_content.SessionManager, MORTypes.SessionManager),
+                                                  property_names=['currentSession'])
+        if viserver.keep_session_alive() and session is not None and session.PropSet:
+            return viserver
+    except Exception:
+        pass
+    return None
+
+
+class SessionBroker(object):
+    """
+    Client for tools/vsphere_session_broker.py. The broker lends out the
+    Set-Cookie header of a pooled pyVmomi session; pysphere only needs the
+    cookie values. The broker takes the lease back by itself if this
+    process dies.
+    """
+    def __init__(self, socket_path):
+        self.lease = None
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(os.path.expanduser(socket_path))
+        self.reader = self.sock.makefile("rb")
+
+    def _call(self, **request):
+        self.sock.sendall(json.dumps(request) + "\n")
+        line = self.reader.readline()
+        if not line:
+            raise Exception("vSphere session broker closed the connection")
+        response = json.loads(line)
+        if not response.get("ok"):
+            raise Exception(response.get("msg"))
+        return response
+
+    def connect(self, vcenter_hostname, vcenter_username, vcenter_password, timeout=300):
+        for attempt in range(2):
+            response = self._call(op="acquire", host=vcenter_hostname, user=vcenter_username,
+                                  password=vcenter_password, timeout=timeout)
+            self.lease = response["lease"]
+            cookies = dict((name, morsel.value) for name, morsel in SimpleCookie(str(response["cookie"])).items())
+            viserver = resume_session_cookies(vcenter_hostname, vcenter_username, cookies)
+            if viserver is not None:
+                return viserver
+            self.release(invalid=True, close=False)
+        return None
+
+    def release(self, invalid=False, close=True):
+        if self.lease is not None:
+            try:
+                self._call(op="release", lease=self.lease, invalid=invalid)
+            except Exception:
+                pass
+            self.lease = None
+        if close:
+            self.reader.close()
+            self.sock.close()
+
+
+class SoapStats(object):
+    """
+    Opt-in accounting of the SOAP calls a run makes: calls, request and
+    response bytes and latency per method, and calls per method for each
+    function that made them. install() wraps the methods of a VIServer's
+    _proxy, so the login before it is not counted. Byte counts come from
+    the ZSI binding: the request it sends and the response it keeps in
+    binding.data.
+    """
+    def __init__(self):
+        self.methods = {}
+        self.callers = {}
+        self.request_bytes = 0
+
+    def install(self, proxy):
+        binding = proxy.binding
+        if hasattr(binding, "SendSOAPData"):
+            send_soap_data = binding.SendSOAPData
+            stats = self
+
+            def SendSOAPData(soapdata, *args, **kwargs):
+                stats.request_bytes += len(soapdata)
+                return send_soap_data(soapdata, *args, **kwargs)
+            binding.SendSOAPData = SendSOAPData
+
+        for name in dir(proxy):
+            method = getattr(proxy, name)
+            if name.startswith("_") or name == "binding" or not callable(method):
+                continue
+            setattr(proxy, name, self._wrap(proxy, name, method))
+        return self
+
+    def _wrap(self, proxy, name, method):
+        stats = self
+
+        def call(*args, **kwargs):
+            stats.request_bytes = 0
+            proxy.binding.data = None
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                stats.add(name, time.time() - start, stats.request_bytes, len(proxy.binding.data or ""))
+        return call
+
+    def _caller(self):
+        home = sys._getframe(0).f_code.co_filename
+        frame = sys._getframe(1)
+        while frame is not None:
+            code = frame.f_code
+            if code.co_filename == home and code.co_name not in ("call", "add", "_caller"):
+                return code.co_name
+            frame = frame.f_back
+        return "other"
+
+    def add(self, method, seconds, request_bytes, response_bytes):
+        entry = self.methods.setdefault(method, {"calls": 0, "request_bytes": 0, "response_bytes": 0,
+                                                 "seconds": 0.0, "max_seconds": 0.0})
+        entry["calls"] += 1
+        entry["request_bytes"] += request_bytes
+        entry["response_bytes"] += response_bytes
+        entry["seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+        calls = self.callers.setdefault(self._caller(), {})
+        calls[method] = calls.get(method, 0) + 1
+
+    def report(self):
+        methods = dict((name, dict(x, seconds=round(x["seconds"], 3), max_seconds=round(x["max_seconds"], 3)))
+                       for name, x in self.methods.items())
+        return {"calls": sum(x["calls"] for x in methods.values()),
+                "request_bytes": sum(x["request_bytes"] for x in methods.values()),
+                "response_bytes": sum(x["response_bytes"] for x in methods.values()),
+                "seconds": round(sum(x["seconds"] for x in methods.values()), 3),
+                "methods": methods,
+                "callers": self.callers}
+
+
+def release_session(viserver, keep_session, broker=None):
+    if broker is not None:
+        broker.release()
+    elif not keep_session:
+        viserver.disconnect()
+
+
 def main():
     vm = None
 
@@ -275,6 +507,9 @@ def main():
             datacenter_name=dict(required=True, type='str'),
             folder_structure=dict(required=True, type='list'),
             guest_list=dict(required=True, type='list'),
+            session_cache_dir=dict(required=False, default=None, type='str'),
+            session_broker=dict(required=False, default=None, type='str'),
+            soap_stats=dict(required=False, default=False, type='bool'),
         ),
         supports_check_mode=False,
     )
@@ -288,14 +523,44 @@ def main():
     guest_list = module.params['guest_list']
     folder_structure = module.params['folder_structure']
     base_datacenter = module.params['datacenter_name']
+    session_cache_dir = module.params['session_cache_dir']
+    session_broker = module.params['session_broker']
 
     # CONNECT TO THE SERVER
-    viserver = VIServer()
-    try:
-        viserver.connect(vcenter_hostname, vcenter_username, vcenter_password)
-    except VIApiException, err:
-        module.fail_json(msg="Cannot connect to %s: %s" %
-                         (vcenter_hostname, err))
+    viserver = None
+    keep_session = False
+    broker = None
+    if session_broker:
+        try:
+            broker = SessionBroker(session_broker)
+            viserver = broker.connect(vcenter_hostname, vcenter_username, vcenter_password)
+        except Exception, err:
+            module.fail_json(msg="Cannot borrow a session from %s: %s" % (session_broker, err))
+        if viserver is None:
+            broker.release()
+            broker = None
+    elif session_cache_dir:
+        keep_session = True
+        cache_path = get_session_cache_path(session_cache_dir, vcenter_hostname, vcenter_username)
+        viserver = resume_session(vcenter_hostname, vcenter_username, cache_path)
+
+    if viserver is None:
+        viserver = VIServer()
+        try:
+            viserver.connect(vcenter_hostname, vcenter_username, vcenter_password)
+        except VIApiException, err:
+            module.fail_json(msg="Cannot connect to %s: %s" %
+                             (vcenter_hostname, err))
+
+        if keep_session:
+            save_session(viserver, cache_path)
+
+    if module.params['soap_stats']:
+        soap_stats = SoapStats().install(viserver._proxy)
+        # Every result, failures included, reports the calls made so far.
+        exit_json, fail_json = module.exit_json, module.fail_json
+        module.exit_json = lambda **kwargs: exit_json(soap_stats=soap_stats.report(), **kwargs)
+        module.fail_json = lambda **kwargs: fail_json(soap_stats=soap_stats.report(), **kwargs)
 
     vm_mors = []
     found_vms = []
@@ -322,10 +587,10 @@ def main():
                     temp_mors.append(vm)
             vm_mors = temp_mors
             if len(vm_mors) == 0:
-                viserver.disconnect()
+                release_session(viserver, keep_session, broker)
                 module.exit_json(changed=False)
         except Exception as e:
-            viserver.disconnect()
+            release_session(viserver, keep_session, broker)
             module.fail_json(msg=str(e))
 
         try:
@@ -336,16 +601,16 @@ def main():
             task.wait_for_state([task.STATE_SUCCESS, task.STATE_ERROR])
 
             if task.get_state() == task.STATE_ERROR:
-                viserver.disconnect()
+                release_session(viserver, keep_session, broker)
                 module.fail_json(msg="Error moving vm: %s to folder %s. Error: %s" %
                                  (found_vms, json.dumps(folder_structure), task.get_error_message()))
             else:
                 changed = True
         except Exception as e:
-            viserver.disconnect()
+            release_session(viserver, keep_session, broker)
             module.fail_json(msg="Error Requesting VM Move: %s for VM: %s" % (found_vms, json.dumps(folder_structure), str(e)))
 
-    viserver.disconnect()
+    release_session(viserver, keep_session, broker)
     module.exit_json(
         changed=changed,
         changes=found_vms)